@@ -0,0 +1,259 @@
+# annotation_render.py (Composición en el servidor de las anotaciones vectoriales de Fabric.js)
+#
+# El editor guarda el JSON de canvas.toJSON(): las coordenadas están en píxeles del
+# lienzo, donde la captura original es el backgroundImage escalado por scaleX/scaleY.
+# Aquí se redibujan trazos, textos y formas sobre la captura a su resolución real.
+
+import hashlib
+import io
+import json
+import math
+import re
+
+from PIL import Image, ImageColor, ImageDraw, ImageFont
+
+CURVE_STEPS = 8  # Segmentos con que se aproxima cada curva de un trazo
+DEFAULT_LINE_HEIGHT = 1.16  # Valor por defecto de fabric.Text
+FONT_FILES = {'normal': 'DejaVuSans.ttf', 'bold': 'DejaVuSans-Bold.ttf'}
+
+_RGBA_RE = re.compile(r'rgba?\(\s*([\d.]+)\s*,\s*([\d.]+)\s*,\s*([\d.]+)\s*(?:,\s*([\d.]+)\s*)?\)')
+
+
+def annotation_hash(annotation_json):
+    """Huella corta del JSON de la anotación, independiente del orden de las claves."""
+    canonical = json.dumps(json.loads(annotation_json), sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()[:16]
+
+
+def has_objects(annotation_json):
+    try:
+        return bool(json.loads(annotation_json).get('objects'))
+    except (ValueError, AttributeError):
+        return False
+
+
+def parse_color(value, opacity=1.0):
+    """Color de Fabric ('#rrggbb', 'rgb()', 'rgba()', nombre) a RGBA, o None si es transparente."""
+    if not value or value == 'transparent':
+        return None
+    match = _RGBA_RE.fullmatch(value.strip())
+    if match:
+        r, g, b = (int(float(match.group(i))) for i in (1, 2, 3))
+        alpha = float(match.group(4)) if match.group(4) is not None else 1.0
+    else:
+        try:
+            rgb = ImageColor.getrgb(value)
+        except ValueError:
+            return None
+        r, g, b = rgb[:3]
+        alpha = rgb[3] / 255 if len(rgb) == 4 else 1.0
+    return (r, g, b, round(255 * alpha * opacity))
+
+
+def _load_font(size, weight='normal'):
+    name = FONT_FILES['bold' if str(weight) in ('bold', '700', '800', '900') else 'normal']
+    try:
+        return ImageFont.truetype(name, size)
+    except OSError:
+        try:
+            return ImageFont.load_default(size)
+        except TypeError:  # Pillow < 10.1
+            return ImageFont.load_default()
+
+
+class _Transform:
+    """Transformación lienzo -> píxeles de la imagen para un objeto de Fabric."""
+
+    ORIGIN = {'left': 0.5, 'center': 0.0, 'right': -0.5, 'top': 0.5, 'bottom': -0.5}
+
+    def __init__(self, obj, background):
+        self.scale_x = obj.get('scaleX', 1) * (-1 if obj.get('flipX') else 1)
+        self.scale_y = obj.get('scaleY', 1) * (-1 if obj.get('flipY') else 1)
+        self.angle = math.radians(obj.get('angle', 0))
+        self.bg = background
+        # El ancho visible incluye el grosor del trazo, igual que en Fabric.
+        stroke = obj.get('strokeWidth', 0) or 0
+        dim_w = (obj.get('width', 0) + stroke) * abs(self.scale_x)
+        dim_h = (obj.get('height', 0) + stroke) * abs(self.scale_y)
+        offset_x = self.ORIGIN.get(obj.get('originX', 'left'), 0.5) * dim_w
+        offset_y = self.ORIGIN.get(obj.get('originY', 'top'), 0.5) * dim_h
+        cx, cy = self._rotate(offset_x, offset_y)
+        self.center = (obj.get('left', 0) + cx, obj.get('top', 0) + cy)
+
+    def _rotate(self, x, y):
+        cos, sin = math.cos(self.angle), math.sin(self.angle)
+        return x * cos - y * sin, x * sin + y * cos
+
+    def point(self, x, y):
+        """Punto en coordenadas locales del objeto (relativas a su centro) -> píxel de la imagen."""
+        rx, ry = self._rotate(x * self.scale_x, y * self.scale_y)
+        return self.bg.to_image(self.center[0] + rx, self.center[1] + ry)
+
+    def length(self, value):
+        return value * (abs(self.scale_x) + abs(self.scale_y)) / 2 / self.bg.scale
+
+
+class _Background:
+    def __init__(self, annotation, image_size):
+        bg = annotation.get('backgroundImage') or {}
+        width = bg.get('width') or image_size[0]
+        height = bg.get('height') or image_size[1]
+        # Si la captura se sustituyó por otra de distinta resolución, se reescala.
+        self.scale_x = bg.get('scaleX', 1) * width / image_size[0]
+        self.scale_y = bg.get('scaleY', 1) * height / image_size[1]
+        self.scale = (self.scale_x + self.scale_y) / 2
+        self.left = bg.get('left', 0)
+        self.top = bg.get('top', 0)
+
+    def to_image(self, x, y):
+        return ((x - self.left) / self.scale_x, (y - self.top) / self.scale_y)
+
+
+def _flatten_path(commands):
+    """Convierte los comandos M/L/Q/C/Z de un fabric.Path en listas de puntos."""
+    polylines, current, start = [], [], None
+    for command in commands:
+        op, args = command[0], command[1:]
+        if op in ('M', 'm'):
+            if len(current) > 1:
+                polylines.append(current)
+            current = [(args[0], args[1])]
+            start = current[0]
+        elif op == 'L' and current:
+            current.append((args[0], args[1]))
+        elif op == 'Q' and current:
+            (x0, y0), (x1, y1, x2, y2) = current[-1], args[:4]
+            for i in range(1, CURVE_STEPS + 1):
+                t = i / CURVE_STEPS
+                current.append(((1 - t) ** 2 * x0 + 2 * (1 - t) * t * x1 + t ** 2 * x2,
+                                (1 - t) ** 2 * y0 + 2 * (1 - t) * t * y1 + t ** 2 * y2))
+        elif op == 'C' and current:
+            (x0, y0), (x1, y1, x2, y2, x3, y3) = current[-1], args[:6]
+            for i in range(1, CURVE_STEPS + 1):
+                t = i / CURVE_STEPS
+                a, b, c, d = (1 - t) ** 3, 3 * (1 - t) ** 2 * t, 3 * (1 - t) * t ** 2, t ** 3
+                current.append((a * x0 + b * x1 + c * x2 + d * x3, a * y0 + b * y1 + c * y2 + d * y3))
+        elif op in ('Z', 'z') and current and start:
+            current.append(start)
+    if len(current) > 1:
+        polylines.append(current)
+    return polylines
+
+
+def _draw_polyline(draw, points, color, width):
+    draw.line(points, fill=color, width=width, joint='curve')
+    # Extremos redondeados, como el pincel de Fabric.
+    radius = width / 2
+    for x, y in (points[0], points[-1]):
+        draw.ellipse((x - radius, y - radius, x + radius, y + radius), fill=color)
+
+
+def _draw_path(draw, obj, transform):
+    color = parse_color(obj.get('stroke'), obj.get('opacity', 1))
+    if color is None:
+        return
+    width = max(1, round(transform.length(obj.get('strokeWidth', 1))))
+    polylines = _flatten_path(obj.get('path') or [])
+    if not polylines:
+        return
+    offset = obj.get('pathOffset')
+    if not offset:
+        # toJSON() no guarda pathOffset: Fabric lo recalcula como el centro de la caja del trazo.
+        xs = [x for polyline in polylines for x, _ in polyline]
+        ys = [y for polyline in polylines for _, y in polyline]
+        offset = {'x': (min(xs) + max(xs)) / 2, 'y': (min(ys) + max(ys)) / 2}
+    for polyline in polylines:
+        points = [transform.point(x - offset['x'], y - offset['y']) for x, y in polyline]
+        _draw_polyline(draw, points, color, width)
+
+
+def _draw_shape(draw, obj, transform):
+    kind = obj.get('type')
+    opacity = obj.get('opacity', 1)
+    fill = parse_color(obj.get('fill'), opacity)
+    stroke = parse_color(obj.get('stroke'), opacity)
+    width = max(1, round(transform.length(obj.get('strokeWidth', 1))))
+    if kind == 'line':
+        x1, y1, x2, y2 = (obj.get(k, 0) for k in ('x1', 'y1', 'x2', 'y2'))
+        # Igual que fabric.Line.calcLinePoints: los extremos son esquinas opuestas de la caja.
+        local_x = (-1 if x1 <= x2 else 1) * obj.get('width', 0) / 2
+        local_y = (-1 if y1 <= y2 else 1) * obj.get('height', 0) / 2
+        start, end = transform.point(local_x, local_y), transform.point(-local_x, -local_y)
+        if stroke:
+            _draw_polyline(draw, [start, end], stroke, width)
+        return
+    if kind == 'rect':
+        half_w, half_h = obj.get('width', 0) / 2, obj.get('height', 0) / 2
+        points = [transform.point(x, y) for x, y in
+                  ((-half_w, -half_h), (half_w, -half_h), (half_w, half_h), (-half_w, half_h))]
+    elif kind == 'triangle':
+        half_w, half_h = obj.get('width', 0) / 2, obj.get('height', 0) / 2
+        points = [transform.point(x, y) for x, y in ((0, -half_h), (half_w, half_h), (-half_w, half_h))]
+    else:  # circle / ellipse
+        rx = obj.get('rx', obj.get('radius', 0))
+        ry = obj.get('ry', obj.get('radius', 0))
+        points = [transform.point(rx * math.cos(a), ry * math.sin(a))
+                  for a in (2 * math.pi * i / 64 for i in range(64))]
+    if fill:
+        draw.polygon(points, fill=fill)
+    if stroke:
+        _draw_polyline(draw, points + [points[0]], stroke, width)
+
+
+def _draw_text(overlay, obj, transform):
+    color = parse_color(obj.get('fill'), obj.get('opacity', 1))
+    text = obj.get('text') or ''
+    if color is None or not text.strip():
+        return
+    scale = (abs(transform.scale_x) + abs(transform.scale_y)) / 2 / transform.bg.scale
+    # El JSON viene del navegador: la capa del texto nunca es mayor que la imagen.
+    max_width, max_height = overlay.size
+    font_size = min(max_height, max(1, round(obj.get('fontSize', 40) * scale)))
+    font = _load_font(font_size, obj.get('fontWeight', 'normal'))
+    line_height = max(1, round(font_size * obj.get('lineHeight', DEFAULT_LINE_HEIGHT)))
+    lines = text.split('\n')[:max_height // line_height + 1]
+    width = min(max_width, max(1, round(obj.get('width', 0) * scale), *(round(font.getlength(line)) for line in lines)))
+    height = min(max_height, max(1, round(obj.get('height', 0) * scale), line_height * len(lines)))
+
+    # El texto se dibuja en su propia capa para poder rotarlo con el objeto.
+    layer = Image.new('RGBA', (width, height), (0, 0, 0, 0))
+    layer_draw = ImageDraw.Draw(layer)
+    align = obj.get('textAlign', 'left')
+    for i, line in enumerate(lines):
+        line_width = font.getlength(line)
+        x = {'center': (width - line_width) / 2, 'right': width - line_width}.get(align, 0)
+        layer_draw.text((x, i * line_height), line, font=font, fill=color)
+    if transform.scale_x < 0:
+        layer = layer.transpose(Image.FLIP_LEFT_RIGHT)
+    if transform.scale_y < 0:
+        layer = layer.transpose(Image.FLIP_TOP_BOTTOM)
+    if transform.angle:
+        layer = layer.rotate(-math.degrees(transform.angle), resample=Image.BICUBIC, expand=True)
+    cx, cy = transform.point(0, 0)
+    overlay.alpha_composite(layer, (round(cx - layer.width / 2), round(cy - layer.height / 2)))
+
+
+def composite(image_bytes, annotation_json, jpeg_quality=90):
+    """Dibuja la anotación sobre la captura original y retorna un JPEG a resolución completa."""
+    annotation = json.loads(annotation_json)
+    base = Image.open(io.BytesIO(image_bytes)).convert('RGBA')
+    background = _Background(annotation, base.size)
+    overlay = Image.new('RGBA', base.size, (0, 0, 0, 0))
+    draw = ImageDraw.Draw(overlay)
+
+    for obj in annotation.get('objects') or []:
+        if not obj.get('visible', True):
+            continue
+        kind = obj.get('type')
+        transform = _Transform(obj, background)
+        if kind == 'path':
+            _draw_path(draw, obj, transform)
+        elif kind in ('i-text', 'text', 'textbox'):
+            _draw_text(overlay, obj, transform)
+        elif kind in ('rect', 'circle', 'ellipse', 'triangle', 'line'):
+            _draw_shape(draw, obj, transform)
+
+    result = Image.alpha_composite(base, overlay).convert('RGB')
+    output = io.BytesIO()
+    result.save(output, format='JPEG', quality=jpeg_quality)
+    return output.getvalue()
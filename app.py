@@ -3,25 +3,56 @@
 import os
 import sqlite3
 import io
+import shutil
+import tempfile
+import time
 import requests
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from urllib.parse import unquote
 import json
 from flask import Flask, Response, render_template, jsonify, request, redirect, url_for, session, send_file
 from functools import wraps
-from fpdf import FPDF
-from fpdf.enums import XPos, YPos
 import base64
+import binascii
 
 # --- IMPORTS DE FIREBASE ---
 import firebase_admin
 from firebase_admin import credentials, firestore, storage, auth
 from google.cloud.firestore_v1.base_query import FieldFilter
+from google.cloud.firestore_v1.field_path import FieldPath
+from google.api_core.exceptions import NotFound
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from streaming import AdaptiveStream, FrameBroadcaster, MJPEG_MIMETYPE
+from upload_queue import UploadQueue
+import report_images
+import annotation_render
+import derivatives
+import fluorescence
+import sequence
+from sequence import SequenceRecorder
+from report_cache import ReportCache, report_fingerprint
+import reports
+from reports import build_report_pdf, capture_image_source
+from local_cache import LocalCache, init_schema
+from jobs import JobRegistry
+import metrics
+import auth_cache
+from devices import DeviceRegistry, HeartbeatClient, hash_key
+import stream_relay
 
 # --- MODIFICACION PARA COMPATIBILIDAD CON VPS ---
 # (Este bloque está correcto y se queda igual)
+# LINFO_CAMERA=synthetic permite probar el streaming en un equipo sin cámara.
+CAMERA_BACKEND = os.environ.get('LINFO_CAMERA', 'pi')
 try:
-    from camera_pi import Camera
-    camera = Camera()
+    if CAMERA_BACKEND == 'synthetic':
+        from camera_synthetic import Camera
+        camera = Camera()
+    else:
+        from camera_pi import Camera
+        # LINFO_STILL_FROM_STREAM=1 captura desde el stream de doble resolución (sin cambio de modo).
+        camera = Camera(still_from_stream=os.environ.get('LINFO_STILL_FROM_STREAM') == '1')
     camera_available = True
     print("Cámara encontrada y activada.")
 except (ImportError, RuntimeError, ModuleNotFoundError):
@@ -29,9 +60,25 @@ except (ImportError, RuntimeError, ModuleNotFoundError):
     camera_available = False
     print("Cámara NO encontrada. Ejecutando en modo servidor/sin cámara.")
 
+# Un único productor codifica cada frame; todos los clientes de /video_feed lo comparten.
+# Si la cámara ya publica sus frames (encoder continuo) se usa directamente.
+frame_broadcaster = None
+adaptive_stream = None
+if camera_available:
+    frame_broadcaster = getattr(camera, 'frames', None) or FrameBroadcaster(camera.get_frame).start()
+    # Niveles de menor resolución/fps/calidad para los clientes con peor conexión.
+    adaptive_stream = AdaptiveStream(frame_broadcaster)
+
+# Búfer de los últimos segundos de la vista previa y grabaciones a intervalo fijo (ICG).
+sequence_recorder = None
+if camera_available:
+    sequence_recorder = getattr(camera, 'sequence', None) or SequenceRecorder(frame_broadcaster).start()
+
 # --- INICIALIZACIÓN CENTRAL ---
 app = Flask(__name__)
 app.secret_key = 'clave-secreta-para-el-linfofluoroscopio'
+# Tiempos de cada ruta y de las llamadas externas, exportados en /metrics.
+metrics.init_app(app)
 
 # --- INICIALIZACIÓN DE FIREBASE ---
 # (Esta sección está correcta y se queda igual)
@@ -48,33 +95,16 @@ except Exception as e:
     db_firestore = None
     bucket = None
 
-# --- [COMIENZO DEL CÓDIGO SIN CAMBIOS HASTA 'start_study'] ---
+# --- VERIFICACIÓN DE SESIONES ---
+# Los ID tokens se verifican localmente con los certificados de Google, compartidos
+# entre workers en disco. El rol y el equipo salen de los claims del token; el perfil
+# de Firestore solo se lee (y se cachea) si faltan.
+profile_cache = auth_cache.ProfileCache(db_firestore)
+token_verifier = None
+if db_firestore:
+    token_verifier = auth_cache.TokenVerifier(firebase_admin.get_app().project_id, auth_cache.CertCache())
 
-class PDF(FPDF):
-    def header(self):
-        self.set_font('Helvetica', 'B', 16)
-        self.cell(0, 10, 'LINFOFLUOROSCOPIA', align='C', new_x=XPos.LMARGIN, new_y=YPos.NEXT)
-        self.ln(5)
-
-    def footer(self):
-        self.set_y(-15)
-        self.set_font('Helvetica', 'I', 8)
-        self.cell(0, 10, f'Página {self.page_no()}', align='C')
-
-    def chapter_title(self, title):
-        self.set_font('Helvetica', 'B', 12)
-        self.cell(0, 10, title, new_x=XPos.LMARGIN, new_y=YPos.NEXT)
-        self.ln(4)
-
-    def chapter_body(self, name, data):
-        y_before = self.get_y()
-        self.set_font('Helvetica', 'B', 11)
-        self.multi_cell(40, 10, name, border=1, new_x="RIGHT", new_y="TOP")
-        self.set_y(y_before)
-        self.set_x(self.l_margin + 40)
-        self.set_font('Helvetica', '', 11)
-        available_width = self.w - self.l_margin - self.r_margin - 40
-        self.multi_cell(available_width, 10, data, border=1, new_x="LMARGIN", new_y="NEXT")
+# --- [COMIENZO DEL CÓDIGO SIN CAMBIOS HASTA 'start_study'] ---
 
 def get_db_connection():
     conn = sqlite3.connect('linfoscopio.db')
@@ -84,24 +114,72 @@ def get_db_connection():
 
 def init_db():
     conn = get_db_connection()
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS patients (
-            id INTEGER PRIMARY KEY AUTOINCREMENT, cedula TEXT NOT NULL UNIQUE,
-            nombre TEXT NOT NULL, apellido TEXT NOT NULL, edad INTEGER, telefono TEXT,
-            firestore_id TEXT UNIQUE
-        )
-    ''')
-    conn.execute('''
-        CREATE TABLE IF NOT EXISTS captures (
-            id INTEGER PRIMARY KEY AUTOINCREMENT, patient_firestore_id TEXT, timestamp TEXT,
-            storage_path TEXT, firestore_id TEXT UNIQUE, cloud_url TEXT,
-            FOREIGN KEY (patient_firestore_id) REFERENCES patients (firestore_id) ON DELETE CASCADE
-        )
-    ''')
+    # Las tablas 'patients' y 'captures' son la réplica local de Firestore (ver local_cache.py).
+    init_schema(conn)
     conn.close()
 
 init_db()
 
+# --- RÉPLICA LOCAL DE FIRESTORE ---
+# Pacientes y capturas se leen de SQLite en cuanto el listener del equipo está al día.
+local_cache = LocalCache('linfoscopio.db', db_firestore)
+
+def local_cache_ready(team_id):
+    local_cache.watch_team(team_id)
+    return local_cache.is_ready(team_id)
+
+# --- COLA DE SUBIDAS ---
+# Las capturas se guardan primero en disco (spool) y se suben a Storage en segundo plano.
+# Las miniaturas de la galería y las métricas de fluorescencia se calculan desde el
+# archivo del spool, antes de subirlo.
+upload_queue = UploadQueue('linfoscopio.db', 'capture_spool', bucket, db_firestore,
+                           derivatives=derivatives.derivatives_for_upload,
+                           analyze=fluorescence.analysis_for_upload).start()
+
+# --- REGISTRO DE DISPOSITIVOS ---
+# Índice en memoria de las Pi de cada equipo, alimentado por sus latidos y un listener.
+device_registry = DeviceRegistry(db_firestore)
+
+# Si esta instancia corre en una Pi con cámara y está dada de alta, anuncia su IP al servidor.
+if camera_available and os.environ.get('LINFO_REGISTRY_URL') and os.environ.get('LINFO_DEVICE_ID'):
+    HeartbeatClient(
+        os.environ['LINFO_REGISTRY_URL'], os.environ['LINFO_DEVICE_ID'], os.environ.get('LINFO_DEVICE_KEY', ''),
+        capabilities={'camera': CAMERA_BACKEND,
+                      'still_from_stream': os.environ.get('LINFO_STILL_FROM_STREAM') == '1',
+                      # URL por la que el servidor alcanza esta Pi si no es su IP local (túnel, VPN).
+                      'stream_url': os.environ.get('LINFO_STREAM_URL')},
+        status_fn=lambda: 'busy' if frame_broadcaster and frame_broadcaster.clients else 'idle',
+    ).start()
+
+# Las peticiones que reenvía el relé del servidor vienen firmadas con el hash de la clave de esta Pi.
+DEVICE_KEY_HASH = hash_key(os.environ['LINFO_DEVICE_KEY']) if os.environ.get('LINFO_DEVICE_KEY') else None
+
+# --- RELÉ DEL STREAM ---
+# En el servidor (sin cámara) /stream/* se sirve desde la Pi elegida: una conexión por
+# dispositivo, compartida por todos los navegadores que miran ese estudio.
+def resolve_device(device_id):
+    device = device_registry.get(device_id)
+    if not device or not device_registry.is_online(device):
+        return None, None
+    capabilities = device.get('capabilities') or {}
+    # Solo IP privadas en el puerto fijo o túneles de LINFO_TUNNEL_HOSTS (ver stream_relay).
+    base_url = stream_relay.device_base_url(device.get('local_ip'), capabilities.get('stream_url'))
+    if not base_url:
+        return None, None
+    return base_url, device.get('key_hash')
+
+relay = stream_relay.StreamRelay(resolve_device)
+
+# --- CACHÉ DE INFORMES PDF ---
+report_cache = ReportCache('linfoscopio.db')
+
+# --- TRABAJOS EN SEGUNDO PLANO ---
+# Operaciones largas (borrado en cascada, etc.); su progreso se consulta en /jobs/<id>.
+# Los borrados de pacientes tienen sus propios hilos: no esperan a backfills ni exportaciones.
+jobs = JobRegistry(dedicated_workers={'delete_patient': 2})
+FIRESTORE_BATCH_SIZE = 500  # Límite de operaciones por WriteBatch
+STORAGE_DELETE_WORKERS = 8
+
 def sync_to_firestore(collection_name, data, document_id=None):
     if not db_firestore: return None
     try:
@@ -109,7 +187,8 @@ def sync_to_firestore(collection_name, data, document_id=None):
             doc_ref = db_firestore.collection(collection_name).document(document_id)
         else:
             doc_ref = db_firestore.collection(collection_name).document()
-        doc_ref.set(data, merge=True)
+        with metrics.span('firestore', 'set'):
+            doc_ref.set(data, merge=True)
         return doc_ref.id
     except Exception as e:
         print(f"Error al sincronizar con Firestore: {e}")
@@ -119,8 +198,9 @@ def upload_to_storage(source_file_path, destination_blob_name):
     if not bucket: return None
     try:
         blob = bucket.blob(destination_blob_name)
-        blob.upload_from_filename(source_file_path)
-        blob.make_public()
+        with metrics.span('storage', 'upload'):
+            blob.upload_from_filename(source_file_path)
+            blob.make_public()
         print(f"Archivo {source_file_path} subido a Storage como {destination_blob_name}.")
         return blob.public_url
     except Exception as e:
@@ -130,23 +210,36 @@ def upload_to_storage(source_file_path, destination_blob_name):
 def delete_from_firestore(collection_name, document_id):
     if not db_firestore: return
     try:
-        db_firestore.collection(collection_name).document(str(document_id)).delete()
+        with metrics.span('firestore', 'delete'):
+            db_firestore.collection(collection_name).document(str(document_id)).delete()
     except Exception as e:
         print(f"Error al eliminar de Firestore: {e}")
 
 def delete_from_storage(blob_name):
     if not bucket: return
     try:
-        blob = bucket.blob(blob_name)
-        if blob.exists():
-            blob.delete()
+        with metrics.span('storage', 'delete'):
+            bucket.blob(blob_name).delete()
+    except NotFound:
+        pass
     except Exception as e:
         print(f"Error al eliminar de Storage: {e}")
 
+def relayed_user():
+    """Usuario de una petición reenviada por el relé del servidor, o None."""
+    if not DEVICE_KEY_HASH or 'X-Relay-User' not in request.headers:
+        return None
+    return stream_relay.verify_user(request.headers, DEVICE_KEY_HASH)
+
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if 'user' not in session:
+        user = relayed_user()
+        if user:
+            # Vale solo para esta petición: no se devuelve cookie de sesión al relé.
+            session['user'] = user
+            session.modified = False
+        elif 'user' not in session:
             return redirect(url_for('login'))
         return f(*args, **kwargs)
     return decorated_function
@@ -190,27 +283,44 @@ def login():
         return redirect(url_for('dashboard'))
     return render_template('login.html')
 
+def establish_session(id_token):
+    """Verifica el token y guarda el usuario en la sesión. Retorna None si no tiene perfil."""
+    if token_verifier is None:
+        raise auth_cache.AuthError("Firebase no está disponible.")
+    claims = token_verifier.verify(id_token)
+    user = auth_cache.session_user(claims, profile_cache)
+    if user is not None:
+        session['user'] = user
+    return user
+
 @app.route('/session_login', methods=['POST'])
 def session_login():
     try:
-        id_token = request.json['token']
-        decoded_token = auth.verify_id_token(id_token)
-        uid = decoded_token['uid']
-        user_profile_ref = db_firestore.collection('users').document(uid)
-        user_profile = user_profile_ref.get()
-        if not user_profile.exists:
+        user = establish_session(request.json['token'])
+        if user is None:
             return jsonify({"status": "error", "message": "El perfil de usuario no existe."}), 401
-        profile_data = user_profile.to_dict()
-        session['user'] = {
-            'uid': uid,
-            'email': profile_data.get('email'),
-            'role': profile_data.get('role'),
-            'team_id': profile_data.get('team_id')
-        }
+        local_cache.watch_team(user['team_id'])
+        device_registry.watch_team(user['team_id'])
         return jsonify({"status": "success"}), 200
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 401
 
+@app.route('/session_refresh', methods=['POST'])
+def session_refresh():
+    """Revalida la sesión con un ID token renovado (getIdToken(true) tras un cambio de rol).
+
+    Con los claims en el token no lee Firestore, y repetir el mismo token solo
+    cuesta una búsqueda en la caché de tokens verificados.
+    """
+    try:
+        user = establish_session(request.json['token'])
+        if user is None:
+            session.pop('user', None)
+            return jsonify({"status": "error", "message": "El perfil de usuario no existe."}), 401
+        return jsonify({"status": "success", "role": user['role'], "team_id": user['team_id']}), 200
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 401
+
 @app.route('/logout')
 @login_required
 def logout():
@@ -256,29 +366,127 @@ def register_patient():
                 'tratamiento_quirurgico': request.form.get('tratamiento_quirurgico'),
             }
             patient_data['history'] = history_data
-            sync_to_firestore('patients', patient_data)
+            patient_id = sync_to_firestore('patients', patient_data)
+            if patient_id:
+                local_cache.upsert_patient(patient_id, patient_data)
             return redirect(url_for('dashboard'))
         except Exception as e:
             print(f"Error al registrar el paciente: {e}")
             return "Error al guardar el paciente.", 500
     return render_template('register_patient.html', user=session['user'])
 
+# --- PAGINACIÓN DE LA LISTA DE PACIENTES ---
+PATIENT_PAGE_SIZE = 50
+MAX_PATIENT_PAGE_SIZE = 200
+# Solo los campos que muestra patient_list.html (el historial no viaja).
+PATIENT_LIST_FIELDS = ['nombre', 'apellido', 'cedula']
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, binascii.Error):
+        return None
+
+def get_page_size(default, maximum):
+    try:
+        page_size = int(request.args.get('page_size', default))
+    except ValueError:
+        page_size = default
+    return max(1, min(page_size, maximum))
+
+def fetch_patient_page(team_id, cursor=None, page_size=PATIENT_PAGE_SIZE):
+    """Una página de pacientes del equipo ordenada por apellido.
+
+    El cursor es (apellido, id del documento) del último paciente de la página
+    anterior; el id desempata apellidos repetidos. Retorna (pacientes, siguiente_cursor).
+    """
+    cursor_values = decode_cursor(cursor) if cursor else None
+    if local_cache_ready(team_id):
+        patients, has_more = local_cache.patient_page(team_id, cursor_values, page_size)
+        next_cursor = None
+        if has_more:
+            last = patients[-1]
+            next_cursor = encode_cursor([last.get('apellido'), last['firestore_id']])
+        return patients, next_cursor
+    query = (db_firestore.collection('patients')
+             .where(filter=FieldFilter('team_id', '==', team_id))
+             .order_by('apellido')
+             .order_by(FieldPath.document_id())
+             .select(PATIENT_LIST_FIELDS)
+             .limit(page_size + 1))
+    if cursor_values:
+        apellido, doc_id = cursor_values
+        query = query.start_after({'apellido': apellido, FieldPath.document_id(): doc_id})
+    with metrics.span('firestore', 'query'):
+        docs = list(query.stream())
+    patients = []
+    for doc in docs[:page_size]:
+        patient_data = doc.to_dict()
+        patient_data['firestore_id'] = doc.id
+        patients.append(patient_data)
+    next_cursor = None
+    if len(docs) > page_size:
+        last = patients[-1]
+        next_cursor = encode_cursor([last.get('apellido'), last['firestore_id']])
+    return patients, next_cursor
+
 @app.route('/patient_list')
 @login_required
 def patient_list():
     patients_list = []
+    next_cursor = None
     team_id = session['user']['team_id']
-    if db_firestore:
+    page_size = get_page_size(PATIENT_PAGE_SIZE, MAX_PATIENT_PAGE_SIZE)
+    if db_firestore or local_cache_ready(team_id):
         try:
-            query = db_firestore.collection('patients').where(filter=FieldFilter('team_id', '==', team_id)).order_by('apellido')
-            docs = query.stream()
-            for doc in docs:
-                patient_data = doc.to_dict()
-                patient_data['firestore_id'] = doc.id
-                patients_list.append(patient_data)
+            patients_list, next_cursor = fetch_patient_page(team_id, request.args.get('cursor'), page_size)
         except Exception as e:
             print(f"Error al leer pacientes de Firestore: {e}")
-    return render_template('patient_list.html', patients=patients_list, user=session.get('user'))
+    return render_template('patient_list.html', patients=patients_list, next_cursor=next_cursor,
+                           page_size=page_size, user=session.get('user'))
+
+@app.route('/api/patients')
+@login_required
+def api_patients():
+    """Página de pacientes en JSON para el scroll infinito de patient_list."""
+    team_id = session['user']['team_id']
+    if not db_firestore and not local_cache_ready(team_id):
+        return jsonify(status="error", message="Base de datos no disponible."), 503
+    page_size = get_page_size(PATIENT_PAGE_SIZE, MAX_PATIENT_PAGE_SIZE)
+    try:
+        patients, next_cursor = fetch_patient_page(team_id, request.args.get('cursor'), page_size)
+    except Exception as e:
+        print(f"Error al leer pacientes de Firestore: {e}")
+        return jsonify(status="error", message="No se pudo leer la lista de pacientes."), 500
+    for patient in patients:
+        patient['detail_url'] = url_for('patient_detail', firestore_patient_id=patient['firestore_id'])
+        patient['study_url'] = url_for('start_study', firestore_patient_id=patient['firestore_id'])
+    return jsonify(status="success", patients=patients, next_cursor=next_cursor)
+
+@app.route('/patients/search')
+@login_required
+def search_patients():
+    """Búsqueda por prefijo de nombre, apellido o cédula sobre el índice FTS5 local."""
+    team_id = session['user']['team_id']
+    query_text = request.args.get('q', '').strip()
+    try:
+        limit = max(1, min(int(request.args.get('limit', 20)), 100))
+    except ValueError:
+        limit = 20
+    # 'partial' indica que la réplica local del equipo todavía no terminó de cargarse.
+    ready = local_cache_ready(team_id)
+    try:
+        patients = local_cache.search_patients(team_id, query_text, limit) if query_text else []
+    except Exception as e:
+        print(f"Error en la búsqueda de pacientes: {e}")
+        return jsonify(status="error", message="No se pudo realizar la búsqueda."), 500
+    for patient in patients:
+        patient['detail_url'] = url_for('patient_detail', firestore_patient_id=patient['firestore_id'])
+        patient['study_url'] = url_for('start_study', firestore_patient_id=patient['firestore_id'])
+    return jsonify(status="success", patients=patients, partial=not ready)
 
 # --- [FIN DEL CÓDIGO SIN CAMBIOS] ---
 
@@ -290,72 +498,227 @@ def start_study(firestore_patient_id):
     if session['user']['role'] != 'doctor':
         return "Acceso denegado.", 403
     
-    patient_ref = db_firestore.collection('patients').document(firestore_patient_id)
-    patient = patient_ref.get()
+    if local_cache_ready(session['user']['team_id']):
+        patient_data = local_cache.get_patient(firestore_patient_id)
+    else:
+        patient_ref = db_firestore.collection('patients').document(firestore_patient_id)
+        with metrics.span('firestore', 'get'):
+            patient = patient_ref.get()
+        patient_data = None
+        if patient.exists:
+            patient_data = patient.to_dict()
+            patient_data['firestore_id'] = patient.id
     
     # He corregido el bug que tenías: usaba 'patient_doc' (que no existía) en lugar de 'patient'.
-    if not patient.exists or patient.to_dict().get('team_id') != session['user']['team_id']:
+    if not patient_data or patient_data.get('team_id') != session['user']['team_id']:
         return "Paciente no encontrado o acceso no autorizado.", 404
-    
-    patient_data = patient.to_dict()
-    patient_data['firestore_id'] = patient.id
 
-    # --- NUEVA LÓGICA PARA OBTENER LA IP DEL DISPOSITIVO DESDE FIREBASE ---
+    # El dispositivo sale del índice en memoria (latidos + listener), sin leer Firestore.
     team_id = patient_data.get('team_id')
-    device_ip = "127.0.0.1" # IP por defecto en caso de que no se encuentre el dispositivo
-
-    if team_id:
-        # Asumimos que el ID del dispositivo está predefinido en el código.
-        # Este ID debe coincidir con el que pusiste en el device_config.json de tu Pi.
-        device_id = "LINFO-PROTO-001" 
-        try:
-            device_ref = db_firestore.collection('devices').document(device_id)
-            device_doc = device_ref.get()
-            if device_doc.exists:
-                # Aquí se podría añadir una lógica para verificar que el dispositivo
-                # pertenece al team_id del paciente, pero por simplicidad la omitimos.
-                device_ip = device_doc.to_dict().get('local_ip', '127.0.0.1')
-                print(f"IP del dispositivo encontrada para el equipo {team_id}: {device_ip}")
-        except Exception as e:
-            print(f"Error al buscar la IP del dispositivo para el equipo {team_id}: {e}")
-    # --- FIN DE LA NUEVA LÓGICA ---
+    device_registry.watch_team(team_id)
+    devices = device_registry.online_devices(team_id)
+    device = device_registry.pick_device(team_id, request.values.get('device_id') or session.get('device_id'))
+    device_ip = device['local_ip'] if device and device.get('local_ip') else "127.0.0.1"
+    if device:
+        session['device_id'] = device['device_id']
 
     if request.method == 'POST':
         study_area = request.form.get('study_area')
         # Pasamos la nueva variable device_ip a la plantilla study.html
-        return render_template('study.html', patient=patient_data, study_area=study_area, user=session.get('user'), device_ip=device_ip)
+        return render_template('study.html', patient=patient_data, study_area=study_area, user=session.get('user'),
+                               device_ip=device_ip, device=device)
 
-    return render_template('select_study_area.html', patient=patient_data, user=session.get('user'))
+    return render_template('select_study_area.html', patient=patient_data, user=session.get('user'),
+                           devices=devices, device=device)
 # --- FIN DE LA FUNCIÓN MODIFICADA ---
 
 
 # --- [COMIENZO DEL CÓDIGO SIN CAMBIOS HASTA EL FINAL] ---
+# --- GALERÍA DE CAPTURAS (PAGINADA) ---
+CAPTURE_PAGE_SIZE = 24
+MAX_CAPTURE_PAGE_SIZE = 100
+# De la fluorescencia, solo lo que muestra la galería (la máscara de reflujo no viaja).
+GALLERY_FLUORESCENCE_KEYS = ['area_fraction', 'threshold', 'mean_intensity', 'backflow_fraction',
+                             'regions', 'histogram']
+GALLERY_FIELDS = (['timestamp', 'study_area', 'cloud_url', 'thumb_small_url', 'thumb_medium_url',
+                   'annotated_url', 'annotated_thumb_small_url', 'annotated_thumb_medium_url',
+                   'annotation_hash']
+                  + [f'fluorescence.{key}' for key in GALLERY_FLUORESCENCE_KEYS])
+FIRESTORE_READ_WORKERS = 8
+
+# Lecturas de Firestore que una misma petición lanza a la vez (paciente + página de capturas).
+firestore_reads = ThreadPoolExecutor(max_workers=FIRESTORE_READ_WORKERS, thread_name_prefix='firestore-read')
+
+def capture_cursor(capture):
+    timestamp = capture.get('timestamp')
+    if isinstance(timestamp, datetime):
+        timestamp = timestamp.isoformat()
+    return encode_cursor([timestamp, capture['firestore_id']])
+
+def fetch_capture_page(team_id, firestore_patient_id, cursor=None, page_size=CAPTURE_PAGE_SIZE):
+    """Una página de capturas del paciente, de la más reciente a la más antigua.
+
+    El cursor es (timestamp en ISO, id del documento) de la última captura de la
+    página anterior. De Firestore solo se piden GALLERY_FIELDS. No comprueba el
+    equipo del paciente: eso lo hace quien la llama. Retorna (capturas, siguiente_cursor).
+    """
+    cursor_values = decode_cursor(cursor) if cursor else None
+    if local_cache_ready(team_id):
+        captures, has_more = local_cache.capture_page(firestore_patient_id, cursor_values, page_size)
+        return captures, capture_cursor(captures[-1]) if has_more else None
+    query = (db_firestore.collection('captures')
+             .where(filter=FieldFilter('patient_firestore_id', '==', firestore_patient_id))
+             .order_by('timestamp', direction=firestore.Query.DESCENDING)
+             .order_by(FieldPath.document_id(), direction=firestore.Query.DESCENDING)
+             .select(GALLERY_FIELDS)
+             .limit(page_size + 1))
+    if cursor_values and cursor_values[0]:
+        timestamp, doc_id = cursor_values
+        query = query.start_after({'timestamp': datetime.fromisoformat(timestamp), FieldPath.document_id(): doc_id})
+    with metrics.span('firestore', 'query'):
+        docs = list(query.stream())
+    captures = []
+    for doc in docs[:page_size]:
+        capture_data = doc.to_dict()
+        capture_data['firestore_id'] = doc.id
+        captures.append(capture_data)
+    return captures, capture_cursor(captures[-1]) if len(docs) > page_size else None
+
+def read_patient(firestore_patient_id, field_paths=None):
+    doc_ref = db_firestore.collection('patients').document(firestore_patient_id)
+    with metrics.span('firestore', 'get'):
+        patient = doc_ref.get(field_paths=field_paths)
+    if not patient.exists:
+        return None
+    patient_data = patient.to_dict()
+    patient_data['firestore_id'] = patient.id
+    return patient_data
+
+def load_patient_captures(team_id, firestore_patient_id, cursor=None, page_size=CAPTURE_PAGE_SIZE,
+                          patient_fields=None):
+    """El paciente y una página de sus capturas.
+
+    Con Firestore las dos lecturas se lanzan a la vez; las capturas se descartan si
+    el paciente no es del equipo. Retorna (paciente, capturas, siguiente_cursor), con
+    paciente None si no existe o no es del equipo. 'patient_fields' limita los campos
+    leídos del paciente (None: el documento completo, que se guarda en la réplica local).
+    """
+    if local_cache_ready(team_id):
+        patient_data = local_cache.get_patient(firestore_patient_id)
+        if not patient_data or patient_data.get('team_id') != team_id:
+            return None, [], None
+        captures, next_cursor = fetch_capture_page(team_id, firestore_patient_id, cursor, page_size)
+        return patient_data, captures, next_cursor
+    patient_future = firestore_reads.submit(read_patient, firestore_patient_id, patient_fields)
+    captures_future = firestore_reads.submit(fetch_capture_page, team_id, firestore_patient_id, cursor, page_size)
+    patient_data = patient_future.result()
+    if not patient_data or patient_data.get('team_id') != team_id:
+        captures_future.cancel()
+        return None, [], None
+    if patient_fields is None:
+        local_cache.upsert_patient(firestore_patient_id, {k: v for k, v in patient_data.items() if k != 'firestore_id'})
+    captures, next_cursor = captures_future.result()
+    return patient_data, captures, next_cursor
+
+def load_cached_patient_captures(team_id, firestore_patient_id, cursor=None, page_size=CAPTURE_PAGE_SIZE):
+    """Lo mismo que load_patient_captures, solo desde la réplica local (sin conexión con Firestore)."""
+    patient_data = local_cache.get_patient(firestore_patient_id)
+    if not patient_data or patient_data.get('team_id') != team_id:
+        return None, [], None
+    captures, has_more = local_cache.capture_page(firestore_patient_id, decode_cursor(cursor) if cursor else None,
+                                                  page_size)
+    return patient_data, captures, capture_cursor(captures[-1]) if has_more else None
+
+def gallery_item(capture):
+    """Lo que necesita la galería de una captura, con las URL de imagen y miniaturas ya elegidas.
+
+    La galería usa miniaturas; la resolución completa solo se carga al abrirla o anotarla.
+    """
+    capture_id = capture['firestore_id']
+    if capture.get('annotated_url'):
+        # Anotaciones raster anteriores a sus miniaturas: se usan las de la captura original.
+        image_url = capture['annotated_url']
+        thumb_small = (capture.get('annotated_thumb_small_url') or capture.get('thumb_small_url')
+                       or image_url)
+        thumb_medium = (capture.get('annotated_thumb_medium_url') or capture.get('thumb_medium_url')
+                        or image_url)
+    elif capture.get('annotation_hash'):
+        image_url = url_for('annotated_capture', capture_id=capture_id)
+        thumb_small = url_for('annotated_capture', capture_id=capture_id, size='small')
+        thumb_medium = url_for('annotated_capture', capture_id=capture_id, size='medium')
+    else:
+        image_url = capture.get('cloud_url')
+        thumb_small = capture.get('thumb_small_url') or image_url
+        thumb_medium = capture.get('thumb_medium_url') or image_url
+    timestamp = capture.get('timestamp')
+    fluorescence_data = capture.get('fluorescence')
+    return {
+        'firestore_id': capture_id,
+        'study_area': capture.get('study_area') or 'General',
+        'timestamp': timestamp.isoformat() if isinstance(timestamp, datetime) else timestamp,
+        'timestamp_display': timestamp.strftime('%d-%m-%Y %H:%M') if isinstance(timestamp, datetime) else '',
+        'cloud_url': capture.get('cloud_url'),
+        'image_url': image_url,
+        'thumb_small': thumb_small,
+        'thumb_medium': thumb_medium,
+        # El JSON de la anotación puede ser grande: el editor lo pide al abrirse.
+        'annotation_url': url_for('capture_annotation', capture_id=capture_id),
+        'fluorescence': ({key: fluorescence_data.get(key) for key in GALLERY_FLUORESCENCE_KEYS}
+                         if fluorescence_data and 'area_fraction' in fluorescence_data else None),
+        'delete_url': url_for('delete_capture', firestore_capture_id=capture_id),
+    }
+
+def group_by_study_area(captures):
+    """Agrupa una página de capturas por zona de estudio, en el orden en que aparece cada zona."""
+    groups = {}
+    for capture in captures:
+        item = gallery_item(capture)
+        groups.setdefault(item['study_area'], []).append(item)
+    return [{'study_area': area, 'captures': items} for area, items in groups.items()]
+
 @app.route('/patient/<string:firestore_patient_id>')
 @login_required
 def patient_detail(firestore_patient_id):
+    """Cabecera del paciente y la página más reciente de la galería; el resto de la
+    galería lo pide el navegador a /api/patients/<id>/captures."""
     patient_data = None
-    captures_list = []
+    captures = []
+    next_cursor = None
     team_id = session['user']['team_id']
-    if db_firestore:
+    page_size = get_page_size(CAPTURE_PAGE_SIZE, MAX_CAPTURE_PAGE_SIZE)
+    if db_firestore or local_cache_ready(team_id):
         try:
-            doc_ref = db_firestore.collection('patients').document(firestore_patient_id)
-            patient = doc_ref.get()
-            if patient.exists and patient.to_dict().get('team_id') == team_id:
-                patient_data = patient.to_dict()
-                patient_data['firestore_id'] = patient.id
-                captures_query = db_firestore.collection('captures').where(filter=FieldFilter('patient_firestore_id', '==', firestore_patient_id)).order_by('timestamp', direction=firestore.Query.DESCENDING)
-                captures_stream = captures_query.stream()
-                for capture in captures_stream:
-                    capture_data = capture.to_dict()
-                    capture_data['firestore_id'] = capture.id
-                    captures_list.append(capture_data)
-            else:
-                return "Acceso denegado o paciente no encontrado.", 404
+            patient_data, captures, next_cursor = load_patient_captures(team_id, firestore_patient_id, None, page_size)
         except Exception as e:
             print(f"Error al leer detalles de Firestore: {e}")
+            # Sin conexión: se sirve lo que haya en la réplica local.
+            patient_data, captures, next_cursor = load_cached_patient_captures(team_id, firestore_patient_id,
+                                                                               None, page_size)
     if not patient_data:
-        return "Paciente no encontrado", 404
-    return render_template('patient_detail.html', patient=patient_data, captures=captures_list, user=session.get('user'))
+        return "Acceso denegado o paciente no encontrado.", 404
+    return render_template('patient_detail.html', patient=patient_data, capture_groups=group_by_study_area(captures),
+                           next_cursor=next_cursor, page_size=page_size, user=session.get('user'),
+                           annotation_vector_mode=ANNOTATION_STORAGE_MODE == 'vector')
+
+@app.route('/api/patients/<string:firestore_patient_id>/captures')
+@login_required
+def api_patient_captures(firestore_patient_id):
+    """Página de la galería de un paciente en JSON, agrupada por zona de estudio."""
+    team_id = session['user']['team_id']
+    if not db_firestore and not local_cache_ready(team_id):
+        return jsonify(status="error", message="Base de datos no disponible."), 503
+    page_size = get_page_size(CAPTURE_PAGE_SIZE, MAX_CAPTURE_PAGE_SIZE)
+    cursor = request.args.get('cursor')
+    try:
+        # Del paciente solo hace falta el equipo, para comprobar el acceso.
+        patient_data, captures, next_cursor = load_patient_captures(team_id, firestore_patient_id, cursor, page_size,
+                                                                    patient_fields=['team_id'])
+    except Exception as e:
+        print(f"Error al leer capturas de Firestore: {e}")
+        return jsonify(status="error", message="No se pudieron leer las capturas."), 500
+    if not patient_data:
+        return jsonify(status="error", message="Paciente no encontrado o acceso no autorizado."), 404
+    return jsonify(status="success", groups=group_by_study_area(captures), next_cursor=next_cursor)
 
 
 @app.route('/update_history/<string:firestore_patient_id>', methods=['POST'])
@@ -384,9 +747,12 @@ def update_history(firestore_patient_id):
         }
         
         patient_updates['history'] = history_updates
+        patient_updates['updated_at'] = firestore.SERVER_TIMESTAMP
         
         patient_ref = db_firestore.collection('patients').document(firestore_patient_id)
         patient_ref.update(patient_updates)
+        local_cache.update_patient(firestore_patient_id, patient_updates)
+        report_cache.invalidate_patient(firestore_patient_id)
         
         return redirect(url_for('patient_detail', firestore_patient_id=firestore_patient_id))
     except Exception as e:
@@ -424,66 +790,48 @@ def save_analysis(firestore_patient_id):
 @app.route('/generate_report/<string:report_id>')
 @login_required
 def generate_report(report_id):
+    quality = request.args.get('quality', report_images.DEFAULT_QUALITY)
+    if quality not in report_images.QUALITY_PRESETS:
+        return f"Calidad no válida. Opciones: {', '.join(report_images.QUALITY_PRESETS)}.", 400
     try:
         report_ref = db_firestore.collection('reports').document(report_id)
-        report_data = report_ref.get().to_dict()
+        with metrics.span('firestore', 'get'):
+            report_data = report_ref.get().to_dict()
 
         if not report_data or report_data.get('team_id') != session['user']['team_id']:
             return "Reporte no encontrado o acceso no autorizado.", 404
 
         patient_id = report_data.get('patient_id')
         patient_ref = db_firestore.collection('patients').document(patient_id)
-        patient_data = patient_ref.get().to_dict()
-        
-        pdf = PDF()
-        pdf.add_page()
-        
-        pdf.chapter_title('Datos del Paciente')
-        pdf.chapter_body('Nombre:', f"{patient_data.get('nombre', '')} {patient_data.get('apellido', '')}")
-        pdf.chapter_body('Cédula:', patient_data.get('cedula', 'N/A'))
-        fecha_informe = report_data.get('analysis_date')
-        if fecha_informe:
-            pdf.chapter_body('Fecha del Informe:', fecha_informe.strftime('%d-%m-%Y'))
-        
-        pdf.ln(10)
-        
-        extremidad_str = ', '.join(report_data.get('extremidad', []))
-        hallazgos_str = ', '.join(report_data.get('hallazgos', []))
-        observaciones_str = report_data.get('conclusiones', '')
-
-        pdf.chapter_title('Resultados del Estudio')
-        pdf.chapter_body('Extremidad:', extremidad_str if extremidad_str else ' ')
-        pdf.chapter_body('Hallazgos:', hallazgos_str if hallazgos_str else ' ')
-        pdf.chapter_body('Observaciones:', observaciones_str if observaciones_str else ' ')
-        
+        with metrics.span('firestore', 'get'):
+            patient_data = patient_ref.get().to_dict()
+
+        # Una sola lectura en lote para todas las capturas del informe.
         selected_captures_ids = report_data.get('selected_captures', [])
+        captures_by_id = {}
         if selected_captures_ids:
-            pdf.add_page()
-            pdf.chapter_title('Imágenes Anexas')
-            
-            for capture_id in selected_captures_ids:
-                capture_ref = db_firestore.collection('captures').document(capture_id)
-                capture_data = capture_ref.get().to_dict()
-                if capture_data:
-                    image_url_to_use = capture_data.get('annotated_url', capture_data.get('cloud_url'))
-                    if image_url_to_use:
-                        response = requests.get(image_url_to_use)
-                        if response.status_code == 200:
-                            img_stream = io.BytesIO(response.content)
-                            pdf.image(img_stream, w=pdf.w - 20)
-                            pdf.set_font('Helvetica', 'I', 9)
-                            timestamp = capture_data.get('timestamp')
-                            if timestamp:
-                                pdf.cell(0, 10, f"Captura de {capture_data.get('study_area', '')} - {timestamp.strftime('%d-%m-%Y %H:%M')}", align='C', new_x=XPos.LMARGIN, new_y=YPos.NEXT)
-                            pdf.ln(5)
-
-        pdf_output = pdf.output()
-        return send_file(
+            capture_refs = [db_firestore.collection('captures').document(cid) for cid in selected_captures_ids]
+            with metrics.span('firestore', 'get_all'):
+                captures_by_id = {doc.id: doc.to_dict() for doc in db_firestore.get_all(capture_refs) if doc.exists}
+
+        # Si nada de lo que entra en el PDF cambió, se reutiliza el ya generado.
+        fingerprint = report_fingerprint(report_data, patient_data, captures_by_id, quality)
+        if request.if_none_match.contains(fingerprint):
+            return Response(status=304, headers={'ETag': f'"{fingerprint}"', 'Cache-Control': 'private, no-cache'})
+        pdf_output = report_cache.get(report_id, quality, fingerprint)
+        if pdf_output is None:
+            pdf_output = bytes(build_report_pdf(report_data, patient_data, captures_by_id, quality))
+            report_cache.put(report_id, quality, fingerprint, patient_id, selected_captures_ids, pdf_output)
+
+        response = send_file(
             io.BytesIO(pdf_output),
             as_attachment=True,
             download_name=f'informe_{patient_data.get("apellido", "")}_{report_id}.pdf',
-            mimetype='application/pdf'
+            mimetype='application/pdf',
+            etag=fingerprint
         )
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
 
     except Exception as e:
         print(f"Error al generar el PDF: {e}")
@@ -499,9 +847,13 @@ def capture():
         
     firestore_patient_id = request.args.get('firestore_patient_id')
     study_area = request.args.get('study_area', 'General')
+    # ?burst=K une K frames en una sola captura (menos ruido); sin él, un único frame.
+    burst_frames = request.args.get('burst', 1, type=int)
 
     if not firestore_patient_id:
         return jsonify(message="Error: ID de paciente no proporcionado."), 400
+    if burst_frames > 1 and not hasattr(camera, 'capture_burst'):
+        return jsonify(message="Error: Esta cámara no admite capturas en ráfaga."), 400
         
     try:
         team_id = session['user']['team_id']
@@ -509,28 +861,32 @@ def capture():
         timestamp_str = timestamp_obj.strftime("%Y-%m-%d_%H-%M-%S")
         destination_blob_name = f"pacientes/{firestore_patient_id}/{study_area.replace(' ', '_')}/{timestamp_str}.jpg"
         
-        temp_dir = 'temp_captures'
-        os.makedirs(temp_dir, exist_ok=True)
-        local_file_path = os.path.join(temp_dir, f"{timestamp_str}.jpg")
-        
-        frame_bytes = camera.capture_high_res()
-        
-        with open(local_file_path, 'wb') as f:
-            f.write(frame_bytes)
-        cloud_image_url = upload_to_storage(local_file_path, destination_blob_name)
-        os.remove(local_file_path)
+        if burst_frames > 1:
+            with metrics.span('camera', 'capture_burst'):
+                frame_bytes, capture_stats = camera.capture_burst(burst_frames)
+        else:
+            with metrics.span('camera', 'capture_still'):
+                frame_bytes, capture_stats = camera.capture_still()
         
-        if cloud_image_url:
-            capture_data = {
-                'patient_firestore_id': firestore_patient_id,
-                'cloud_url': cloud_image_url,
-                'storage_path': destination_blob_name,
-                'timestamp': timestamp_obj,
-                'team_id': team_id,
-                'study_area': study_area
-            }
-            sync_to_firestore('captures', capture_data)
-        return jsonify(message="¡Captura guardada y sincronizada!")
+        capture_data = {
+            'patient_firestore_id': firestore_patient_id,
+            'storage_path': destination_blob_name,
+            'timestamp': timestamp_obj,
+            'team_id': team_id,
+            'study_area': study_area
+        }
+        if 'burst' in capture_stats:
+            capture_data['burst'] = {'frames': capture_stats['burst']['frames'],
+                                     'used': len(capture_stats['burst']['used'])}
+        # La captura queda a salvo en disco; la subida y el documento de Firestore
+        # ('cloud_url' incluido) los completa la cola en segundo plano.
+        capture_id = upload_queue.enqueue(frame_bytes, destination_blob_name, 'captures', capture_data)
+        return jsonify(message="¡Captura guardada! Se sincronizará en segundo plano.",
+                       capture_id=capture_id,
+                       capture_mode=capture_stats['mode'],
+                       capture_ms=capture_stats['capture_ms'],
+                       stall_ms=capture_stats['stall_ms'],
+                       burst=capture_stats.get('burst'))
     except Exception as e:
         return jsonify(message=f"Error en la captura: {e}"), 500
 
@@ -541,27 +897,133 @@ def delete_patient(firestore_patient_id):
         return "Acceso denegado.", 403
     team_id = session['user']['team_id']
     patient_ref = db_firestore.collection('patients').document(firestore_patient_id)
-    patient_doc = patient_ref.get()
+    with metrics.span('firestore', 'get'):
+        patient_doc = patient_ref.get()
     if not patient_doc.exists or patient_doc.to_dict().get('team_id') != team_id:
         return "Paciente no encontrado o acceso no autorizado.", 404
-    try:
-        captures_query = db_firestore.collection('captures').where(filter=FieldFilter('patient_firestore_id', '==', firestore_patient_id)).stream()
-        for capture in captures_query:
-            capture_data = capture.to_dict()
-            if 'storage_path' in capture_data:
-                delete_from_storage(capture_data['storage_path'])
-            if 'annotated_url' in capture_data:
-                blob_name_annotated = '/'.join(capture_data['annotated_url'].split('?')[0].split('/')[-5:])
-                delete_from_storage(blob_name_annotated)
-            capture.reference.delete()
-        delete_from_firestore('patients', firestore_patient_id)
-        conn = get_db_connection()
-        conn.execute('DELETE FROM patients WHERE firestore_id = ?', (firestore_patient_id,))
-        conn.commit()
-        conn.close()
-        return redirect(url_for('dashboard'))
-    except Exception as e:
-        return "Ocurrió un error durante la eliminación.", 500
+    # El paciente desaparece de los listados en el acto; el resto se borra en segundo plano.
+    local_cache.delete_patient_captures(firestore_patient_id)
+    local_cache.delete_patient(firestore_patient_id)
+    report_cache.invalidate_patient(firestore_patient_id)
+    job = jobs.submit('delete_patient', team_id, delete_patient_cascade, firestore_patient_id)
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify({'job_id': job.id, 'status_url': url_for('job_status', job_id=job.id)}), 202
+    return redirect(url_for('dashboard'))
+
+# Campos con la URL de un blob propio de la captura (además de storage_path).
+CAPTURE_URL_FIELDS = (['annotated_url'] + list(derivatives.DERIVATIVE_FIELDS.values())
+                      + list(derivatives.ANNOTATED_DERIVATIVE_FIELDS.values()))
+
+def capture_blob_names(capture_data):
+    names = []
+    if capture_data.get('storage_path'):
+        names.append(capture_data['storage_path'])
+    for field in CAPTURE_URL_FIELDS:
+        if capture_data.get(field):
+            names.append(report_images.storage_path_from_url(capture_data[field]))
+    return names
+
+def purge_cached_images(capture_data):
+    """Quita de la caché local de imágenes la captura, su anotación y todas sus variantes."""
+    names = set(capture_blob_names(capture_data))
+    if capture_data.get('cloud_url'):
+        names.add(report_images.storage_path_from_url(capture_data['cloud_url']))
+    cache = report_images.get_cache()
+    for name in names:
+        cache.purge(name)
+
+def delete_blobs(blob_names, job=None):
+    """Borra blobs de Storage en paralelo. Un blob que ya no existe no es un error."""
+    def delete_one(blob_name):
+        try:
+            with metrics.span('storage', 'delete'):
+                bucket.blob(blob_name).delete()
+        except NotFound:
+            pass
+        if job:
+            job.update(advance=1)
+
+    with ThreadPoolExecutor(max_workers=STORAGE_DELETE_WORKERS) as executor:
+        # list() propaga la primera excepción que no sea NotFound.
+        list(executor.map(delete_one, blob_names))
+
+def delete_documents(refs, job=None):
+    """Borra documentos de Firestore en lotes de hasta FIRESTORE_BATCH_SIZE."""
+    for start in range(0, len(refs), FIRESTORE_BATCH_SIZE):
+        chunk = refs[start:start + FIRESTORE_BATCH_SIZE]
+        batch = db_firestore.batch()
+        for ref in chunk:
+            batch.delete(ref)
+        with metrics.span('firestore', 'batch_commit'):
+            batch.commit()
+        if job:
+            job.update(advance=len(chunk))
+
+def delete_patient_cascade(job, firestore_patient_id):
+    """Borra las imágenes, las capturas y por último el paciente.
+
+    El documento del paciente se borra al final: si el trabajo falla a medias,
+    puede relanzarse y encontrará las capturas que falten.
+    """
+    job.update(message="Buscando capturas")
+    with metrics.span('firestore', 'query'):
+        captures = list(db_firestore.collection('captures')
+                        .where(filter=FieldFilter('patient_firestore_id', '==', firestore_patient_id))
+                        .select(['storage_path', 'cloud_url'] + CAPTURE_URL_FIELDS)
+                        .stream())
+    blob_names = [name for capture in captures for name in capture_blob_names(capture.to_dict())]
+    for capture in captures:
+        purge_cached_images(capture.to_dict())
+    capture_refs = [capture.reference for capture in captures]
+    patient_ref = db_firestore.collection('patients').document(firestore_patient_id)
+    job.update(done=0, total=len(blob_names) + len(capture_refs) + 1)
+
+    job.update(message="Borrando imágenes")
+    delete_blobs(blob_names, job)
+    job.update(message="Borrando capturas")
+    delete_documents(capture_refs + [patient_ref], job)
+    job.update(message="Completado")
+    return {'captures': len(capture_refs), 'blobs': len(blob_names)}
+
+@app.route('/devices/heartbeat', methods=['POST'])
+def device_heartbeat():
+    """Latido de una Pi: se autentica con su clave (X-Device-Key), no con la sesión."""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not request.headers.get('X-Device-Key'):
+        return jsonify({"status": "error", "message": "Dispositivo o clave no válidos."}), 403
+    # El registro valida local_ip y capabilities: solo IP de la LAN y túneles configurados.
+    device = device_registry.heartbeat(
+        data.get('device_id', ''), request.headers.get('X-Device-Key'),
+        local_ip=data.get('local_ip'), status=data.get('status', 'idle'), capabilities=data.get('capabilities'))
+    if device is None:
+        return jsonify({"status": "error", "message": "Dispositivo o clave no válidos."}), 403
+    return jsonify({"status": "success", "interval": device_registry.offline_after // 3})
+
+@app.route('/devices', methods=['GET', 'POST'])
+@login_required
+def devices_list():
+    team_id = session['user']['team_id']
+    if request.method == 'POST':
+        if session['user']['role'] != 'doctor':
+            return jsonify({"status": "error", "message": "Acceso denegado."}), 403
+        name = (request.get_json(silent=True) or {}).get('name') or request.form.get('name') or 'Linfofluoroscopio'
+        device_id, key = device_registry.register(team_id, name)
+        # La clave solo se muestra ahora: en Firestore se guarda su hash.
+        return jsonify({"status": "success", "device_id": device_id, "device_key": key}), 201
+    device_registry.watch_team(team_id)
+    return jsonify({'devices': [
+        {'device_id': d['device_id'], 'name': d.get('name'), 'status': d.get('status'),
+         'local_ip': d.get('local_ip'), 'capabilities': d.get('capabilities', {})}
+        for d in device_registry.online_devices(team_id)
+    ]})
+
+@app.route('/jobs/<string:job_id>')
+@login_required
+def job_status(job_id):
+    job = jobs.get(job_id, team_id=session['user']['team_id'])
+    if job is None:
+        return jsonify({'error': 'Trabajo no encontrado'}), 404
+    return jsonify(job.to_dict())
 
 @app.route('/delete_capture/<string:firestore_capture_id>', methods=['POST'])
 @login_required
@@ -571,80 +1033,348 @@ def delete_capture(firestore_capture_id):
     team_id = session['user']['team_id']
     try:
         capture_ref = db_firestore.collection('captures').document(firestore_capture_id)
-        capture_doc = capture_ref.get()
+        with metrics.span('firestore', 'get'):
+            capture_doc = capture_ref.get()
         if not capture_doc.exists or capture_doc.to_dict().get('team_id') != team_id:
             return "Captura no encontrada o acceso no autorizado.", 404
         capture_data = capture_doc.to_dict()
         patient_id_to_redirect = capture_data.get('patient_firestore_id')
-        if 'storage_path' in capture_data:
-            delete_from_storage(capture_data['storage_path'])
-        if 'annotated_url' in capture_data:
-            blob_name_annotated = '/'.join(capture_data['annotated_url'].split('?')[0].split('/')[-5:])
-            delete_from_storage(blob_name_annotated)
-            
+        for blob_name in capture_blob_names(capture_data):
+            delete_from_storage(blob_name)
+        purge_cached_images(capture_data)
+
         delete_from_firestore('captures', firestore_capture_id)
-        conn = get_db_connection()
-        conn.execute('DELETE FROM captures WHERE firestore_id = ?', (firestore_capture_id,))
-        conn.commit()
-        conn.close()
+        report_cache.invalidate_capture(firestore_capture_id)
+        local_cache.delete_capture(firestore_capture_id)
         return redirect(url_for('patient_detail', firestore_patient_id=patient_id_to_redirect))
     except Exception as e:
         return "Ocurrió un error durante la eliminación.", 500
 
+def stream_hints():
+    """Preferencias del cliente para el stream: ?w=<ancho>&fps=<fps>&q=<calidad>&adapt=0."""
+    return {'width': request.args.get('w', type=int),
+            'fps': request.args.get('fps', type=int),
+            'quality': request.args.get('q', type=int),
+            'adaptive': request.args.get('adapt', '1') != '0'}
+
 @app.route('/video_feed')
 @login_required
 def video_feed():
     if not camera_available:
         return "Cámara no disponible en este servidor.", 503
-    def gen(camera_instance):
-        while True:
-            frame = camera_instance.get_frame()
-            yield (b'--frame\r\n'
-                   b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
-    return Response(gen(camera), mimetype='multipart/x-mixed-replace; boundary=frame')
+    return Response(adaptive_stream.stream(**stream_hints()), mimetype=MJPEG_MIMETYPE)
 
-@app.route('/save_annotation/<string:capture_id>', methods=['POST'])
+def study_device():
+    """Dispositivo del estudio en curso: el elegido en start_study, si sigue conectado."""
+    team_id = session['user']['team_id']
+    device_registry.watch_team(team_id)
+    return device_registry.pick_device(team_id, request.args.get('device_id') or session.get('device_id'))
+
+@app.route('/stream/video_feed')
 @login_required
-def save_annotation(capture_id):
+def stream_video_feed():
+    # Si la app corre en la propia Pi, no hay nada que reenviar.
+    if camera_available:
+        return Response(adaptive_stream.stream(**stream_hints()), mimetype=MJPEG_MIMETYPE)
+    device = study_device()
+    if device is None:
+        return "No hay ningún dispositivo conectado.", 503
+    return Response(relay.stream(device['device_id'], **stream_hints()), mimetype=MJPEG_MIMETYPE)
+
+@app.route('/stream/capture')
+@login_required
+def stream_capture():
+    if camera_available:
+        return capture()
     if session['user']['role'] != 'doctor':
-        return jsonify(status="error", message="Acceso denegado."), 403
+        return jsonify(message="Error: Solo los doctores pueden realizar capturas."), 403
+    return forward_to_study_device('/capture')
 
+def forward_to_study_device(path):
+    """Reenvía la petición actual (parámetros y formulario) a la Pi del estudio."""
+    device = study_device()
+    if device is None:
+        return jsonify(message="Error: No hay ningún dispositivo conectado."), 503
     try:
-        data = request.json
-        image_data_url = data.get('imageData')
-        annotation_data = data.get('annotationData')
+        result = relay.forward(device['device_id'], path, session['user'],
+                               params=request.values.to_dict(flat=False), method=request.method)
+    except requests.RequestException as e:
+        return jsonify(message=f"Error: No se pudo contactar con el dispositivo ({e})."), 502
+    if result is None:
+        return jsonify(message="Error: El dispositivo no tiene una dirección conocida."), 503
+    status_code, payload = result
+    # Al navegador solo vuelve un objeto JSON, nunca el cuerpo tal cual llegó de la Pi.
+    if payload is None or not 200 <= status_code < 600 or 300 <= status_code < 400:
+        return jsonify(message="Error: El dispositivo respondió algo inesperado."), 502
+    return jsonify(payload), status_code
+
+# --- SECUENCIAS DE ICG ---
+# El doctor guarda los últimos segundos de la vista previa o graba a intervalo fijo; se sube
+# un único .npz con las curvas tiempo-intensidad (colección 'sequences') en vez de un JPEG por frame.
+def sequence_request():
+    """Paciente, zona y regiones de interés de la petición. Retorna (datos, mensaje_de_error)."""
+    if not camera_available:
+        return None, ("Error: La grabación de secuencias no está disponible en el servidor.", 400)
+    if session['user']['role'] != 'doctor':
+        return None, ("Error: Solo los doctores pueden grabar secuencias.", 403)
+    firestore_patient_id = request.values.get('firestore_patient_id')
+    if not firestore_patient_id:
+        return None, ("Error: ID de paciente no proporcionado.", 400)
+    rois = None
+    if request.values.get('rois'):
+        try:
+            rois = json.loads(request.values['rois'])
+        except ValueError:
+            rois = None
+        if not isinstance(rois, list):
+            return None, ("Error: Las regiones de interés deben ser una lista JSON.", 400)
+    return {'patient_firestore_id': firestore_patient_id,
+            'study_area': request.values.get('study_area', 'General'),
+            'team_id': session['user']['team_id'],
+            'rois': rois}, None
 
-        if not image_data_url:
-            return jsonify(status="error", message="No se proporcionaron datos de imagen."), 400
+def store_sequence(seq, meta):
+    """Calcula las curvas de la secuencia y encola el .npz. Retorna el ID del documento."""
+    try:
+        with metrics.span('sequence', 'build_artifact'):
+            data, summary = sequence.build_artifact(seq, meta['rois'])
+        timestamp_obj = datetime.now()
+        timestamp_str = timestamp_obj.strftime("%Y-%m-%d_%H-%M-%S")
+        destination_blob_name = (f"pacientes/{meta['patient_firestore_id']}/"
+                                 f"{meta['study_area'].replace(' ', '_')}/secuencias/{timestamp_str}.npz")
+        sequence_data = dict(summary,
+                             patient_firestore_id=meta['patient_firestore_id'],
+                             team_id=meta['team_id'],
+                             study_area=meta['study_area'],
+                             storage_path=destination_blob_name,
+                             timestamp=timestamp_obj)
+        return upload_queue.enqueue(data, destination_blob_name, 'sequences', sequence_data,
+                                    content_type='application/octet-stream')
+    finally:
+        # El .npz ya está en el spool de subidas: los frames del disco sobran.
+        seq.discard()
+
+@app.route('/sequence/save', methods=['POST'])
+@login_required
+def sequence_save():
+    meta, error = sequence_request()
+    if error:
+        return jsonify(message=error[0]), error[1]
+    seconds = min(request.values.get('seconds', sequence.BUFFER_SECONDS, type=float), sequence.BUFFER_SECONDS)
+    seq = sequence_recorder.save_last(seconds)
+    if seq is None:
+        return jsonify(message="Error: El búfer está vacío; la vista previa debe estar abierta."), 409
+    frame_count, duration = seq.count, seq.duration
+    try:
+        sequence_id = store_sequence(seq, meta)
+    except Exception as e:
+        return jsonify(message=f"Error al guardar la secuencia: {e}"), 500
+    return jsonify(message=f"¡Secuencia de {duration:.0f} s guardada! Se sincronizará en segundo plano.",
+                   sequence_id=sequence_id, frame_count=frame_count, duration=round(duration, 2))
 
-        team_id = session['user']['team_id']
-        capture_ref = db_firestore.collection('captures').document(capture_id)
-        capture_doc = capture_ref.get()
+@app.route('/sequence/start', methods=['POST'])
+@login_required
+def sequence_start():
+    meta, error = sequence_request()
+    if error:
+        return jsonify(message=error[0]), error[1]
+    interval = request.values.get('interval', 1.0, type=float)
+    duration = request.values.get('duration', 60.0, type=float)
+    if interval <= 0 or duration <= 0:
+        return jsonify(message="Error: El intervalo y la duración deben ser positivos."), 400
+    try:
+        status = sequence_recorder.start_recording(interval, duration, lambda seq: store_sequence(seq, meta))
+    except Exception as e:
+        return jsonify(message=f"Error al iniciar la grabación: {e}"), 500
+    if status is None:
+        return jsonify(message="Error: Ya hay una grabación en curso."), 409
+    return jsonify(message="Grabando secuencia...", recording=status)
 
-        if not capture_doc.exists or capture_doc.to_dict().get('team_id') != team_id:
-            return jsonify(status="error", message="Captura no encontrada o sin autorización."), 404
+@app.route('/sequence/stop', methods=['POST'])
+@login_required
+def sequence_stop():
+    if not camera_available:
+        return jsonify(message="Error: La grabación de secuencias no está disponible en el servidor."), 400
+    if session['user']['role'] != 'doctor':
+        return jsonify(message="Error: Solo los doctores pueden grabar secuencias."), 403
+    status = sequence_recorder.stop_recording()
+    if status is None:
+        return jsonify(message="Error: No hay ninguna grabación en curso."), 409
+    if status['error']:
+        return jsonify(message=f"Error al guardar la secuencia: {status['error']}", recording=status), 500
+    return jsonify(message="¡Secuencia guardada! Se sincronizará en segundo plano.",
+                   sequence_id=status['result'], recording=status)
+
+@app.route('/sequence/status')
+@login_required
+def sequence_status():
+    if not camera_available:
+        return jsonify(message="Error: La grabación de secuencias no está disponible en el servidor."), 400
+    return jsonify(sequence_recorder.status())
 
-        patient_id = capture_doc.to_dict().get('patient_firestore_id')
+SEQUENCE_VIEWS = {'save': sequence_save, 'start': sequence_start, 'stop': sequence_stop, 'status': sequence_status}
 
+@app.route('/stream/sequence/<string:action>', methods=['GET', 'POST'])
+@login_required
+def stream_sequence(action):
+    if action not in SEQUENCE_VIEWS:
+        return jsonify(message="Error: Acción desconocida."), 404
+    if camera_available:
+        return SEQUENCE_VIEWS[action]()
+    if action != 'status' and session['user']['role'] != 'doctor':
+        return jsonify(message="Error: Solo los doctores pueden grabar secuencias."), 403
+    return forward_to_study_device(f'/sequence/{action}')
+
+# --- ANOTACIONES ---
+# 'raster' sube la imagen anotada a Storage en cada guardado; 'vector' guarda solo el
+# JSON de Fabric.js y el servidor compone la imagen cuando la necesita (informes, galería).
+ANNOTATION_STORAGE_MODE = os.environ.get('LINFO_ANNOTATION_STORAGE', 'raster')
+
+def read_annotation_json():
+    """Solo el JSON de la anotación (modo vectorial), venga en multipart o en JSON."""
+    if request.mimetype == 'multipart/form-data':
+        annotation_json = request.form.get('annotationData') or None
+    else:
+        data = request.get_json(silent=True) or {}
+        annotation_json = json.dumps(data['annotationData']) if data.get('annotationData') else None
+    if annotation_json is None:
+        raise ValueError("No se proporcionaron datos de anotación.")
+    json.loads(annotation_json)
+    return annotation_json
+
+# Formatos aceptados para la imagen anotada y su extensión en Storage.
+ANNOTATION_IMAGE_TYPES = {'image/png': 'png', 'image/webp': 'webp', 'image/jpeg': 'jpg'}
+# Storage sube por trozos (subida reanudable); deben ser múltiplos de 256 KB.
+ANNOTATION_CHUNK_SIZE = 1024 * 1024
+
+def store_annotated_derivatives(annotated_blob):
+    """Sube las miniaturas de la imagen anotada ya guardada en 'annotated_blob'; retorna
+    sus campos para el documento.
+
+    Se generan a partir de la copia de Storage: el cuerpo de la petición se consumió
+    al subirla. Si no se pueden generar, la galería usa las de la captura original.
+    """
+    storage_path = annotated_blob.name
+    try:
+        with metrics.span('storage', 'download'):
+            image_data = annotated_blob.download_as_bytes()
+        images = derivatives.make_derivatives(image_data)
+    except Exception as e:
+        print(f"Error al generar las miniaturas de la anotación {storage_path}: {e}")
+        return {}
+    update_data = {}
+    for size_name, data in images.items():
+        blob = bucket.blob(derivatives.derivative_path(storage_path, size_name))
+        with metrics.span('storage', 'upload'):
+            blob.upload_from_string(data, content_type=derivatives.CONTENT_TYPE)
+            blob.make_public()
+        update_data[derivatives.ANNOTATED_DERIVATIVE_FIELDS[size_name]] = blob.public_url
+    return update_data
+
+def read_annotation_upload():
+    """Retorna (stream, content_type, annotation_json) de la petición de save_annotation.
+
+    Acepta tres formatos:
+    - multipart/form-data con el archivo 'image' y el campo JSON 'annotationData';
+    - el cuerpo image/* en crudo, con annotationData (JSON codificado como URL)
+      en la cabecera X-Annotation-Data;
+    - el JSON antiguo con la imagen como data URL en base64.
+    Lanza ValueError si falta la imagen o los datos no son válidos.
+    """
+    mimetype = request.mimetype
+    if mimetype == 'multipart/form-data':
+        image = request.files.get('image')
+        if image is None:
+            raise ValueError("No se proporcionaron datos de imagen.")
+        annotation_json = request.form.get('annotationData') or None
+        stream, content_type = image.stream, image.mimetype
+    elif mimetype in ANNOTATION_IMAGE_TYPES:
+        if not request.content_length:
+            raise ValueError("No se proporcionaron datos de imagen.")
+        annotation_json = unquote(request.headers.get('X-Annotation-Data', '')) or None
+        stream, content_type = request.stream, mimetype
+    elif mimetype.startswith('image/'):
+        raise ValueError(f"Formato de imagen no admitido: {mimetype}")
+    else:
+        data = request.get_json(silent=True) or {}
+        image_data_url = data.get('imageData')
+        if not image_data_url:
+            raise ValueError("No se proporcionaron datos de imagen.")
         header, encoded = image_data_url.split(",", 1)
-        decoded_image = base64.b64decode(encoded)
+        content_type = header.split(':', 1)[-1].split(';', 1)[0] or 'image/png'
+        annotation_json = json.dumps(data['annotationData']) if data.get('annotationData') else None
+        stream = io.BytesIO(base64.b64decode(encoded))
 
-        timestamp_str = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-        destination_blob_name = f"pacientes/{patient_id}/anotaciones/annotated_{capture_id}_{timestamp_str}.png"
+    if content_type not in ANNOTATION_IMAGE_TYPES:
+        raise ValueError(f"Formato de imagen no admitido: {content_type}")
+    if annotation_json is not None:
+        json.loads(annotation_json)  # Solo se valida; se guarda tal cual llega.
+    return stream, content_type, annotation_json
 
-        blob = bucket.blob(destination_blob_name)
-        blob.upload_from_string(decoded_image, content_type='image/png')
-        blob.make_public()
-        new_annotated_url = blob.public_url
+@app.route('/save_annotation/<string:capture_id>', methods=['POST'])
+@login_required
+def save_annotation(capture_id):
+    if session['user']['role'] != 'doctor':
+        return jsonify(status="error", message="Acceso denegado."), 403
 
-        update_data = {
-            'annotated_url': new_annotated_url,
-            'last_annotated_at': firestore.SERVER_TIMESTAMP
-        }
-        if annotation_data:
-            update_data['annotation_data'] = json.dumps(annotation_data)
+    try:
+        team_id = session['user']['team_id']
+        capture_ref = db_firestore.collection('captures').document(capture_id)
+        with metrics.span('firestore', 'get'):
+            capture_doc = capture_ref.get()
 
-        capture_ref.update(update_data)
+        if not capture_doc.exists or capture_doc.to_dict().get('team_id') != team_id:
+            return jsonify(status="error", message="Captura no encontrada o sin autorización."), 404
+
+        capture_data = capture_doc.to_dict()
+        previous_annotated_fields = ['annotated_url'] + list(derivatives.ANNOTATED_DERIVATIVE_FIELDS.values())
+        previous_annotated_urls = {field: capture_data.get(field) for field in previous_annotated_fields}
+        update_data = {'last_annotated_at': firestore.SERVER_TIMESTAMP}
+
+        if ANNOTATION_STORAGE_MODE == 'vector':
+            try:
+                annotation_json = read_annotation_json()
+            except ValueError as e:
+                return jsonify(status="error", message=str(e)), 400
+            for field in previous_annotated_fields:
+                update_data[field] = firestore.DELETE_FIELD
+        else:
+            try:
+                stream, content_type, annotation_json = read_annotation_upload()
+            except (ValueError, binascii.Error) as e:
+                return jsonify(status="error", message=str(e)), 400
+
+            patient_id = capture_data.get('patient_firestore_id')
+            timestamp_str = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+            extension = ANNOTATION_IMAGE_TYPES[content_type]
+            destination_blob_name = f"pacientes/{patient_id}/anotaciones/annotated_{capture_id}_{timestamp_str}.{extension}"
+
+            # El cuerpo va de la petición a Storage por trozos, sin copiarlo antes; las
+            # miniaturas se hacen después a partir del blob guardado.
+            blob = bucket.blob(destination_blob_name)
+            blob.chunk_size = ANNOTATION_CHUNK_SIZE
+            with metrics.span('storage', 'upload'):
+                blob.upload_from_file(stream, content_type=content_type)
+                blob.make_public()
+            update_data['annotated_url'] = blob.public_url
+            update_data.update(store_annotated_derivatives(blob))
+            for field in derivatives.ANNOTATED_DERIVATIVE_FIELDS.values():
+                update_data.setdefault(field, firestore.DELETE_FIELD)
+
+        if annotation_json:
+            update_data['annotation_data'] = annotation_json
+            update_data['annotation_hash'] = annotation_render.annotation_hash(annotation_json)
+
+        with metrics.span('firestore', 'update'):
+            capture_ref.update(update_data)
+        local_cache.update_capture(capture_id, update_data)
+        report_cache.invalidate_capture(capture_id)
+
+        # La imagen anotada anterior y sus miniaturas ya no las referencia nadie.
+        for field, previous_url in previous_annotated_urls.items():
+            if previous_url and previous_url != update_data.get(field):
+                delete_from_storage(report_images.storage_path_from_url(previous_url))
+                report_images.get_cache().purge(report_images.storage_path_from_url(previous_url))
 
         return jsonify(status="success", message="Anotación guardada con éxito.")
 
@@ -652,6 +1382,419 @@ def save_annotation(capture_id):
         print(f"Error al guardar la anotación: {e}")
         return jsonify(status="error", message=f"Ocurrió un error en el servidor: {e}"), 500
 
+@app.route('/captures/<string:capture_id>/annotation')
+@login_required
+def capture_annotation(capture_id):
+    """JSON de Fabric de la anotación de una captura, para abrirla en el editor."""
+    team_id = session['user']['team_id']
+    capture_data = local_cache.get_capture(capture_id) if local_cache_ready(team_id) else None
+    if capture_data is None and db_firestore:
+        with metrics.span('firestore', 'get'):
+            capture_doc = db_firestore.collection('captures').document(capture_id).get(
+                field_paths=['team_id', 'annotation_data'])
+        capture_data = capture_doc.to_dict() if capture_doc.exists else None
+    if not capture_data or capture_data.get('team_id') != team_id:
+        return jsonify(status="error", message="Captura no encontrada o acceso no autorizado."), 404
+    return jsonify(status="success", annotation_data=capture_data.get('annotation_data') or '')
+
+@app.route('/captures/<string:capture_id>/annotated')
+@login_required
+def annotated_capture(capture_id):
+    """Captura con su anotación vectorial compuesta en el servidor (cacheada por huella)."""
+    team_id = session['user']['team_id']
+    capture_data = local_cache.get_capture(capture_id) if local_cache_ready(team_id) else None
+    if capture_data is None and db_firestore:
+        with metrics.span('firestore', 'get'):
+            capture_doc = db_firestore.collection('captures').document(capture_id).get()
+        capture_data = capture_doc.to_dict() if capture_doc.exists else None
+    if not capture_data or capture_data.get('team_id') != team_id:
+        return "Captura no encontrada o acceso no autorizado.", 404
+
+    image_url, annotation_json = capture_image_source(capture_data)
+    if not annotation_json:
+        return redirect(image_url)
+    # ?size=small|medium sirve la miniatura de la galería en lugar de la resolución completa.
+    size = request.args.get('size')
+    max_side = derivatives.SIZES.get(size)
+    etag = f"{capture_data['annotation_hash']}-{size}" if max_side else capture_data['annotation_hash']
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers={'ETag': f'"{etag}"', 'Cache-Control': 'private, no-cache'})
+    try:
+        image_bytes = report_images.fetch_annotated_image(image_url, annotation_json, max_side=max_side)
+    except Exception as e:
+        print(f"Error al componer la anotación: {e}")
+        return redirect(image_url)
+    response = send_file(io.BytesIO(image_bytes), mimetype='image/jpeg', etag=etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+# Una anotación recién subida aún no figura en su captura (se sube antes de guardar la URL):
+# las más recientes que esto no se consideran huérfanas.
+ANNOTATION_GC_GRACE = timedelta(hours=1)
+
+def collect_annotation_garbage(job, team_id):
+    """Borra de Storage las imágenes anotadas que ninguna captura del equipo referencia."""
+    job.update(message="Buscando anotaciones en uso")
+    cutoff = datetime.now(timezone.utc) - ANNOTATION_GC_GRACE
+    captures = (db_firestore.collection('captures')
+                .where(filter=FieldFilter('team_id', '==', team_id))
+                .select(['annotated_url', 'patient_firestore_id'] + list(derivatives.ANNOTATED_DERIVATIVE_FIELDS.values()))
+                .stream())
+    referenced = set()
+    patient_ids = set()
+    for capture in captures:
+        capture_data = capture.to_dict()
+        patient_ids.add(capture_data.get('patient_firestore_id'))
+        for field in ['annotated_url'] + list(derivatives.ANNOTATED_DERIVATIVE_FIELDS.values()):
+            if capture_data.get(field):
+                referenced.add(report_images.storage_path_from_url(capture_data[field]))
+
+    orphans = []
+    for patient_id in filter(None, patient_ids):
+        for blob in bucket.list_blobs(prefix=f"pacientes/{patient_id}/anotaciones/"):
+            if blob.name not in referenced and blob.time_created and blob.time_created < cutoff:
+                orphans.append(blob.name)
+    job.update(done=0, total=len(orphans), message="Borrando anotaciones obsoletas")
+    delete_blobs(orphans, job)
+    job.update(message="Completado")
+    return {'deleted': len(orphans)}
+
+@app.route('/annotations/gc', methods=['POST'])
+@login_required
+def annotations_gc():
+    if session['user']['role'] != 'doctor':
+        return jsonify(status="error", message="Acceso denegado."), 403
+    team_id = session['user']['team_id']
+    job = jobs.submit('gc_annotations', team_id, collect_annotation_garbage, team_id)
+    return jsonify({'job_id': job.id, 'status_url': url_for('job_status', job_id=job.id)}), 202
+
+# --- MINIATURAS (BACKFILL) ---
+DERIVATIVE_WORKERS = max(1, (os.cpu_count() or 2) - 1)
+
+def store_derivatives(capture_id, storage_path, images):
+    """Sube las miniaturas generadas y anota sus URL en el documento de la captura."""
+    update_data = {}
+    for size_name, data in images.items():
+        blob = bucket.blob(derivatives.derivative_path(storage_path, size_name))
+        with metrics.span('storage', 'upload'):
+            blob.upload_from_string(data, content_type=derivatives.CONTENT_TYPE)
+            blob.make_public()
+        update_data[derivatives.DERIVATIVE_FIELDS[size_name]] = blob.public_url
+    with metrics.span('firestore', 'update'):
+        db_firestore.collection('captures').document(capture_id).update(update_data)
+    local_cache.update_capture(capture_id, update_data)
+
+def process_captures(job, pending, worker, store, workers, label):
+    """Procesa 'pending' [(capture_id, datos)] en un pool de procesos.
+
+    'worker(capture_id, cloud_url)' corre en el pool y retorna (capture_id, resultado);
+    'store(capture_id, datos, resultado)' guarda el resultado en este proceso. Nunca
+    hay más de 2 * workers capturas en vuelo. Retorna cuántas fallaron.
+    """
+    failed = 0
+    remaining = iter(pending)
+    with ProcessPoolExecutor(max_workers=workers, initializer=derivatives.init_worker) as executor:
+        def submit_next():
+            item = next(remaining, None)
+            if item:
+                capture_id, capture_data = item
+                futures[executor.submit(worker, capture_id, capture_data['cloud_url'])] = capture_data
+
+        futures = {}
+        for _ in range(workers * 2):
+            submit_next()
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                capture_data = futures.pop(future)
+                try:
+                    capture_id, result = future.result()
+                    store(capture_id, capture_data, result)
+                except Exception as e:
+                    failed += 1
+                    print(f"Error al {label} {capture_data.get('storage_path')}: {e}")
+                job.update(advance=1)
+                submit_next()
+    return failed
+
+def backfill_derivatives(job, team_id, workers=DERIVATIVE_WORKERS):
+    """Genera las miniaturas de las capturas que no las tienen.
+
+    Es reanudable: cada captura terminada queda anotada en su documento, así que
+    relanzar el trabajo solo procesa las pendientes. Las imágenes se decodifican
+    en un pool de procesos (ver process_captures).
+    """
+    job.update(message="Buscando capturas sin miniaturas")
+    fields = list(derivatives.DERIVATIVE_FIELDS.values())
+    captures = (db_firestore.collection('captures')
+                .where(filter=FieldFilter('team_id', '==', team_id))
+                .select(['cloud_url', 'storage_path'] + fields)
+                .stream())
+    pending = []
+    for capture in captures:
+        capture_data = capture.to_dict()
+        if capture_data.get('cloud_url') and capture_data.get('storage_path') \
+                and not all(capture_data.get(field) for field in fields):
+            pending.append((capture.id, capture_data))
+    job.update(done=0, total=len(pending), message="Generando miniaturas")
+
+    failed = process_captures(
+        job, pending, derivatives.backfill_capture,
+        lambda capture_id, capture_data, images: store_derivatives(capture_id, capture_data['storage_path'], images),
+        workers, "generar miniaturas de")
+    job.update(message="Completado")
+    return {'processed': len(pending) - failed, 'failed': failed}
+
+@app.route('/derivatives/backfill', methods=['POST'])
+@login_required
+def derivatives_backfill():
+    if session['user']['role'] != 'doctor':
+        return jsonify(status="error", message="Acceso denegado."), 403
+    team_id = session['user']['team_id']
+    job = jobs.submit('backfill_derivatives', team_id, backfill_derivatives, team_id)
+    return jsonify({'job_id': job.id, 'status_url': url_for('job_status', job_id=job.id)}), 202
+
+# --- CUANTIFICACIÓN DE FLUORESCENCIA ---
+def store_fluorescence(capture_id, analysis):
+    update_data = {'fluorescence': analysis}
+    with metrics.span('firestore', 'update'):
+        db_firestore.collection('captures').document(capture_id).update(update_data)
+    local_cache.update_capture(capture_id, update_data)
+
+def backfill_fluorescence(job, team_id, force=False, workers=DERIVATIVE_WORKERS):
+    """Analiza las capturas del equipo sin métricas o con una versión anterior del análisis.
+
+    Igual que las miniaturas: reanudable y en un pool de procesos. Con 'force'
+    se reprocesan todas.
+    """
+    job.update(message="Buscando capturas sin analizar")
+    captures = (db_firestore.collection('captures')
+                .where(filter=FieldFilter('team_id', '==', team_id))
+                .select(['cloud_url', 'storage_path', 'fluorescence.version'])
+                .stream())
+    pending = []
+    for capture in captures:
+        capture_data = capture.to_dict()
+        version = (capture_data.get('fluorescence') or {}).get('version')
+        if capture_data.get('cloud_url') and (force or version != fluorescence.ANALYSIS_VERSION):
+            pending.append((capture.id, capture_data))
+    job.update(done=0, total=len(pending), message="Analizando fluorescencia")
+
+    failed = process_captures(
+        job, pending, fluorescence.analyze_capture,
+        lambda capture_id, capture_data, analysis: store_fluorescence(capture_id, analysis),
+        workers, "analizar")
+    job.update(message="Completado")
+    return {'processed': len(pending) - failed, 'failed': failed}
+
+@app.route('/fluorescence/backfill', methods=['POST'])
+@login_required
+def fluorescence_backfill():
+    if session['user']['role'] != 'doctor':
+        return jsonify(status="error", message="Acceso denegado."), 403
+    team_id = session['user']['team_id']
+    force = request.values.get('force') == '1'
+    job = jobs.submit('backfill_fluorescence', team_id, backfill_fluorescence, team_id, force)
+    return jsonify({'job_id': job.id, 'status_url': url_for('job_status', job_id=job.id)}), 202
+
+# --- EXPORTACIÓN MASIVA DE INFORMES ---
+EXPORT_DIR = 'report_exports'
+EXPORT_WORKERS = DERIVATIVE_WORKERS
+EXPORT_CHUNK = 50  # Informes que se leen de Firestore de una vez, con sus pacientes y capturas
+EXPORT_KEEP_SECONDS = 3600  # Lo mismo que JobRegistry guarda el estado del trabajo
+# Solo los campos que usan build_report_pdf y report_fingerprint.
+REPORT_PATIENT_FIELDS = ['nombre', 'apellido', 'cedula', 'updated_at']
+REPORT_CAPTURE_FIELDS = ['cloud_url', 'annotated_url', 'annotation_data', 'annotation_hash', 'last_annotated_at',
+                         'timestamp', 'study_area']
+
+def export_path(job_id):
+    return os.path.join(EXPORT_DIR, f'{job_id}.zip')
+
+def purge_exports(max_age=EXPORT_KEEP_SECONDS):
+    """Borra los ZIP (y los directorios de trabajo que dejara un proceso caído) más antiguos que 'max_age'."""
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    now = time.time()
+    for entry in os.scandir(EXPORT_DIR):
+        if now - entry.stat().st_mtime < max_age:
+            continue
+        if entry.is_dir():
+            shutil.rmtree(entry.path, ignore_errors=True)
+        else:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+def list_report_ids(team_id, date_from=None, date_to=None, patient_id=None):
+    """Ids de los informes del equipo con analysis_date en [date_from, date_to), por fecha."""
+    query = db_firestore.collection('reports').where(filter=FieldFilter('team_id', '==', team_id))
+    if patient_id:
+        query = query.where(filter=FieldFilter('patient_id', '==', patient_id))
+    if date_from:
+        query = query.where(filter=FieldFilter('analysis_date', '>=', date_from))
+    if date_to:
+        query = query.where(filter=FieldFilter('analysis_date', '<', date_to))
+    query = query.order_by('analysis_date').select(['patient_id'])
+    with metrics.span('firestore', 'query'):
+        return [doc.id for doc in query.stream()]
+
+def iter_export_items(report_ids):
+    """(report_id, informe, paciente, capturas) de cada informe, leídos por lotes de EXPORT_CHUNK.
+
+    En memoria solo está el lote en curso. Un informe borrado mientras tanto sale con
+    informe None.
+    """
+    for start in range(0, len(report_ids), EXPORT_CHUNK):
+        chunk = report_ids[start:start + EXPORT_CHUNK]
+        report_refs = [db_firestore.collection('reports').document(report_id) for report_id in chunk]
+        with metrics.span('firestore', 'get_all'):
+            reports_by_id = {doc.id: doc.to_dict() for doc in db_firestore.get_all(report_refs) if doc.exists}
+        patient_ids = {data.get('patient_id') for data in reports_by_id.values() if data.get('patient_id')}
+        capture_ids = {cid for data in reports_by_id.values() for cid in data.get('selected_captures', [])}
+        patients_by_id = {}
+        if patient_ids:
+            patient_refs = [db_firestore.collection('patients').document(pid) for pid in patient_ids]
+            with metrics.span('firestore', 'get_all'):
+                patients_by_id = {doc.id: doc.to_dict() for doc in
+                                  db_firestore.get_all(patient_refs, field_paths=REPORT_PATIENT_FIELDS) if doc.exists}
+        captures_by_id = {}
+        if capture_ids:
+            capture_refs = [db_firestore.collection('captures').document(cid) for cid in capture_ids]
+            with metrics.span('firestore', 'get_all'):
+                captures_by_id = {doc.id: doc.to_dict() for doc in
+                                  db_firestore.get_all(capture_refs, field_paths=REPORT_CAPTURE_FIELDS) if doc.exists}
+        for report_id in chunk:
+            report_data = reports_by_id.get(report_id)
+            if report_data is None:
+                yield report_id, None, None, None
+                continue
+            report_captures = {cid: captures_by_id[cid] for cid in report_data.get('selected_captures', [])
+                               if cid in captures_by_id}
+            yield report_id, report_data, patients_by_id.get(report_data.get('patient_id')) or {}, report_captures
+
+def export_reports(job, team_id, quality, date_from=None, date_to=None, patient_id=None, workers=EXPORT_WORKERS):
+    """Exporta a un ZIP los PDF de los informes del equipo (de un rango de fechas o de un paciente, si se indican).
+
+    Los PDF que ya están en report_cache con la misma huella se copian tal cual; el
+    resto se arma en un pool de procesos (reports.render_report_file), con 2 * workers
+    informes en vuelo como mucho. Cada proceso escribe su PDF en disco; aquí se pasa
+    al ZIP y a report_cache y se borra, así que la memoria no crece con el número de
+    informes y la siguiente exportación (o descarga) ya lo encuentra hecho.
+    """
+    purge_exports()
+    job.update(message="Buscando informes")
+    report_ids = list_report_ids(team_id, date_from, date_to, patient_id)
+    job.update(done=0, total=len(report_ids), message="Generando informes")
+
+    spool_dir = tempfile.mkdtemp(prefix=f'{job.id}-', dir=EXPORT_DIR)
+    archive = reports.ExportArchive(export_path(job.id))
+    items = iter_export_items(report_ids)
+    counts = {'rendered': 0, 'from_cache': 0, 'failed': 0}
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=derivatives.init_worker) as executor:
+            def submit_next():
+                # Los informes borrados o ya cacheados no pasan por el pool: se sigue
+                # hasta encontrar uno que haya que armar.
+                for report_id, report_data, patient_data, captures_by_id in items:
+                    if report_data is None:
+                        job.update(advance=1)
+                        continue
+                    fingerprint = report_fingerprint(report_data, patient_data, captures_by_id, quality)
+                    pdf_output = report_cache.get(report_id, quality, fingerprint)
+                    if pdf_output is not None:
+                        archive.add(report_id, report_data, patient_data, pdf_bytes=pdf_output)
+                        counts['from_cache'] += 1
+                        job.update(advance=1)
+                        continue
+                    path = os.path.join(spool_dir, f'{report_id}.pdf')
+                    future = executor.submit(reports.render_report_file, report_id, report_data, patient_data,
+                                             captures_by_id, quality, path)
+                    futures[future] = (report_id, report_data, patient_data, fingerprint, path)
+                    return
+
+            futures = {}
+            for _ in range(workers * 2):
+                submit_next()
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    report_id, report_data, patient_data, fingerprint, path = futures.pop(future)
+                    pdf_output = None
+                    try:
+                        future.result()
+                        with open(path, 'rb') as f:
+                            pdf_output = f.read()
+                        archive.add(report_id, report_data, patient_data, pdf_bytes=pdf_output)
+                        counts['rendered'] += 1
+                    except Exception as e:
+                        counts['failed'] += 1
+                        print(f"Error al generar el informe {report_id}: {e}")
+                        archive.add(report_id, report_data, patient_data, error=str(e))
+                    finally:
+                        if os.path.exists(path):
+                            os.remove(path)
+                    if pdf_output is not None:
+                        try:
+                            report_cache.put(report_id, quality, fingerprint, report_data.get('patient_id'),
+                                             report_data.get('selected_captures', []), pdf_output)
+                        except Exception as e:
+                            print(f"Error al guardar el informe {report_id} en la caché: {e}")
+                    job.update(advance=1)
+                    submit_next()
+        archive.close()
+    except Exception:
+        archive.discard()
+        raise
+    finally:
+        shutil.rmtree(spool_dir, ignore_errors=True)
+    job.update(message="Completado")
+    return dict(counts, reports=len(report_ids), size=os.path.getsize(export_path(job.id)))
+
+def parse_export_date(value):
+    """'AAAA-MM-DD' -> datetime (UTC) al comienzo de ese día; None si viene vacío."""
+    if not value:
+        return None
+    return datetime.strptime(value, '%Y-%m-%d').replace(tzinfo=timezone.utc)
+
+@app.route('/reports/export', methods=['POST'])
+@login_required
+def reports_export():
+    """Lanza la exportación de informes. Parámetros: quality, from y to (AAAA-MM-DD, ambos
+    incluidos) y patient_id, todos opcionales."""
+    if session['user']['role'] != 'doctor':
+        return jsonify(status="error", message="Acceso denegado."), 403
+    quality = request.values.get('quality', report_images.DEFAULT_QUALITY)
+    if quality not in report_images.QUALITY_PRESETS:
+        return jsonify(status="error", message=f"Calidad no válida. Opciones: {', '.join(report_images.QUALITY_PRESETS)}."), 400
+    try:
+        date_from = parse_export_date(request.values.get('from'))
+        date_to = parse_export_date(request.values.get('to'))
+    except ValueError:
+        return jsonify(status="error", message="Las fechas deben tener el formato AAAA-MM-DD."), 400
+    if date_to:
+        date_to += timedelta(days=1)
+    team_id = session['user']['team_id']
+    job = jobs.submit('export_reports', team_id, export_reports, team_id, quality, date_from, date_to,
+                      request.values.get('patient_id') or None)
+    return jsonify({'job_id': job.id, 'status_url': url_for('job_status', job_id=job.id),
+                    'download_url': url_for('reports_export_download', job_id=job.id)}), 202
+
+@app.route('/reports/export/<string:job_id>/download')
+@login_required
+def reports_export_download(job_id):
+    """El ZIP de una exportación terminada, servido desde el disco por partes."""
+    job = jobs.get(job_id, team_id=session['user']['team_id'])
+    if job is None or job.kind != 'export_reports':
+        return jsonify(status="error", message="Exportación no encontrada."), 404
+    if job.status != 'completado':
+        return jsonify(status="error", message="La exportación todavía no ha terminado."), 409
+    path = export_path(job.id)
+    if not os.path.exists(path):
+        return jsonify(status="error", message="La exportación ya no está disponible."), 410
+    download_name = f"informes_{datetime.fromtimestamp(job.created_at).strftime('%Y-%m-%d_%H-%M')}.zip"
+    return send_file(path, as_attachment=True, download_name=download_name, mimetype='application/zip',
+                     max_age=0)
+
 if __name__ == '__main__':
     print("Iniciando servidor Flask...")
     app.run(host='0.0.0.0', port=5000, debug=True, use_reloader=False, threaded=True)
@@ -0,0 +1,229 @@
+# auth_cache.py (Verificación de ID tokens de Firebase con cachés de certificados, tokens y perfiles)
+#
+# El rol y el equipo vienen de los custom claims del token (los pone 'register' y
+# set_user_role.py); el perfil de Firestore solo se lee si faltan, y se cachea.
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+from google.auth import jwt
+
+import metrics
+
+GOOGLE_CERTS_URL = 'https://www.googleapis.com/robot/v1/metadata/x509/securetoken@system.gserviceaccount.com'
+CERT_CACHE_PATH = os.path.join('auth_cache', 'google_certs.json')
+DEFAULT_CERT_TTL = 3600  # Si Google no indica max-age
+CLOCK_SKEW = 60  # Segundos de tolerancia entre el reloj de la Pi y el de Google
+FORCED_REFRESH_INTERVAL = 60  # Como mucho una descarga forzada por 'kid' desconocido en este intervalo
+
+try:
+    import fcntl
+except ImportError:  # Windows: sin bloqueo entre procesos, cada uno descarga por su cuenta.
+    fcntl = None
+
+
+class AuthError(Exception):
+    """El token no es válido (firma, emisor, audiencia o caducidad)."""
+
+
+def fetch_google_certs():
+    """Descarga los certificados públicos de Firebase Auth. Retorna (certs, ttl)."""
+    with metrics.span('auth', 'fetch_certs'):
+        response = requests.get(GOOGLE_CERTS_URL, timeout=(5, 10))
+        response.raise_for_status()
+    match = re.search(r'max-age=(\d+)', response.headers.get('Cache-Control', ''))
+    return response.json(), int(match.group(1)) if match else DEFAULT_CERT_TTL
+
+
+class CertCache:
+    """Certificados de Google compartidos por todos los workers a través de un archivo.
+
+    El primer worker que encuentra el archivo caducado lo descarga (con un flock
+    para que los demás esperen en vez de descargarlo a la vez); el resto lo lee
+    del disco. 'fetcher' retorna (certs, ttl) y se puede sustituir en pruebas.
+    """
+
+    def __init__(self, path=CERT_CACHE_PATH, fetcher=fetch_google_certs, clock=time.time):
+        self.path = path
+        self.fetcher = fetcher
+        self.clock = clock
+        self._certs = None
+        self._expires_at = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    def _read_file(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            return data['certs'], data['expires_at']
+        except (OSError, ValueError, KeyError):
+            return None, 0
+
+    def _write_file(self, certs, expires_at):
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'certs': certs, 'expires_at': expires_at}, f)
+        os.replace(tmp_path, self.path)
+
+    def get(self, force_refresh=False):
+        """Retorna {kid: certificado PEM}."""
+        with self._lock:
+            now = self.clock()
+            if not force_refresh and self._certs and now < self._expires_at:
+                return self._certs
+            certs, expires_at = self._read_file()
+            if force_refresh or not certs or now >= expires_at:
+                certs, expires_at = self._refresh(force_refresh)
+            self._certs, self._expires_at = certs, expires_at
+            return certs
+
+    def _refresh(self, force_refresh):
+        lock_file = open(self.path + '.lock', 'w')
+        try:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            # Otro worker pudo descargarlos mientras esperábamos el lock.
+            certs, expires_at = self._read_file()
+            if not force_refresh and certs and self.clock() < expires_at:
+                return certs, expires_at
+            certs, ttl = self.fetcher()
+            expires_at = self.clock() + ttl
+            self._write_file(certs, expires_at)
+            return certs, expires_at
+        finally:
+            lock_file.close()  # Cerrar libera el flock
+
+
+class TokenVerifier:
+    """Verifica ID tokens de Firebase (RS256) sin llamar a Firebase en cada petición.
+
+    Equivale a auth.verify_id_token (sin comprobar revocación). Los tokens ya
+    verificados se recuerdan hasta que caducan, así que revalidar la sesión
+    con el mismo token solo cuesta un hash.
+    """
+
+    def __init__(self, project_id, cert_cache, clock=time.time, max_tokens=256,
+                 forced_refresh_interval=FORCED_REFRESH_INTERVAL):
+        self.project_id = project_id
+        self.issuer = f'https://securetoken.google.com/{project_id}'
+        self.cert_cache = cert_cache
+        self.clock = clock
+        self.max_tokens = max_tokens
+        self.forced_refresh_interval = forced_refresh_interval
+        self._verified = OrderedDict()
+        self._last_forced_refresh = None
+        self._lock = threading.Lock()
+
+    def verify(self, id_token):
+        """Retorna los claims del token o lanza AuthError."""
+        key = hashlib.sha256(id_token.encode('utf-8')).hexdigest()
+        now = self.clock()
+        with self._lock:
+            cached = self._verified.get(key)
+            if cached and cached['exp'] > now:
+                self._verified.move_to_end(key)
+                return cached
+        with metrics.span('auth', 'verify_id_token'):
+            claims = self._verify_signature(id_token)
+        self._check_claims(claims, now)
+        with self._lock:
+            self._verified[key] = claims
+            while len(self._verified) > self.max_tokens:
+                self._verified.popitem(last=False)
+        return claims
+
+    def _verify_signature(self, id_token):
+        try:
+            header = jwt.decode_header(id_token)
+        except ValueError as e:
+            raise AuthError(f"Token mal formado: {e}")
+        if header.get('alg') != 'RS256':
+            raise AuthError("Algoritmo de firma no admitido.")
+        certs = self.cert_cache.get()
+        if header.get('kid') not in certs:
+            # Google rota las claves: puede que el archivo aún no tenga la nueva. Como el 'kid'
+            # lo elige quien envía el token, se fuerza la descarga como mucho una vez por intervalo.
+            if not self._may_force_refresh():
+                raise AuthError("Clave de firma desconocida.")
+            certs = self.cert_cache.get(force_refresh=True)
+            if header.get('kid') not in certs:
+                raise AuthError("Clave de firma desconocida.")
+        try:
+            return jwt.decode(id_token, certs=certs, audience=self.project_id,
+                              clock_skew_in_seconds=CLOCK_SKEW)
+        except ValueError as e:
+            raise AuthError(f"Token no válido: {e}")
+
+    def _may_force_refresh(self):
+        now = self.clock()
+        with self._lock:
+            if self._last_forced_refresh is not None and now - self._last_forced_refresh < self.forced_refresh_interval:
+                return False
+            self._last_forced_refresh = now
+            return True
+
+    def _check_claims(self, claims, now):
+        if claims.get('iss') != self.issuer:
+            raise AuthError("Emisor del token no válido.")
+        if not claims.get('sub') or len(claims['sub']) > 128:
+            raise AuthError("El token no tiene un usuario válido.")
+        if claims.get('exp', 0) + CLOCK_SKEW < now:
+            raise AuthError("El token ha caducado.")
+        if claims.get('auth_time', 0) > now + CLOCK_SKEW:
+            raise AuthError("El token tiene una fecha de autenticación futura.")
+        claims['uid'] = claims['sub']
+
+
+class ProfileCache:
+    """Perfiles de 'users/<uid>' en memoria durante 'ttl' segundos."""
+
+    def __init__(self, firestore_client, ttl=300, clock=time.time):
+        self.firestore_client = firestore_client
+        self.ttl = ttl
+        self.clock = clock
+        self._profiles = {}
+        self._lock = threading.Lock()
+
+    def get(self, uid):
+        """Retorna el perfil, o None si el usuario no tiene perfil."""
+        now = self.clock()
+        with self._lock:
+            cached = self._profiles.get(uid)
+            if cached and cached[0] > now:
+                return cached[1]
+        with metrics.span('firestore', 'get'):
+            doc = self.firestore_client.collection('users').document(uid).get()
+        profile = doc.to_dict() if doc.exists else None
+        with self._lock:
+            self._profiles[uid] = (now + self.ttl, profile)
+        return profile
+
+    def invalidate(self, uid):
+        with self._lock:
+            self._profiles.pop(uid, None)
+
+
+def session_user(claims, profile_cache):
+    """Datos de session['user'] a partir de los claims verificados.
+
+    Solo se consulta el perfil (cacheado) si el token no trae 'role' y 'team_id',
+    p. ej. usuarios creados antes de que 'register' pusiera los claims.
+    Retorna None si el usuario no tiene perfil.
+    """
+    role, team_id = claims.get('role'), claims.get('team_id')
+    email = claims.get('email')
+    if not role or not team_id:
+        profile = profile_cache.get(claims['uid'])
+        if profile is None:
+            return None
+        role = role or profile.get('role')
+        team_id = team_id or profile.get('team_id')
+        email = email or profile.get('email')
+    return {'uid': claims['uid'], 'email': email, 'role': role, 'team_id': team_id}
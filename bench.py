@@ -0,0 +1,1011 @@
+# bench.py (Benchmarks que se ejecutan sin cámara, sobre fuentes sintéticas)
+#
+# Uso:
+#   python bench.py stream --clients 3 --seconds 5
+#   python bench.py search --patients 100000
+#   python bench.py auth --tokens 200
+#   python bench.py devices --devices 50
+#   python bench.py relay --clients 5 --seconds 5
+#   python bench.py adaptive --seconds 20
+#   python bench.py frame --frames 300
+#   python bench.py fluorescence --repeat 10
+#   python bench.py sequence --seconds 60
+#   python bench.py burst --frames 6 --noise 25
+#   python bench.py reports --reports 40 --workers 4
+
+import argparse
+import threading
+import time
+
+
+def bench_stream(args):
+    """Mide los fps que recibe cada cliente del stream con la cámara sintética."""
+    from camera_synthetic import Camera
+
+    camera = Camera(fps=args.fps)
+    received = [0] * args.clients
+    stop = threading.Event()
+
+    def client(index, delay):
+        for _ in camera.frames.stream():
+            received[index] += 1
+            if delay:
+                time.sleep(delay)
+            if stop.is_set():
+                break
+
+    threads = []
+    for i in range(args.clients):
+        # El último cliente simula una conexión lenta para comprobar que no frena al resto.
+        delay = args.slow_delay if i == args.clients - 1 and args.clients > 1 else 0
+        t = threading.Thread(target=client, args=(i, delay), daemon=True)
+        t.start()
+        threads.append(t)
+
+    written_before = camera.frames_written
+    time.sleep(args.seconds)
+    stop.set()
+    produced = camera.frames_written - written_before
+
+    print(f"Frames producidos: {produced} ({produced / args.seconds:.1f} fps)")
+    for i, count in enumerate(received):
+        tag = ' (lento)' if i == args.clients - 1 and args.clients > 1 else ''
+        print(f"Cliente {i}{tag}: {count} frames ({count / args.seconds:.1f} fps)")
+
+
+def bench_search(args):
+    """Mide la búsqueda FTS5 de pacientes sobre una réplica local sintética."""
+    import os
+    import random
+    import tempfile
+    from local_cache import LocalCache
+
+    nombres = ['José', 'María', 'Ángel', 'Lucía', 'Andrés', 'Sofía', 'Raúl', 'Inés', 'Martín', 'Elena']
+    apellidos = ['Pérez', 'Núñez', 'Gómez', 'Rodríguez', 'Fernández', 'López', 'Martínez', 'Sánchez',
+                 'Díaz', 'Álvarez', 'Romero', 'Suárez', 'Castillo', 'Ortega', 'Rubio', 'Marín']
+    random.seed(1)
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = LocalCache(os.path.join(tmp, 'bench.db'), None)
+        start = time.perf_counter()
+        conn = cache._connect()
+        for i in range(args.patients):
+            apellido = f"{random.choice(apellidos)} {random.choice(apellidos)}{i % 97}"
+            conn.execute('''
+                INSERT INTO patients (firestore_id, team_id, cedula, nombre, apellido, data)
+                VALUES (?, ?, ?, ?, ?, '{}')
+            ''', (f'p{i}', f'team{i % args.teams}', f'V-{10000000 + i}', random.choice(nombres), apellido))
+        conn.commit()
+        conn.close()
+        print(f"{args.patients} pacientes indexados en {time.perf_counter() - start:.1f} s")
+
+        for query in ['per', 'jose nu', 'gomez', 'V-10.050', '1000123', 'alv rom', 'sofia marin4']:
+            timings = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                results = cache.search_patients('team0', query)
+                timings.append((time.perf_counter() - start) * 1000)
+            timings.sort()
+            print(f"{query!r:>16}: {len(results):2d} resultados, mediana {timings[len(timings) // 2]:.2f} ms, "
+                  f"peor {timings[-1]:.2f} ms")
+
+
+def make_fake_issuer(project_id):
+    """Emisor de ID tokens firmado localmente, con el mismo formato que Firebase Auth.
+
+    Retorna (certs, sign): 'certs' es lo que publicaría Google ({kid: PEM}) y
+    sign(claims) firma un token RS256 con iss/aud/iat/exp de Firebase.
+    """
+    import datetime
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from cryptography.x509.oid import NameOID
+    from google.auth import crypt, jwt
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'fake-securetoken')])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (x509.CertificateBuilder().subject_name(name).issuer_name(name)
+            .public_key(key.public_key()).serial_number(1)
+            .not_valid_before(now - datetime.timedelta(days=1))
+            .not_valid_after(now + datetime.timedelta(days=1))
+            .sign(key, hashes.SHA256()))
+    kid = 'fake-kid'
+    certs = {kid: cert.public_bytes(serialization.Encoding.PEM).decode()}
+    private_pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                    serialization.NoEncryption())
+    signer = crypt.RSASigner.from_string(private_pem, key_id=kid)
+
+    def sign(claims):
+        issued = int(time.time())
+        payload = {'iss': f'https://securetoken.google.com/{project_id}', 'aud': project_id,
+                   'iat': issued, 'exp': issued + 3600, 'auth_time': issued}
+        payload.update(claims)
+        return jwt.encode(signer, payload).decode()
+
+    return certs, sign
+
+
+def bench_auth(args):
+    """Mide la verificación de ID tokens con un emisor falso y la caché de certificados en disco."""
+    import os
+    import tempfile
+    import auth_cache
+
+    project_id = 'linfo-bench'
+    certs, sign = make_fake_issuer(project_id)
+    fetches = []
+
+    def fetcher():
+        fetches.append(time.time())
+        time.sleep(args.fetch_latency)  # Latencia simulada de googleapis.com
+        return certs, 3600
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'google_certs.json')
+        tokens = [sign({'sub': f'uid{i}', 'role': 'doctor', 'team_id': 't1'}) for i in range(args.tokens)]
+
+        # Varios "workers" (instancias independientes) comparten el archivo de certificados.
+        verifiers = [auth_cache.TokenVerifier(project_id, auth_cache.CertCache(path, fetcher))
+                     for _ in range(args.workers)]
+        start = time.perf_counter()
+        for verifier in verifiers:
+            verifier.verify(tokens[0])
+        print(f"{args.workers} workers en frío: {(time.perf_counter() - start) * 1000:.1f} ms, "
+              f"{len(fetches)} descarga(s) de certificados")
+
+        verifier = verifiers[0]
+        for label, batch in (('tokens nuevos', tokens[1:]), ('tokens ya verificados', tokens[1:])):
+            start = time.perf_counter()
+            for token in batch:
+                claims = verifier.verify(token)
+            elapsed = (time.perf_counter() - start) / len(batch) * 1e6
+            print(f"{label}: {elapsed:.0f} µs por token (rol '{claims['role']}')")
+
+        try:
+            verifier.verify(tokens[0][:-4] + 'AAAA')
+            print("ERROR: se aceptó un token con la firma alterada")
+        except auth_cache.AuthError as e:
+            print(f"Firma alterada rechazada: {e}")
+
+        # Tokens con un 'kid' inventado: solo el primero fuerza una descarga de certificados.
+        import base64
+        import json
+        header = base64.urlsafe_b64encode(json.dumps({'alg': 'RS256', 'kid': 'kid-inventado'}).encode())
+        forged = header.rstrip(b'=').decode() + tokens[0][tokens[0].index('.'):]
+        before, rejected = len(fetches), 0
+        for _ in range(20):
+            try:
+                verifier.verify(forged)
+            except auth_cache.AuthError:
+                rejected += 1
+        print(f"'kid' desconocido: {rejected}/20 rechazados, {len(fetches) - before} descarga(s) forzada(s)")
+
+
+def bench_devices(args):
+    """Simula Pi que envían latidos y mide la elección de dispositivo en start_study."""
+    import random
+    from devices import DeviceRegistry, HeartbeatClient, HEARTBEAT_INTERVAL
+
+    clock = [time.time()]
+    registry = DeviceRegistry(None, clock=lambda: clock[0])
+    random.seed(1)
+
+    def transport(payload, headers):
+        # Lo mismo que hace /devices/heartbeat con el cuerpo y la cabecera recibidos.
+        device = registry.heartbeat(payload['device_id'], headers.get('X-Device-Key'),
+                                    payload['local_ip'], payload['status'], payload['capabilities'])
+        return 200 if device else 403
+
+    clients = []
+    for i in range(args.devices):
+        team_id = f'team{i % args.teams}'
+        device_id, key = registry.register(team_id, f'Pi {i}')
+        status = random.choice(['idle', 'idle', 'busy'])
+        clients.append(HeartbeatClient(None, device_id, key, capabilities={'camera': 'synthetic'},
+                                       status_fn=lambda status=status: status, send=transport,
+                                       ip_fn=lambda i=i: f'192.168.1.{10 + i}'))
+    rejected = HeartbeatClient(None, clients[0].device_id, 'clave-incorrecta', send=transport).beat()
+    # Un latido con una dirección que no es de la LAN ni de un túnel configurado no se guarda.
+    spoofed = registry.heartbeat(clients[0].device_id, clients[0].key, '169.254.169.254', 'idle',
+                                 {'camera': 'synthetic', 'stream_url': 'http://169.254.169.254/', 'extra': 'x' * 4096})
+    print(f"Latido con IP de metadatos: local_ip={spoofed['local_ip']}, capabilities={spoofed['capabilities']}")
+
+    for client in clients:
+        client.beat()
+    # Pasa el tiempo y solo la mitad de las Pi siguen enviando latidos.
+    clock[0] += 2 * HEARTBEAT_INTERVAL
+    for client in clients[::2]:
+        client.beat()
+    clock[0] += 2 * HEARTBEAT_INTERVAL
+
+    online = sum(len(registry.online_devices(f'team{t}')) for t in range(args.teams))
+    print(f"{args.devices} dispositivos simulados, {online} conectados tras el corte "
+          f"(esperados {len(clients[::2])}); clave incorrecta -> HTTP {rejected}")
+
+    start = time.perf_counter()
+    for i in range(args.repeat):
+        device = registry.pick_device(f'team{i % args.teams}')
+    elapsed = (time.perf_counter() - start) / args.repeat * 1e6
+    print(f"pick_device: {elapsed:.1f} µs por llamada (último: {device['name']}, {device['status']}, "
+          f"{device['local_ip']})")
+
+
+def start_fake_device(fps, secret):
+    """Servidor MJPEG local que imita a una Pi: /video_feed a 'fps' y /capture.
+
+    Retorna (url_base, servidor, conexiones): 'conexiones' cuenta los streams abiertos.
+    """
+    import json
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from camera_synthetic import DEFAULT_FRAMES_DIR
+    import glob
+    import stream_relay
+    from streaming import MJPEG_MIMETYPE, mjpeg_part
+
+    jpegs = []
+    for path in sorted(glob.glob(f'{DEFAULT_FRAMES_DIR}/*.jpg')):
+        with open(path, 'rb') as f:
+            jpegs.append(f.read())
+    connections = [0]
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            user = stream_relay.verify_user(self.headers, secret)
+            if user is None:
+                self.send_response(401)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            if self.path.startswith('/video_feed'):
+                connections[0] += 1
+                self.send_response(200)
+                self.send_header('Content-Type', MJPEG_MIMETYPE)
+                self.send_header('Connection', 'close')
+                self.end_headers()
+                index, next_time = 0, time.monotonic()
+                try:
+                    while True:
+                        self.wfile.write(mjpeg_part(jpegs[index % len(jpegs)]))
+                        index += 1
+                        next_time += 1.0 / fps
+                        time.sleep(max(0, next_time - time.monotonic()))
+                except (BrokenPipeError, ConnectionResetError):
+                    return
+            body = json.dumps({'message': 'ok', 'uid': user['uid']}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}', server, connections
+
+
+def bench_relay(args):
+    """Relé de /stream/* contra una Pi falsa: conexiones, latencia, frames perdidos y capturas."""
+    import requests
+    import stream_relay
+    import streaming
+
+    secret = 'hash-de-la-clave'
+    base_url, server, connections = start_fake_device(args.fps, secret)
+    relay = stream_relay.StreamRelay(lambda device_id: (base_url, secret), linger=1)
+    received = [0] * args.clients
+    latencies = [[] for _ in range(args.clients)]
+    stop = threading.Event()
+
+    def client(index, delay):
+        for part in relay.stream('pi-bench', adaptive=False):
+            header = part[:200].split(b'X-Timestamp: ', 1)[1].split(b'\r\n', 1)[0]
+            latencies[index].append(time.time() - float(header))
+            received[index] += 1
+            if delay:
+                time.sleep(delay)
+            if stop.is_set():
+                break
+
+    threads = []
+    for i in range(args.clients):
+        # El último cliente simula una conexión lenta: debe saltarse frames, no frenar al resto.
+        delay = args.slow_delay if i == args.clients - 1 and args.clients > 1 else 0
+        t = threading.Thread(target=client, args=(i, delay), daemon=True)
+        t.start()
+        threads.append(t)
+    time.sleep(args.seconds)
+    stop.set()
+    for t in threads:
+        t.join(2)
+
+    dropped = streaming.FRAMES_DROPPED._values.get(('relay:pi-bench',), 0)
+    print(f"{args.clients} clientes, {connections[0]} conexión(es) con la Pi falsa a {args.fps} fps")
+    for i, count in enumerate(received):
+        tag = ' (lento)' if i == args.clients - 1 and args.clients > 1 else ''
+        samples = sorted(latencies[i]) or [0]
+        print(f"Cliente {i}{tag}: {count / args.seconds:.1f} fps, latencia mediana "
+              f"{samples[len(samples) // 2] * 1000:.1f} ms, peor {samples[-1] * 1000:.1f} ms")
+    print(f"Frames saltados por clientes lentos: {dropped:.0f}")
+
+    user = {'uid': 'u1', 'role': 'doctor', 'team_id': 't1'}
+    for label, forward in (
+            ('conexión nueva por captura', lambda: requests.get(
+                f'{base_url}/capture', headers=stream_relay.sign_user(user, secret), timeout=5)),
+            ('pool del relé', lambda: relay.forward('pi-bench', '/capture', user))):
+        forward()
+        start = time.perf_counter()
+        for _ in range(args.captures):
+            response = forward()
+        elapsed = (time.perf_counter() - start) / args.captures * 1000
+        status_code = response[0] if isinstance(response, tuple) else response.status_code
+        print(f"/stream/capture ({label}): {elapsed:.2f} ms por petición (HTTP {status_code})")
+    server.shutdown()
+
+
+def bench_adaptive(args):
+    """Niveles de calidad: clientes con pistas, con poco ancho de banda y compartiendo nivel."""
+    import io
+    from PIL import Image
+    from camera_synthetic import Camera
+    import streaming
+
+    camera = Camera(fps=args.fps)
+    levels = streaming.AdaptiveStream(camera.frames)
+    # (etiqueta, pistas, ancho de banda simulado en KB/s o None si es ilimitado)
+    clients = [('LAN sin pistas', {}, None),
+               ('LAN ?w=320&q=50 (1)', {'width': 320, 'quality': 50}, None),
+               ('LAN ?w=320&q=50 (2)', {'width': 320, 'quality': 50}, None),
+               ('LAN ?w=320&q=50 (3)', {'width': 320, 'quality': 50}, None),
+               (f'Wi-Fi {args.bandwidth} KB/s adaptativo', {}, args.bandwidth),
+               (f'Wi-Fi {args.bandwidth} KB/s fijo', {'adaptive': False}, args.bandwidth)]
+    stats = [{'frames': 0, 'bytes': 0, 'last': None} for _ in clients]
+    stop = threading.Event()
+
+    def client(index, hints, bandwidth):
+        for part in levels.stream(**hints):
+            stats[index]['frames'] += 1
+            stats[index]['bytes'] += len(part)
+            stats[index]['last'] = part
+            if bandwidth:
+                time.sleep(len(part) / (bandwidth * 1024))  # La escritura se bloquea al ritmo de la red
+            if stop.is_set():
+                break
+
+    for i, (_, hints, bandwidth) in enumerate(clients):
+        threading.Thread(target=client, args=(i, hints, bandwidth), daemon=True).start()
+    time.sleep(args.seconds / 2)
+    for entry in stats:  # Se mide la segunda mitad, con los niveles ya estabilizados
+        entry['frames'] = entry['bytes'] = 0
+    time.sleep(args.seconds / 2)
+    stop.set()
+
+    elapsed = args.seconds / 2
+    for (label, _, _), entry in zip(clients, stats):
+        jpeg = entry['last'].split(b'\r\n\r\n', 1)[1] if entry['last'] else None
+        size = Image.open(io.BytesIO(jpeg)).size if jpeg else None
+        print(f"{label:>28}: {entry['frames'] / elapsed:5.1f} fps, {entry['bytes'] / elapsed / 1024:7.1f} KB/s, "
+              f"último frame {size}")
+    published = streaming.FRAMES_PUBLISHED._values
+    for name, count in sorted((key[0], value) for key, value in published.items()):
+        if name != 'camera':
+            print(f"Nivel {name}: {count} frames codificados")
+    switches = streaming.LEVEL_SWITCHES._values
+    print("Cambios de nivel: " + ', '.join(f"{key[1]}={value}" for key, value in sorted(switches.items())))
+
+
+def bench_frame(args):
+    """Camino de un frame en camera.Camera con frames NumPy sintéticos: tiempo y memoria por frame."""
+    import statistics
+    import tracemalloc
+    import cv2
+    import numpy as np
+    from camera import FrameEncoder, JPEG_QUALITY, PREVIEW_SIZE
+
+    width, height = args.width or PREVIEW_SIZE[0], args.height or PREVIEW_SIZE[1]
+    rng = np.random.default_rng(1)
+    # Degradado con ruido: se comprime como una imagen real, no como un color plano.
+    gradient = np.linspace(0, 200, width, dtype=np.uint8)[None, :, None]
+    frames = [np.ascontiguousarray(np.broadcast_to(gradient, (height, width, 3))
+                                   + rng.integers(0, 40, (height, width, 3), dtype=np.uint8))
+              for _ in range(8)]
+    params = [int(cv2.IMWRITE_JPEG_QUALITY), JPEG_QUALITY]
+
+    def original(buffer):
+        frame = buffer.copy()  # capture_array() copia el buffer de la cámara
+        frame = cv2.flip(frame, -1)
+        ok, jpeg = cv2.imencode('.jpg', frame, params)
+        return jpeg.tobytes()
+
+    software_flip = FrameEncoder(flip=True)
+    sensor_flip = FrameEncoder(flip=False)
+    paths = [('capture_array + flip + tobytes (antes)', original),
+             ('MappedArray + flip en buffer', software_flip.encode),
+             ('MappedArray + Transform', sensor_flip.encode)]
+
+    for label, encode in paths:
+        for frame in frames:  # Calentamiento (y asignación de los buffers reutilizables)
+            encode(frame)
+        timings = []
+        for i in range(args.frames):
+            start = time.perf_counter()
+            encode(frames[i % len(frames)])
+            timings.append((time.perf_counter() - start) * 1e6)
+
+        tracemalloc.start()
+        peaks, retained = [], []
+        for i in range(args.frames):
+            before, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            result = encode(frames[i % len(frames)])
+            current, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - before)
+            retained.append(current - before)
+            del result
+        tracemalloc.stop()
+        print(f"{label:>40}: mediana {statistics.median(timings):7.0f} µs, "
+              f"pico {statistics.median(peaks) / 1024:6.0f} KB/frame, "
+              f"JPEG retenido {statistics.median(retained) / 1024:4.0f} KB")
+
+
+def synthetic_fluorescence_capture(width=4056, height=3040, seed=1):
+    """JPEG de una captura de fluorescencia sintética: dos canales lineales y dos manchas difusas."""
+    import io
+    import numpy as np
+    from PIL import Image, ImageDraw, ImageFilter
+
+    img = Image.new('L', (width, height), 15)
+    draw = ImageDraw.Draw(img)
+    draw.line([(width * 0.05, height * 0.92), (width * 0.44, height * 0.1)], fill=200, width=width // 160)
+    draw.line([(width * 0.22, height * 0.95), (width * 0.64, height * 0.07)], fill=180, width=width // 200)
+    draw.ellipse((width * 0.69, height * 0.59, width * 0.89, height * 0.86), fill=170)
+    draw.ellipse((width * 0.15, height * 0.1, width * 0.25, height * 0.23), fill=150)
+    img = img.filter(ImageFilter.GaussianBlur(6))
+    noise = np.random.default_rng(seed).integers(-8, 8, (height, width))
+    pixels = np.clip(np.asarray(img).astype(np.int16) + noise, 0, 255).astype(np.uint8)
+    output = io.BytesIO()
+    Image.fromarray(pixels).convert('RGB').save(output, format='JPEG', quality=90)
+    return output.getvalue()
+
+
+def bench_fluorescence(args):
+    """Tiempo del análisis de fluorescencia sobre una foto sintética a resolución completa."""
+    import statistics
+    import fluorescence
+
+    jpeg = synthetic_fluorescence_capture(args.width, args.height)
+    decode, analysis = [], []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        gray = fluorescence.decode_intensity(jpeg)
+        middle = time.perf_counter()
+        result = fluorescence.analyze_array(gray)
+        decode.append((middle - start) * 1000)
+        analysis.append((time.perf_counter() - middle) * 1000)
+    print(f"Captura {args.width}x{args.height} ({len(jpeg) // 1024} KB), analizada a {gray.shape[1]}x{gray.shape[0]}")
+    print(f"Decodificación: mediana {statistics.median(decode):.1f} ms; "
+          f"análisis: mediana {statistics.median(analysis):.1f} ms")
+    print(f"Umbral {result['threshold']}, área fluorescente {result['area_fraction'] * 100:.1f} %, "
+          f"reflujo dérmico {result['backflow_fraction'] * 100:.1f} % en {len(result['regions'])} regiones")
+
+
+def synthetic_icg_frames(count, width=320, height=240, fps=5, seed=1):
+    """Frames de luminancia de un bolo de ICG: los canales se llenan de abajo arriba y una
+    mancha de reflujo aparece más tarde. Retorna (frames, horas)."""
+    import numpy as np
+    from PIL import Image, ImageDraw, ImageFilter
+
+    channels = Image.new('L', (width, height), 0)
+    draw = ImageDraw.Draw(channels)
+    draw.line([(width * 0.05, height * 0.95), (width * 0.45, height * 0.05)], fill=255, width=6)
+    draw.line([(width * 0.25, height * 0.95), (width * 0.65, height * 0.05)], fill=255, width=4)
+    channels = np.asarray(channels.filter(ImageFilter.GaussianBlur(2)), dtype=np.float32) / 255
+    spot = Image.new('L', (width, height), 0)
+    ImageDraw.Draw(spot).ellipse((width * 0.7, height * 0.55, width * 0.9, height * 0.85), fill=255)
+    spot = np.asarray(spot.filter(ImageFilter.GaussianBlur(8)), dtype=np.float32) / 255
+    # El frente del contraste sube por los canales: cada fila tiene su propio retraso.
+    delay = (1 - np.linspace(0, 1, height, dtype=np.float32))[:, None] * 0.4
+    rng = np.random.default_rng(seed)
+    frames = np.empty((count, height, width), dtype=np.uint8)
+    times = np.arange(count) / fps
+    for index, t in enumerate(times / max(times[-1], 1e-6)):
+        front = np.clip((t - delay) * 4, 0, 1)
+        backflow = np.clip((t - 0.55) * 3, 0, 1)
+        value = 12 + 190 * channels * front + 140 * spot * backflow + rng.normal(0, 3, (height, width))
+        frames[index] = np.clip(value, 0, 255)
+    return frames, times + 1_700_000_000.0
+
+
+def bench_sequence(args):
+    """Búfer circular, volcado al disco y curvas tiempo-intensidad de una secuencia sintética."""
+    import io
+    import shutil
+    import statistics
+    import tempfile
+    import numpy as np
+    from PIL import Image
+    import sequence
+
+    count = int(args.seconds * sequence.SAMPLE_FPS)
+    frames, times = synthetic_icg_frames(count)
+    ring = sequence.FrameRing(count, frames.shape[1:])
+    pushes = []
+    for frame, timestamp in zip(frames, times):
+        start = time.perf_counter()
+        ring.push(frame, timestamp)
+        pushes.append((time.perf_counter() - start) * 1e6)
+    spool_dir = tempfile.mkdtemp(prefix='linfo_sequence_')
+    try:
+        start = time.perf_counter()
+        path, stack, spilled_times = ring.spill(times[0], spool_dir)
+        spill_ms = (time.perf_counter() - start) * 1000
+        seq = sequence.Sequence(path, stack, spilled_times, 'buffer', 1.0 / sequence.SAMPLE_FPS)
+        rois = [{'name': 'tobillo', 'rect': [0.0, 0.7, 0.4, 1.0]}, {'name': 'rodilla', 'rect': [0.3, 0.0, 0.7, 0.3]}]
+        start = time.perf_counter()
+        data, summary = sequence.build_artifact(seq, rois)
+        build_ms = (time.perf_counter() - start) * 1000
+
+        # Referencia: la media de cada región frame a frame, como haría un bucle en Python.
+        names, kinds, rects, masks, _ = sequence.regions_of_interest(stack.max(axis=0), rois)
+        start = time.perf_counter()
+        loop_curves = np.array([[frame[mask].mean() for mask in masks] for frame in stack])
+        loop_ms = (time.perf_counter() - start) * 1000
+        start = time.perf_counter()
+        curves = sequence.time_intensity_curves(stack, masks)
+        matmul_ms = (time.perf_counter() - start) * 1000
+        seq.discard()
+    finally:
+        shutil.rmtree(spool_dir, ignore_errors=True)
+
+    jpeg_bytes = 0
+    for frame in frames:
+        output = io.BytesIO()
+        Image.fromarray(frame).save(output, format='JPEG', quality=85)
+        jpeg_bytes += output.tell()
+
+    print(f"{count} frames de {frames.shape[2]}x{frames.shape[1]} ({args.seconds:.0f} s a {sequence.SAMPLE_FPS} fps), "
+          f"búfer de {ring.frames.nbytes / 1e6:.1f} MB")
+    print(f"push al búfer: mediana {statistics.median(pushes):.1f} µs; volcado al disco: {spill_ms:.1f} ms")
+    print(f"Curvas de {len(names)} regiones: bucle por frame {loop_ms:.1f} ms, matmul por bloques {matmul_ms:.1f} ms "
+          f"(diferencia máx. {np.abs(curves - loop_curves).max():.4f})")
+    print(f"Artefacto .npz: {len(data) / 1024:.0f} KB en {build_ms:.0f} ms "
+          f"(los mismos frames como JPEG: {jpeg_bytes / 1024:.0f} KB en {count} archivos)")
+    for roi in summary['rois']:
+        print(f"  {roi['name']:<14} pico {roi['peak']:>6} a los {roi['time_to_peak']:>6} s, "
+              f"llegada {roi['arrival']} s, pendiente máx. {roi['max_slope']}")
+
+
+def synthetic_burst(count, width, height, noise, max_shift, blurred, seed=1):
+    """Ráfaga RGB de una captura de fluorescencia sintética: cada frame desplazado al azar
+    (pulso del doctor), con ruido gaussiano y los 'blurred' primeros movidos.
+    Retorna (frames, escena_limpia, desplazamientos)."""
+    import io
+    import numpy as np
+    from PIL import Image, ImageFilter
+
+    jpeg = synthetic_fluorescence_capture(width + 2 * max_shift, height + 2 * max_shift, seed)
+    scene = Image.open(io.BytesIO(jpeg)).convert('L')
+    clean = np.asarray(scene, dtype=np.float32)
+    rng = np.random.default_rng(seed)
+    frames, shifts = [], []
+    for index in range(count):
+        dy, dx = (int(v) for v in rng.integers(-max_shift, max_shift + 1, 2))
+        shifts.append((dy, dx))
+        source = scene.filter(ImageFilter.BoxBlur(8)) if index < blurred else scene
+        view = np.asarray(source, dtype=np.float32)[max_shift + dy:max_shift + dy + height,
+                                                     max_shift + dx:max_shift + dx + width]
+        gray = np.clip(view + rng.normal(0, noise, view.shape).astype(np.float32), 0, 255).astype(np.uint8)
+        frames.append(np.repeat(gray[..., None], 3, axis=2))
+    return frames, clean, shifts
+
+
+def bench_burst(args):
+    """Selección por nitidez, alineado y promedio de una ráfaga sintética con ruido."""
+    import numpy as np
+    import burst
+
+    frames, clean, shifts = synthetic_burst(args.frames, args.width, args.height, args.noise, args.max_shift,
+                                            args.blurred)
+    start = time.perf_counter()
+    jpeg, info = burst.merge_to_jpeg(frames)
+    total_ms = (time.perf_counter() - start) * 1000
+
+    reference = info['reference']
+    ref_dy, ref_dx = shifts[reference]
+    target = clean[args.max_shift + ref_dy:args.max_shift + ref_dy + args.height,
+                   args.max_shift + ref_dx:args.max_shift + ref_dx + args.width]
+    merged, _ = burst.merge(frames)
+    inner = (slice(args.max_shift, -args.max_shift), slice(args.max_shift, -args.max_shift))
+    noise_single = np.std(frames[reference][..., 0][inner] - target[inner])
+    noise_merged = np.std(merged[..., 0][inner].astype(np.float32) - target[inner])
+    alignment_error = max(max(abs(info['shifts'][i][0] - (ref_dy - shifts[i][0])),
+                              abs(info['shifts'][i][1] - (ref_dx - shifts[i][1]))) for i in info['used'])
+
+    print(f"Ráfaga de {args.frames} frames {args.width}x{args.height} RGB, ruido σ={args.noise}, "
+          f"{args.blurred} movidos, desplazamiento hasta ±{args.max_shift} px")
+    print(f"Nitidez: {info['sharpness']} -> usados {info['used']} (referencia {reference})")
+    rejected = [i for i in range(args.blurred) if i not in info['used']]
+    print(f"Movidos descartados: {len(rejected)} de {args.blurred}; error máximo del alineado: {alignment_error} px")
+    print(f"Ruido frente a la escena limpia: un frame {noise_single:.1f}, promedio {noise_merged:.1f} "
+          f"(ideal {noise_single / np.sqrt(len(info['used'])):.1f})")
+    print(f"Tiempo: unir {info['merge_ms']:.0f} ms + JPEG {info['encode_ms']:.0f} ms = {total_ms:.0f} ms "
+          f"({len(jpeg) // 1024} KB)")
+
+
+def bench_reports(args):
+    """Exportación de informes: armado de los PDF en serie frente al pool de procesos, y ZIP."""
+    import datetime
+    import os
+    import random
+    import tempfile
+    from concurrent.futures import ProcessPoolExecutor
+    import derivatives
+    import report_images
+    import reports
+
+    jpeg = synthetic_fluorescence_capture(args.width, args.height)
+    rng = random.Random(1)
+    urls = [f'https://storage.googleapis.com/bench/pacientes/P/Brazo/{i}.jpg' for i in range(args.captures)]
+    captures = {str(i): {'cloud_url': url, 'study_area': 'Brazo', 'timestamp': datetime.datetime(2026, 9, 1)}
+                for i, url in enumerate(urls)}
+    jobs = []
+    for i in range(args.reports):
+        selected = rng.sample(sorted(captures), min(args.per_report, len(captures)))
+        report = {'analysis_date': datetime.datetime(2026, 9, 1), 'selected_captures': selected,
+                  'extremidad': ['Brazo Derecho'], 'hallazgos': ['Flujo Lento'], 'conclusiones': 'Sin cambios.'}
+        jobs.append((f'R{i:04d}', report, {'nombre': 'Paciente', 'apellido': f'Prueba{i}', 'cedula': str(i)},
+                     {cid: captures[cid] for cid in selected}))
+
+    def run(label, render):
+        # Cada pasada parte de una caché con solo los originales: las reducciones para
+        # el PDF se hacen una vez por imagen y las comparten todos los informes.
+        with tempfile.TemporaryDirectory() as tmp:
+            report_images._cache = report_images.ImageCache(os.path.join(tmp, 'cache'))
+            for url in urls:
+                report_images.get_cache().put(report_images.storage_path_from_url(url), jpeg)
+            archive = reports.ExportArchive(os.path.join(tmp, 'export.zip'))
+            start = time.perf_counter()
+            for report_id, report, patient, report_captures in jobs:
+                render(report_id, report, patient, report_captures, os.path.join(tmp, f'{report_id}.pdf'))
+            for report_id, report, patient, _ in jobs:
+                path = os.path.join(tmp, f'{report_id}.pdf')
+                archive.add(report_id, report, patient, pdf_path=path)
+                os.remove(path)
+            archive.close()
+            elapsed = time.perf_counter() - start
+            print(f"{label}: {elapsed:.2f} s ({args.reports / elapsed:.1f} informes/s), "
+                  f"ZIP de {os.path.getsize(archive.path) / 1e6:.1f} MB")
+
+    print(f"{args.reports} informes de {args.per_report} imágenes elegidas entre {args.captures} "
+          f"capturas {args.width}x{args.height} ({len(jpeg) // 1024} KB), calidad '{args.quality}'")
+    run("En serie", lambda *a: reports.render_report_file(*a[:4], args.quality, a[4]))
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=derivatives.init_worker) as executor:
+        pending = []
+
+        def render(*a):
+            # Se encolan todos y, con el último, se espera a que terminen antes de armar el ZIP.
+            pending.append(executor.submit(reports.render_report_file, *a[:4], args.quality, a[4]))
+            if len(pending) == len(jobs):
+                for future in pending:
+                    future.result()
+        run(f"Pool de {args.workers} procesos", render)
+
+
+class FakeBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.public_url = f'https://storage.googleapis.com/bench/{name}'
+
+    def upload_from_filename(self, path, content_type=None):
+        self.bucket.upload(self.name, path)
+
+    def upload_from_string(self, data, content_type=None):
+        pass
+
+    def make_public(self):
+        pass
+
+
+class FakeBucket:
+    """Bucket de Storage en memoria: cuenta las subidas por blob y falla 'failures' veces al principio."""
+
+    def __init__(self, latency, failures=0):
+        self.latency = latency
+        self.failures = failures
+        self.uploads = {}
+        self._lock = threading.Lock()
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+    def upload(self, name, path):
+        time.sleep(self.latency)
+        with self._lock:
+            if self.failures > 0:
+                self.failures -= 1
+                raise ConnectionError("Red no disponible (simulado)")
+            with open(path, 'rb') as f:
+                f.read()
+            self.uploads[name] = self.uploads.get(name, 0) + 1
+
+
+class FakeDocument:
+    def __init__(self, store, collection, document_id):
+        import uuid
+        self.store = store
+        self.collection = collection
+        self.id = document_id or uuid.uuid4().hex[:20]
+
+    def set(self, data, merge=False):
+        self.store.setdefault((self.collection, self.id), []).append(dict(data))
+
+
+class FakeFirestore:
+    """Lo mínimo de firestore.Client que usan UploadQueue y LocalCache.
+
+    collection(...).document(...).set(...) anota la escritura en 'writes';
+    collection(...).where(...).on_snapshot(callback) guarda el callback en 'listeners'
+    para que el bench entregue los snapshots a mano con snapshot().
+    """
+
+    def __init__(self):
+        self.writes = {}
+        self.listeners = {}
+
+    def collection(self, name):
+        firestore_client = self
+
+        class Query:
+            def on_snapshot(self, callback):
+                firestore_client.listeners.setdefault(name, []).append(callback)
+                return self
+
+        class Collection:
+            def document(self, document_id=None):
+                return FakeDocument(firestore_client.writes, name, document_id)
+
+            def where(self, filter=None):
+                return Query()
+        return Collection()
+
+    def snapshot(self, collection, docs, changes):
+        """Entrega a los listeners de 'collection' los documentos {id: datos} y los cambios [(tipo, id)]."""
+        from types import SimpleNamespace
+
+        def document(doc_id):
+            data = docs.get(doc_id, {})
+            return SimpleNamespace(id=doc_id, to_dict=lambda: dict(data))
+        snapshot_docs = [document(doc_id) for doc_id in docs]
+        snapshot_changes = [SimpleNamespace(type=SimpleNamespace(name=kind), document=document(doc_id))
+                            for kind, doc_id in changes]
+        for callback in self.listeners.get(collection, []):
+            callback(snapshot_docs, snapshot_changes, None)
+
+
+def bench_upload(args):
+    """Cola de subidas: dos procesos sobre la misma base de datos, fallos de red y spool perdido."""
+    import contextlib
+    import io
+    import os
+    import sqlite3
+    import tempfile
+    import upload_queue
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'spool.db')
+        spool_dir = os.path.join(tmp, 'spool')
+        bucket, firestore_client = FakeBucket(args.latency, failures=args.failures), FakeFirestore()
+
+        # Restos de una ejecución anterior: una fila huérfana y otra que otro proceso sube ahora.
+        upload_queue.UploadQueue(db_path, spool_dir, bucket, firestore_client)
+        conn = sqlite3.connect(db_path)
+        for destination, claimed_at in (('huerfana.jpg', time.time() - 2 * upload_queue.STALE_UPLOAD_AFTER),
+                                        ('en-curso.jpg', time.time())):
+            path = os.path.join(spool_dir, destination)
+            with open(path, 'wb') as f:
+                f.write(b'x')
+            conn.execute('''
+                INSERT INTO upload_spool (local_path, destination, collection, document_id, document_data,
+                                          url_field, status, claimed_at)
+                VALUES (?, ?, 'captures', ?, '{}', 'cloud_url', 'uploading', ?)
+            ''', (path, destination, destination.split('.')[0], claimed_at))
+        conn.commit()
+
+        # Dos "procesos" (dos colas) comparten la base de datos y el spool.
+        queues = [upload_queue.UploadQueue(db_path, spool_dir, bucket, firestore_client, workers=args.workers,
+                                           base_delay=0.05, max_delay=0.2) for _ in range(2)]
+        statuses = dict(conn.execute("SELECT destination, status FROM upload_spool").fetchall())
+        print(f"Al arrancar: huérfana -> {statuses['huerfana.jpg']}, en curso en otro proceso -> "
+              f"{statuses['en-curso.jpg']}")
+
+        payload = os.urandom(args.size * 1024)
+        log = io.StringIO()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(log):  # La cola imprime una línea por subida
+            ids = [queues[i % 2].enqueue(payload, f'pacientes/P/Brazo/{i}.jpg', 'captures', {'study_area': 'Brazo'})
+                   for i in range(args.jobs)]
+            os.remove(os.path.join(spool_dir, f"{ids[-1]}_{args.jobs - 1}.jpg"))
+            for queue in queues:
+                queue.start()
+            # El trabajo 'en curso' es de otro proceso que sigue vivo: no se espera por él.
+            deadline = time.time() + 60
+            while queues[0].pending_count() > 1 and time.time() < deadline:
+                time.sleep(0.02)
+        elapsed = time.perf_counter() - start
+
+        duplicates = sum(count - 1 for count in bucket.uploads.values())
+        rows = dict(conn.execute("SELECT status, COUNT(*) FROM upload_spool GROUP BY status").fetchall())
+        conn.close()
+        print(f"{args.jobs} capturas de {args.size} KB con 2 colas x {args.workers} hilos y {args.failures} "
+              f"fallos de red: {elapsed:.2f} s ({args.jobs / elapsed:.0f} subidas/s)")
+        print(f"Subidas: {sum(bucket.uploads.values())} ({duplicates} duplicadas), documentos escritos: "
+              f"{len(firestore_client.writes)}; filas que quedan: {rows}")
+        print(f"Reintentos registrados: {log.getvalue().count('Reintento en')}")
+
+
+def bench_replica(args):
+    """Réplica local de Firestore: primer snapshot, escrituras con SERVER_TIMESTAMP/DELETE_FIELD y borrados."""
+    import contextlib
+    import datetime
+    import io
+    import os
+    import tempfile
+    from google.cloud.firestore_v1.transforms import DELETE_FIELD, SERVER_TIMESTAMP
+    from local_cache import LocalCache
+
+    firestore_client = FakeFirestore()
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = LocalCache(os.path.join(tmp, 'bench.db'), firestore_client)
+        # Un paciente que se borró en Firestore mientras la app estaba apagada.
+        cache.upsert_patient('borrado', {'team_id': 'team0', 'apellido': 'Borrado', 'nombre': 'X'})
+        cache.watch_team('team0')
+        print(f"Antes del primer snapshot: lista={cache.is_ready('team0')}")
+
+        taken = datetime.datetime(2026, 9, 1, tzinfo=datetime.timezone.utc)
+        patients = {f'p{i}': {'team_id': 'team0', 'nombre': 'Paciente', 'apellido': f'Prueba{i:06d}',
+                              'cedula': f'V-{10000000 + i}', 'telefono': '0414-0000000'}
+                    for i in range(args.patients)}
+        captures = {f'c{i}': {'team_id': 'team0', 'patient_firestore_id': f'p{i % args.patients}',
+                              'timestamp': taken + datetime.timedelta(minutes=i), 'study_area': 'Brazo',
+                              'cloud_url': f'https://storage.googleapis.com/bench/{i}.jpg'}
+                    for i in range(args.patients * args.captures_per_patient)}
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):  # La réplica anuncia cuando queda lista
+            firestore_client.snapshot('patients', patients, [('ADDED', doc_id) for doc_id in patients])
+            firestore_client.snapshot('captures', captures, [('ADDED', doc_id) for doc_id in captures])
+        elapsed = time.perf_counter() - start
+        print(f"Primer snapshot de {len(patients)} pacientes y {len(captures)} capturas: {elapsed:.2f} s; "
+              f"lista={cache.is_ready('team0')}, paciente borrado podado={cache.get_patient('borrado') is None}")
+
+        # Escritura de la app (write-through) antes de que el listener traiga el valor del servidor.
+        cache.update_patient('p0', {'telefono': DELETE_FIELD, 'updated_at': SERVER_TIMESTAMP})
+        local = cache.get_patient('p0')
+        print(f"update_patient con DELETE_FIELD y SERVER_TIMESTAMP: telefono presente={'telefono' in local}, "
+              f"updated_at={type(local['updated_at']).__name__}")
+
+        server_time = datetime.datetime(2026, 9, 2, 12, 0, tzinfo=datetime.timezone.utc)
+        patients['p0'] = dict(patients['p0'], updated_at=server_time)
+        del patients['p0']['telefono']
+        firestore_client.snapshot('patients', patients, [('MODIFIED', 'p0')])
+        print(f"MODIFIED del servidor: updated_at={cache.get_patient('p0')['updated_at'].isoformat()}")
+
+        firestore_client.snapshot('patients', patients, [('REMOVED', 'p1')])
+        firestore_client.snapshot('captures', captures, [('REMOVED', 'c0')])
+        print(f"REMOVED: paciente p1 presente={cache.get_patient('p1') is not None}, "
+              f"captura c0 presente={cache.get_capture('c0') is not None}")
+
+        start = time.perf_counter()
+        for i in range(args.repeat):
+            doc_id = f'p{2 + i % (args.patients - 2)}'
+            patients[doc_id] = dict(patients[doc_id], edad=i)
+            firestore_client.snapshot('patients', {doc_id: patients[doc_id]}, [('MODIFIED', doc_id)])
+        elapsed = (time.perf_counter() - start) / args.repeat * 1000
+        print(f"Cambio incremental: {elapsed:.2f} ms por documento")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks del Linfofluoroscopio sin cámara.")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('stream', help="Difusión MJPEG a varios clientes")
+    p.add_argument('--clients', type=int, default=3)
+    p.add_argument('--seconds', type=float, default=5)
+    p.add_argument('--fps', type=int, default=30)
+    p.add_argument('--slow-delay', type=float, default=0.2)
+    p.set_defaults(func=bench_stream)
+
+    p = sub.add_parser('search', help="Búsqueda FTS5 de pacientes")
+    p.add_argument('--patients', type=int, default=100000)
+    p.add_argument('--teams', type=int, default=4)
+    p.add_argument('--repeat', type=int, default=20)
+    p.set_defaults(func=bench_search)
+
+    p = sub.add_parser('auth', help="Verificación de ID tokens con un emisor falso")
+    p.add_argument('--tokens', type=int, default=200)
+    p.add_argument('--workers', type=int, default=4)
+    p.add_argument('--fetch-latency', type=float, default=0.15)
+    p.set_defaults(func=bench_auth)
+
+    p = sub.add_parser('devices', help="Latidos de dispositivos simulados")
+    p.add_argument('--devices', type=int, default=50)
+    p.add_argument('--teams', type=int, default=5)
+    p.add_argument('--repeat', type=int, default=10000)
+    p.set_defaults(func=bench_devices)
+
+    p = sub.add_parser('relay', help="Relé de /stream/* contra una Pi falsa")
+    p.add_argument('--clients', type=int, default=5)
+    p.add_argument('--seconds', type=float, default=5)
+    p.add_argument('--fps', type=int, default=30)
+    p.add_argument('--slow-delay', type=float, default=0.2)
+    p.add_argument('--captures', type=int, default=200)
+    p.set_defaults(func=bench_relay)
+
+    p = sub.add_parser('adaptive', help="Niveles de calidad adaptativos del stream")
+    p.add_argument('--seconds', type=float, default=20)
+    p.add_argument('--fps', type=int, default=30)
+    p.add_argument('--bandwidth', type=int, default=300, help="KB/s del cliente con poco ancho de banda")
+    p.set_defaults(func=bench_adaptive)
+
+    p = sub.add_parser('frame', help="Memoria y tiempo por frame en camera.Camera")
+    p.add_argument('--frames', type=int, default=300)
+    p.add_argument('--width', type=int)
+    p.add_argument('--height', type=int)
+    p.set_defaults(func=bench_frame)
+
+    p = sub.add_parser('fluorescence', help="Análisis de fluorescencia de una captura completa")
+    p.add_argument('--repeat', type=int, default=10)
+    p.add_argument('--width', type=int, default=4056)
+    p.add_argument('--height', type=int, default=3040)
+    p.set_defaults(func=bench_fluorescence)
+
+    p = sub.add_parser('sequence', help="Búfer circular y curvas tiempo-intensidad de una secuencia ICG")
+    p.add_argument('--seconds', type=float, default=60)
+    p.set_defaults(func=bench_sequence)
+
+    p = sub.add_parser('burst', help="Captura en ráfaga: nitidez, alineado y promedio")
+    p.add_argument('--frames', type=int, default=6)
+    p.add_argument('--width', type=int, default=4056)
+    p.add_argument('--height', type=int, default=3040)
+    p.add_argument('--noise', type=float, default=25)
+    p.add_argument('--max-shift', type=int, default=24)
+    p.add_argument('--blurred', type=int, default=1)
+    p.set_defaults(func=bench_burst)
+
+    p = sub.add_parser('reports', help="Exportación de informes PDF en un pool de procesos")
+    p.add_argument('--reports', type=int, default=40)
+    p.add_argument('--captures', type=int, default=60)
+    p.add_argument('--per-report', type=int, default=3)
+    p.add_argument('--workers', type=int, default=4)
+    p.add_argument('--width', type=int, default=4056)
+    p.add_argument('--height', type=int, default=3040)
+    p.add_argument('--quality', default='media')
+    p.set_defaults(func=bench_reports)
+
+    p = sub.add_parser('replica', help="Réplica local con un Firestore falso en memoria")
+    p.add_argument('--patients', type=int, default=2000)
+    p.add_argument('--captures-per-patient', type=int, default=5)
+    p.add_argument('--repeat', type=int, default=500)
+    p.set_defaults(func=bench_replica)
+
+    p = sub.add_parser('upload', help="Cola de subidas contra un bucket y un Firestore falsos")
+    p.add_argument('--jobs', type=int, default=200)
+    p.add_argument('--size', type=int, default=200, help="KB por captura")
+    p.add_argument('--workers', type=int, default=3)
+    p.add_argument('--latency', type=float, default=0.01, help="Segundos por subida")
+    p.add_argument('--failures', type=int, default=5)
+    p.set_defaults(func=bench_upload)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+# burst.py (Captura en ráfaga: selección por nitidez, alineado y promedio de K frames)
+#
+# La fluorescencia es tenue y cada foto sale con mucho ruido del sensor. En una ráfaga:
+# - se descartan los frames movidos (varianza del laplaciano muy por debajo del más nítido);
+# - el resto se alinea con el más nítido por correlación de fase (FFT de una copia reducida);
+# - se promedian: el ruido baja con la raíz del número de frames y la señal no.
+# Todo son operaciones sobre arrays enteros (sin bucles por píxel); el resultado sigue siendo un único JPEG.
+
+import io
+import time
+
+import numpy as np
+from PIL import Image
+
+DEFAULT_FRAMES = 4
+MAX_FRAMES = 8  # 8 frames RGB de 12 MP son ~290 MB en la Pi
+SHARPNESS_RATIO = 0.7  # Se descartan los frames con menos nitidez que esta fracción del mejor
+ANALYSIS_SIZE = 1024  # Lado mayor de la copia reducida en la que se mide la nitidez y el desplazamiento
+MAX_SHIFT_FRACTION = 0.25  # Desplazamientos mayores (de la imagen) se consideran fallos del alineado
+SHARPNESS_BIN = 4  # La nitidez se mide a esta escala: el movimiento borra bordes de varios píxeles
+ALIGN_LOWPASS = 0.08  # Ciclos por píxel: por encima solo queda ruido, que desplazaría el pico
+JPEG_QUALITY = 92
+
+
+def bin_image(gray, factor):
+    """Reduce la imagen promediando bloques de factor x factor (el borde sobrante se descarta)."""
+    if factor == 1:
+        return gray
+    height, width = (gray.shape[0] // factor) * factor, (gray.shape[1] // factor) * factor
+    return gray[:height, :width].reshape(height // factor, factor, width // factor, factor).mean(axis=(1, 3))
+
+
+def analysis_image(frame, size=ANALYSIS_SIZE):
+    """Luminancia (float32) reducida a 'size' como mucho. Retorna (imagen, factor de reducción).
+
+    Promediar factor² píxeles también baja el ruido del sensor antes de medir nada. La
+    conversión y la reducción las hace PIL en C: con NumPy serían varias pasadas en
+    float32 sobre los 12 MP de cada frame.
+    """
+    factor = max(1, max(frame.shape[:2]) // size)
+    image = Image.fromarray(frame)
+    if image.mode != 'L':
+        image = image.convert('L')
+    if factor > 1:
+        image = image.reduce(factor)
+    return np.asarray(image, dtype=np.float32), factor
+
+
+def laplacian_variance(gray):
+    """Varianza del laplaciano (vecindad 4), con slices en lugar de una convolución."""
+    laplacian = gray[1:-1, :-2] + gray[1:-1, 2:] + gray[:-2, 1:-1] + gray[2:, 1:-1] - 4 * gray[1:-1, 1:-1]
+    return float(laplacian.var())
+
+
+def sharpness(gray, factor=SHARPNESS_BIN):
+    """Nitidez de una imagen de luminancia: varianza del laplaciano sin la parte del ruido.
+
+    Con la fluorescencia tenue el ruido del sensor domina el laplaciano y un frame movido
+    puntúa casi igual que uno nítido. Se mide sobre la imagen reducida 'factor' x 'factor'
+    y se resta el ruido, estimado con el laplaciano sin reducir: al promediar factor²
+    píxeles su varianza se divide por factor².
+    """
+    return max(0.0, laplacian_variance(bin_image(gray, factor)) - laplacian_variance(gray) / factor ** 2)
+
+
+def _window(shape):
+    return np.outer(np.hanning(shape[0]), np.hanning(shape[1])).astype(np.float32)
+
+
+def _lowpass(shape, cutoff=ALIGN_LOWPASS):
+    """Filtro gaussiano para el espectro de rfft2 de una imagen de tamaño 'shape'."""
+    fy = np.fft.fftfreq(shape[0])[:, None]
+    fx = np.fft.rfftfreq(shape[1])[None, :]
+    return np.exp(-(fx ** 2 + fy ** 2) / (2 * cutoff ** 2)).astype(np.float32)
+
+
+def _subpixel(before, peak, after):
+    """Vértice de la parábola que pasa por tres valores consecutivos (desde el central)."""
+    denominator = before - 2 * peak + after
+    return 0.0 if denominator == 0 else 0.5 * (before - after) / denominator
+
+
+def phase_shift(reference_spectrum, gray, window, lowpass):
+    """Desplazamiento (dy, dx), con fracciones de píxel, de 'gray' respecto a la referencia,
+    por correlación de fase.
+
+    'reference_spectrum' es la FFT (rfft2) de la referencia con la misma ventana. Con
+    frame[y + dy, x + dx] se obtiene el frame alineado con la referencia.
+    """
+    spectrum = np.fft.rfft2((gray - gray.mean()) * window)
+    cross = spectrum * np.conj(reference_spectrum)
+    # Se normaliza la magnitud (solo cuenta la fase) y se descartan las frecuencias de ruido.
+    cross *= lowpass / (np.abs(cross) + 1e-9)
+    correlation = np.fft.irfft2(cross, s=gray.shape)
+    rows, cols = correlation.shape
+    y, x = np.unravel_index(int(np.argmax(correlation)), correlation.shape)
+    dy = y + _subpixel(correlation[y - 1, x], correlation[y, x], correlation[(y + 1) % rows, x])
+    dx = x + _subpixel(correlation[y, x - 1], correlation[y, x], correlation[y, (x + 1) % cols])
+    # Los índices de la segunda mitad son desplazamientos negativos.
+    if dy > rows / 2:
+        dy -= rows
+    if dx > cols / 2:
+        dx -= cols
+    return float(dy), float(dx)
+
+
+def merge(frames, ratio=SHARPNESS_RATIO, size=ANALYSIS_SIZE):
+    """Selecciona, alinea y promedia los frames (uint8, alto x ancho [x canales]).
+
+    Retorna (imagen uint8, info) con la nitidez de cada frame, cuáles se usaron
+    y su desplazamiento respecto al más nítido.
+    """
+    analysis = [analysis_image(frame, size) for frame in frames]
+    grays = [gray for gray, _ in analysis]
+    factor = analysis[0][1]
+    scores = np.array([sharpness(gray) for gray in grays])
+    best = int(np.argmax(scores))
+    kept = [i for i in range(len(frames)) if scores[i] >= ratio * scores[best]]
+
+    window = _window(grays[best].shape)
+    lowpass = _lowpass(grays[best].shape)
+    reference_spectrum = np.fft.rfft2((grays[best] - grays[best].mean()) * window)
+    max_shift = MAX_SHIFT_FRACTION * min(grays[best].shape)
+    height, width = frames[best].shape[:2]
+    # Suma en uint16 (hasta 257 frames sin desbordar) y número de frames por píxel, que
+    # es menor en los bordes que un frame desplazado no cubre.
+    total = np.zeros(frames[best].shape, dtype=np.uint16)
+    count = np.zeros((height, width), dtype=np.uint8)
+    shifts = {}
+    for i in kept:
+        dy, dx = (0.0, 0.0) if i == best else phase_shift(reference_spectrum, grays[i], window, lowpass)
+        if abs(dy) > max_shift or abs(dx) > max_shift:
+            continue
+        # A resolución completa se desplaza un número entero de píxeles (sin interpolar).
+        dy, dx = int(round(dy * factor)), int(round(dx * factor))
+        shifts[i] = [dy, dx]
+        top, bottom = max(0, -dy), min(height, height - dy)
+        left, right = max(0, -dx), min(width, width - dx)
+        total[top:bottom, left:right] += frames[i][top + dy:bottom + dy, left + dx:right + dx]
+        count[top:bottom, left:right] += 1
+    # Casi todos los píxeles los cubren todos los frames: se divide por una constante
+    # (en float32, la división entera de NumPy es varias veces más lenta) y se corrigen
+    # solo los bordes que algún frame desplazado dejó sin cubrir.
+    used = len(shifts)
+    scaled = np.multiply(total, np.float32(1.0 / used), dtype=np.float32)
+    scaled += 0.5
+    merged = scaled.astype(np.uint8)
+    edge = count != used
+    if edge.any():
+        divisor = count[edge].astype(np.float32)
+        if total.ndim == 3:
+            divisor = divisor[:, None]
+        merged[edge] = (total[edge] / divisor + 0.5).astype(np.uint8)
+    info = {
+        'sharpness': [round(float(s), 1) for s in scores],
+        'reference': best,
+        'used': sorted(shifts),
+        'shifts': [shifts.get(i) for i in range(len(frames))],
+    }
+    return merged, info
+
+
+def encode_jpeg(image, quality=JPEG_QUALITY):
+    output = io.BytesIO()
+    Image.fromarray(image).save(output, format='JPEG', quality=quality)
+    return output.getvalue()
+
+
+def merge_to_jpeg(frames, quality=JPEG_QUALITY):
+    """Une la ráfaga en un JPEG. Retorna (jpeg, info) con el tiempo de cada paso."""
+    start = time.perf_counter()
+    merged, info = merge(frames)
+    middle = time.perf_counter()
+    jpeg = encode_jpeg(merged, quality)
+    info['merge_ms'] = round((middle - start) * 1000, 1)
+    info['encode_ms'] = round((time.perf_counter() - middle) * 1000, 1)
+    return jpeg, info
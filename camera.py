@@ -1,15 +1,71 @@
 # camera.py (Versión final y robusta con Lock)
+#
+# El frame no se copia entre la cámara y el JPEG: la orientación la corrige libcamera
+# (Transform) en el propio pipeline del sensor, el encoder lee directamente del buffer
+# de la cámara (MappedArray) y el JPEG sale como memoryview, sin .tobytes().
 import cv2
-from picamera2 import Picamera2
+import numpy as np
 import time
 import threading
 
+try:
+    from picamera2 import Picamera2, MappedArray
+except ImportError:  # Sin cámara (p. ej. 'python bench.py frame'): FrameEncoder sigue disponible.
+    Picamera2 = MappedArray = None
+
+try:
+    from libcamera import Transform
+except ImportError:
+    Transform = None
+
+PREVIEW_SIZE = (640, 480)
+JPEG_QUALITY = 80  # Los niveles más bajos para clientes lentos los genera streaming.AdaptiveStream
+
+class FrameEncoder:
+    """Codifica frames BGR a JPEG reutilizando los buffers entre un frame y el siguiente.
+
+    Con flip=True la rotación de 180° se hace en software, pero sobre un buffer
+    preasignado (cv2.flip con dst) en lugar de crear un array nuevo en cada frame.
+    No es seguro entre hilos: cada Camera usa el suyo bajo 'frame_lock'.
+    """
+
+    def __init__(self, quality=JPEG_QUALITY, flip=False):
+        self.params = [int(cv2.IMWRITE_JPEG_QUALITY), quality]
+        self.flip = flip
+        self._flipped = None
+
+    def encode(self, array):
+        """Retorna el JPEG como memoryview (sin copiar el buffer que produjo OpenCV)."""
+        if self.flip:
+            if self._flipped is None or self._flipped.shape != array.shape:
+                self._flipped = np.empty_like(array)
+            cv2.flip(array, -1, dst=self._flipped)
+            array = self._flipped
+        ok, jpeg = cv2.imencode('.jpg', array, self.params)
+        if not ok:
+            raise RuntimeError("No se pudo codificar el frame a JPEG.")
+        return jpeg.reshape(-1).data
+
 class Camera(object):
-    def __init__(self):
+    def __init__(self, quality=JPEG_QUALITY):
+        if Picamera2 is None:
+            raise RuntimeError("picamera2 no está instalado.")
         print("Inicializando cámara con picamera2...")
         self.picam2 = Picamera2()
-        config = self.picam2.create_preview_configuration(main={"size": (640, 480)})
-        self.picam2.configure(config)
+        # RGB888 de picamera2 es BGR en memoria, justo lo que espera OpenCV (sin canal X que descartar).
+        main = {"size": PREVIEW_SIZE, "format": "RGB888"}
+        software_flip = Transform is None
+        if not software_flip:
+            try:
+                # Corregimos la orientación en el sensor: el frame ya llega girado 180°.
+                config = self.picam2.create_preview_configuration(main=main, transform=Transform(hflip=1, vflip=1))
+                self.picam2.configure(config)
+            except Exception as e:
+                print(f"La cámara no admite Transform ({e}); se girará cada frame en software.")
+                software_flip = True
+        if software_flip:
+            self.picam2.configure(self.picam2.create_preview_configuration(main=main))
+        self.encoder = FrameEncoder(quality, flip=software_flip)
         self.frame_lock = threading.Lock()
         self.picam2.start()
         time.sleep(2)
@@ -22,9 +78,11 @@ class Camera(object):
 
     def get_frame(self):
         with self.frame_lock:
-            # Capturamos el frame solo cuando tengamos el "paso"
-            frame = self.picam2.capture_array()
-        
-        frame = cv2.flip(frame, -1) # Corregimos la orientación
-        ret, jpeg = cv2.imencode('.jpg', frame)
-        return jpeg.tobytes()
+            # El encoder lee el buffer de la cámara tal cual; hay que devolverlo
+            # (release) en cuanto se termina para que libcamera lo reutilice.
+            request = self.picam2.capture_request()
+            try:
+                with MappedArray(request, 'main') as mapped:
+                    return self.encoder.encode(mapped.array)
+            finally:
+                request.release()
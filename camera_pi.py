@@ -1,50 +1,277 @@
 # camera_pi.py (Versión optimizada para Raspberry Pi con libcamera)
 
 import io
+import os
+import threading
 import time
+from contextlib import contextmanager
 from picamera2 import Picamera2
 from picamera2.encoders import JpegEncoder
 from picamera2.outputs import FileOutput
 
+import burst
+from sequence import SequenceRecorder
+from streaming import FrameBroadcaster, LatestFrameOutput
+
+try:
+    # Encoder MJPEG por hardware (V4L2). No existe en todas las versiones/modelos.
+    from picamera2.encoders import MJPEGEncoder
+except ImportError:
+    MJPEGEncoder = None
+
+# Resolución del video en vivo. En la LAN puede subirse (LINFO_PREVIEW_SIZE=1280x960):
+# los clientes con peor conexión reciben niveles reducidos (ver streaming.AdaptiveStream).
+PREVIEW_SIZE = tuple(int(v) for v in os.environ.get('LINFO_PREVIEW_SIZE', '640x480').lower().split('x'))
+# Segundos que el encoder sigue en marcha tras irse el último cliente (p. ej. al recargar la página).
+ENCODER_IDLE_STOP = 5.0
+ENCODER_RESTART_DELAY = 1.0  # Segundos antes de reintentar la grabación si falló la vuelta al modo de video
+CAPTURE_SETTLE = 1.0  # Segundos de ajuste automático antes de una captura con la cámara parada
+
 class Camera:
-    def __init__(self):
+    def __init__(self, streaming=True, still_from_stream=False):
         self.picam2 = Picamera2()
-        # Configuración para el streaming de video (baja resolución para fluidez)
-        self.video_config = self.picam2.create_video_configuration(main={"size": (640, 480)})
+        # Con 'still_from_stream' se usa una configuración de doble stream: 'main' a
+        # resolución completa para las capturas y 'lores' para el video en vivo.
+        # Así una captura sale del stream en marcha, sin reconfigurar la cámara.
+        self.still_from_stream = streaming and still_from_stream
+        if self.still_from_stream:
+            self.video_config = self.picam2.create_video_configuration(
+                main={"size": self.picam2.sensor_resolution},
+                lores={"size": PREVIEW_SIZE},
+                encode="lores")
+            self.encode_stream = "lores"
+        else:
+            # Configuración para el streaming de video (baja resolución para fluidez)
+            self.video_config = self.picam2.create_video_configuration(main={"size": PREVIEW_SIZE})
+            self.encode_stream = "main"
         # Configuración para capturas de alta resolución
         self.still_config = self.picam2.create_still_configuration()
-        
+
+        # Serializa los cambios de modo: mientras dura uno nadie más toca la cámara.
+        self.mode_lock = threading.Lock()
+
         # Iniciar con la configuración de video
         self.picam2.configure(self.video_config)
-        self.picam2.start()
-        
-        # Dar tiempo a la cámara para que se estabilice
-        time.sleep(2)
+
+        # En modo streaming el encoder deja cada JPEG en 'frames' y get_frame() pasa a
+        # ser una simple lectura. Solo graba mientras hay clientes (vista previa, relé o
+        # una grabación de secuencia): sin nadie mirando, la cámara y el encoder se paran.
+        self.streaming = streaming
+        self.frames = FrameBroadcaster(on_demand=self._on_demand) if streaming else None
+        self.encoder = None
+        self.output = None
+        self.recording = False
+        self._idle_timer = None
+        if streaming:
+            self.output = FileOutput(LatestFrameOutput(self.frames))
+        else:
+            self.picam2.start()
+        # Modo de grabación: últimos segundos de la vista previa en un búfer circular
+        # y grabaciones a intervalo fijo (ver sequence.py).
+        self.sequence = SequenceRecorder(self.frames).start() if streaming else None
+
+        # Dar tiempo a la cámara para que se estabilice (en modo streaming arranca con el primer cliente)
+        if not streaming:
+            time.sleep(2)
         print("Cámara optimizada iniciada.")
 
+    def _start_encoder(self):
+        """Arranca la grabación, prefiriendo el encoder MJPEG por hardware."""
+        if self.encoder is None and MJPEGEncoder is not None:
+            try:
+                self.encoder = MJPEGEncoder()
+                self.picam2.start_recording(self.encoder, self.output, name=self.encode_stream)
+                self.recording = True
+                print("Streaming con encoder MJPEG por hardware.")
+                return
+            except Exception as e:
+                print(f"Encoder MJPEG por hardware no disponible ({e}). Usando JpegEncoder.")
+                self.encoder = None
+        if self.encoder is None:
+            self.encoder = JpegEncoder()
+        self.picam2.start_recording(self.encoder, self.output, name=self.encode_stream)
+        self.recording = True
+
+    def _on_demand(self, active):
+        """Llamado por 'frames' al llegar el primer cliente o irse el último."""
+        if self._idle_timer is not None:
+            self._idle_timer.cancel()
+            self._idle_timer = None
+        if active:
+            self._sync_encoder()
+        else:
+            self._idle_timer = threading.Timer(ENCODER_IDLE_STOP, self._sync_encoder)
+            self._idle_timer.daemon = True
+            self._idle_timer.start()
+
+    def _sync_encoder(self):
+        """Graba si hay clientes y para si no; se decide con el número de clientes actual,
+        así que da igual en qué orden lleguen los avisos."""
+        with self.mode_lock:
+            wanted = self.frames.clients > 0
+            try:
+                if wanted and not self.recording:
+                    self._start_encoder()
+                elif not wanted and self.recording:
+                    self.picam2.stop_recording()
+                    self.recording = False
+                    # Que el próximo cliente no vea el último frame de hace minutos.
+                    self.frames.reset()
+                    print("Sin clientes: cámara y encoder detenidos.")
+            except Exception as e:
+                print(f"Error al {'iniciar' if wanted else 'detener'} la grabación: {e}")
+
+    @contextmanager
+    def _camera_running(self):
+        """Con la grabación parada (sin clientes) la cámara también lo está: se enciende
+        solo mientras dura la captura. Debe llamarse con 'mode_lock' tomado."""
+        idle = self.streaming and not self.recording
+        if idle:
+            self.picam2.start()
+            time.sleep(CAPTURE_SETTLE)  # Exposición y balance de blancos recién arrancados
+        try:
+            yield
+        finally:
+            if idle:
+                self.picam2.stop()
+
     def get_frame(self):
         """Captura un frame del stream de video para la transmisión en vivo."""
-        # Usamos un buffer en memoria para no escribir en disco
-        stream = io.BytesIO()
-        # Capturamos el frame del stream de video activo
-        self.picam2.capture_file(stream, format='jpeg')
+        if self.streaming:
+            # El encoder ya dejó el último JPEG listo; no hay captura adicional.
+            # Durante un cambio de modo se sigue devolviendo el último frame bueno.
+            return self.frames.wait_for_frame(timeout=5)
+        with self.mode_lock:
+            # Usamos un buffer en memoria para no escribir en disco
+            stream = io.BytesIO()
+            # Capturamos el frame del stream de video activo
+            self.picam2.capture_file(stream, format='jpeg')
         stream.seek(0)
         return stream.read()
 
-    def capture_high_res(self):
-        """Cambia a modo de alta resolución, captura una imagen y vuelve al modo de video."""
+    def capture_still(self):
+        """Toma una captura de alta resolución.
+
+        Devuelve (jpeg, stats); 'stats' indica el camino usado ('stream' o
+        'switch'), cuánto tardó la captura y cuánto estuvo parado el video.
+        """
+        start = time.monotonic()
+        with self.mode_lock, self._camera_running():
+            if self.still_from_stream:
+                # Camino rápido: el frame sale del stream 'main' que ya está corriendo.
+                stream = io.BytesIO()
+                self.picam2.capture_file(stream, name="main", format='jpeg')
+                stall_ms = 0.0
+                mode = 'stream'
+            else:
+                stream, stall_ms = self._capture_with_mode_switch()
+                mode = 'switch'
+        stats = {
+            'mode': mode,
+            'capture_ms': round((time.monotonic() - start) * 1000, 1),
+            'stall_ms': round(stall_ms, 1),
+        }
+        return stream.getvalue(), stats
+
+    def capture_burst(self, count=burst.DEFAULT_FRAMES):
+        """Toma 'count' frames de alta resolución en un solo cambio de modo y los une en
+        un JPEG: descarta los movidos, alinea el resto y los promedia (ver burst.py).
+
+        Devuelve (jpeg, stats) como capture_still; stats['burst'] tiene la nitidez,
+        los frames usados, sus desplazamientos y el tiempo de cada paso.
+        """
+        count = max(1, min(int(count), burst.MAX_FRAMES))
+        start = time.monotonic()
+        with self.mode_lock, self._camera_running():
+            if self.still_from_stream:
+                frames = [self._rgb_array(self.video_config, "main") for _ in range(count)]
+                stall_ms = 0.0
+                mode = 'burst_stream'
+            else:
+                frames, stall_ms = self._capture_with_mode_switch(
+                    lambda: [self._rgb_array(self.still_config, "main") for _ in range(count)])
+                mode = 'burst'
+        capture_ms = (time.monotonic() - start) * 1000
+        # El video ya volvió: unir la ráfaga no lo detiene.
+        jpeg, info = burst.merge_to_jpeg(frames)
+        info['frames'] = count
+        info['grab_ms'] = round(capture_ms, 1)
+        stats = {
+            'mode': mode,
+            'capture_ms': round((time.monotonic() - start) * 1000, 1),
+            'stall_ms': round(stall_ms, 1),
+            'burst': info,
+        }
+        return jpeg, stats
+
+    def _rgb_array(self, config, name):
+        """Frame sin comprimir como array RGB (alto x ancho x 3).
+
+        En picamera2 'BGR888' ya deja los bytes en orden R, G, B; 'RGB888' al revés,
+        y los formatos X... traen un cuarto canal de relleno.
+        """
+        array = self.picam2.capture_array(name)
+        if array.ndim == 3 and array.shape[2] == 4:
+            array = array[..., :3]
+        if config[name]['format'] in ('RGB888', 'XRGB8888'):
+            array = array[..., ::-1]
+        return array
+
+    def _capture_with_mode_switch(self, grab=None):
+        """Cambia a modo de alta resolución, captura y vuelve al modo de video.
+
+        Debe llamarse con 'mode_lock' tomado. 'grab' hace la captura en el modo de alta
+        resolución (por defecto, un JPEG en un buffer). Devuelve (resultado, ms_sin_video).
+        """
         print("Cambiando a modo de alta resolución para captura...")
-        # Cambiar a la configuración de alta resolución
-        self.picam2.switch_mode(self.still_config)
-        
-        # Capturar la imagen en un buffer de memoria
-        stream = io.BytesIO()
-        self.picam2.capture_file(stream, format='jpeg')
-        stream.seek(0)
-        print("Captura de alta resolución tomada.")
-        
-        # Volver a la configuración de video para continuar el streaming
-        self.picam2.switch_mode(self.video_config)
-        
-        return stream.read()
+        stall_start = time.monotonic()
+        encoding = self.streaming and self.recording
+        if encoding:
+            # El encoder está atado al stream de video: hay que pararlo durante el cambio.
+            self.picam2.stop_encoder()
+        try:
+            # Cambiar a la configuración de alta resolución
+            self.picam2.switch_mode(self.still_config)
+
+            if grab is None:
+                # Capturar la imagen en un buffer de memoria
+                result = io.BytesIO()
+                self.picam2.capture_file(result, format='jpeg')
+            else:
+                result = grab()
+            print("Captura de alta resolución tomada.")
+        finally:
+            # Volver siempre a la configuración de video, aunque la captura haya fallado.
+            self._restore_video_mode(encoding)
+        return result, (time.monotonic() - stall_start) * 1000
 
+    def _restore_video_mode(self, encoding):
+        """Vuelve al modo de video tras una captura y, si estaba grabando, reanuda el encoder.
+
+        Si no se puede, la grabación queda como parada y se vuelve a arrancar en cuanto
+        se libere 'mode_lock', para que el stream no se quede colgado.
+        """
+        try:
+            self.picam2.switch_mode(self.video_config)
+            if encoding:
+                self.picam2.start_encoder(self.encoder, self.output, name=self.encode_stream)
+            return
+        except Exception as e:
+            print(f"Error al volver al modo de video: {e}")
+        if not encoding:
+            return
+        try:
+            self.picam2.stop_recording()
+            self.picam2.configure(self.video_config)
+        except Exception as e:
+            print(f"Error al reiniciar la cámara: {e}")
+        self.recording = False
+        self.frames.reset()
+        restart = threading.Timer(ENCODER_RESTART_DELAY, self._sync_encoder)
+        restart.daemon = True
+        restart.start()
+
+    def capture_high_res(self):
+        """Captura de alta resolución; devuelve solo los bytes del JPEG."""
+        frame_bytes, _ = self.capture_still()
+        return frame_bytes
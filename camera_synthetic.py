@@ -0,0 +1,95 @@
+# camera_synthetic.py (Fuente de frames sintética para pruebas y benchmarks sin cámara)
+
+import glob
+import io
+import os
+import threading
+import time
+
+import numpy as np
+from PIL import Image
+
+import burst
+from sequence import SequenceRecorder
+from streaming import FrameBroadcaster, LatestFrameOutput
+
+DEFAULT_FRAMES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'capturas')
+
+class Camera:
+    """Misma interfaz que camera_pi.Camera, pero sin hardware.
+
+    Un hilo hace de "encoder": escribe en LatestFrameOutput, a un ritmo fijo,
+    JPEGs ya codificados leídos de disco (por defecto las capturas de ejemplo
+    de static/capturas). Así se ejercita el mismo camino de streaming que en la Pi.
+    """
+
+    def __init__(self, fps=30, frames_dir=DEFAULT_FRAMES_DIR):
+        paths = sorted(glob.glob(os.path.join(frames_dir, '*.jpg')))
+        if not paths:
+            raise RuntimeError(f"No hay JPEGs de ejemplo en {frames_dir}")
+        self.jpegs = []
+        for path in paths:
+            with open(path, 'rb') as f:
+                self.jpegs.append(f.read())
+        self.fps = fps
+        self.streaming = True
+        self.frames = FrameBroadcaster()
+        self.output = LatestFrameOutput(self.frames)
+        self.sequence = SequenceRecorder(self.frames).start()
+        self.frames_written = 0
+        self._thread = threading.Thread(target=self._run, name='synthetic-encoder', daemon=True)
+        self._thread.start()
+        print(f"Cámara sintética iniciada ({len(self.jpegs)} frames de ejemplo a {fps} fps).")
+
+    def _run(self):
+        interval = 1.0 / self.fps
+        next_time = time.monotonic()
+        index = 0
+        while True:
+            self.output.write(self.jpegs[index % len(self.jpegs)])
+            self.frames_written += 1
+            index += 1
+            next_time += interval
+            delay = next_time - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_time = time.monotonic()
+
+    def get_frame(self):
+        """Devuelve el último frame publicado por el encoder sintético."""
+        return self.frames.wait_for_frame(timeout=5)
+
+    def capture_still(self):
+        """Devuelve el frame actual como captura, con las mismas estadísticas que la Pi."""
+        start = time.monotonic()
+        frame_bytes = self.get_frame()
+        stats = {
+            'mode': 'stream',
+            'capture_ms': round((time.monotonic() - start) * 1000, 1),
+            'stall_ms': 0.0,
+        }
+        return frame_bytes, stats
+
+    def capture_burst(self, count=burst.DEFAULT_FRAMES):
+        """Ráfaga con el mismo camino que la Pi: los 'count' frames son el frame actual
+        decodificado (sin ruido de sensor, así que el promedio no cambia la imagen)."""
+        count = max(1, min(int(count), burst.MAX_FRAMES))
+        start = time.monotonic()
+        frame = np.asarray(Image.open(io.BytesIO(self.get_frame())).convert('RGB'))
+        grab_ms = (time.monotonic() - start) * 1000
+        jpeg, info = burst.merge_to_jpeg([frame] * count)
+        info['frames'] = count
+        info['grab_ms'] = round(grab_ms, 1)
+        stats = {
+            'mode': 'burst',
+            'capture_ms': round((time.monotonic() - start) * 1000, 1),
+            'stall_ms': 0.0,
+            'burst': info,
+        }
+        return jpeg, stats
+
+    def capture_high_res(self):
+        """Devuelve el frame actual como si fuera una captura de alta resolución."""
+        frame_bytes, _ = self.capture_still()
+        return frame_bytes
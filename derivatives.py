@@ -0,0 +1,90 @@
+# derivatives.py (Miniaturas de las capturas para la galería)
+#
+# Cada captura tiene versiones reducidas junto al original en Storage:
+#   pacientes/<id>/<área>/<fecha>.jpg -> pacientes/<id>/<área>/miniaturas/<fecha>_small.webp
+# Sus URL públicas se guardan en el documento de la captura (DERIVATIVE_FIELDS). Una
+# anotación raster tiene las suyas (ANNOTATED_DERIVATIVE_FIELDS), junto a su imagen.
+
+import io
+import os
+import posixpath
+
+from PIL import Image, features
+
+# Lado mayor de cada tamaño, en píxeles.
+SIZES = {'small': 400, 'medium': 1024}
+DERIVATIVE_FIELDS = {'small': 'thumb_small_url', 'medium': 'thumb_medium_url'}
+ANNOTATED_DERIVATIVE_FIELDS = {'small': 'annotated_thumb_small_url', 'medium': 'annotated_thumb_medium_url'}
+QUALITY = 80
+
+if features.check('webp'):
+    FORMAT, CONTENT_TYPE, EXTENSION = 'WEBP', 'image/webp', 'webp'
+else:
+    FORMAT, CONTENT_TYPE, EXTENSION = 'JPEG', 'image/jpeg', 'jpg'
+
+
+def derivative_path(storage_path, size_name):
+    directory, filename = posixpath.split(storage_path)
+    base = os.path.splitext(filename)[0]
+    return posixpath.join(directory, 'miniaturas', f"{base}_{size_name}.{EXTENSION}")
+
+
+def _fit_size(size, max_side):
+    scale = max_side / max(size)
+    if scale >= 1:
+        return size
+    return max(1, round(size[0] * scale)), max(1, round(size[1] * scale))
+
+
+def _open_for(source, max_side):
+    """Abre la imagen (bytes o archivo) ya en RGB, decodificada a no menos de 'max_side'."""
+    img = Image.open(io.BytesIO(source) if isinstance(source, (bytes, bytearray)) else source)
+    img.draft('RGB', _fit_size(img.size, max_side))  # Decodificación JPEG ya reducida (escalado DCT)
+    return img.convert('RGB')
+
+
+def _encode(img, max_side, quality):
+    target = _fit_size(img.size, max_side)
+    if target != img.size:
+        img = img.resize(target, Image.LANCZOS)
+    output = io.BytesIO()
+    img.save(output, format=FORMAT, quality=quality)
+    return output.getvalue()
+
+
+def resize_image(image_bytes, max_side, quality=QUALITY):
+    """Reduce la imagen para que su lado mayor no pase de 'max_side' (nunca la amplía)."""
+    return _encode(_open_for(image_bytes, max_side), max_side, quality)
+
+
+def make_derivatives(source):
+    """Retorna {tamaño: bytes} de una imagen (bytes o archivo).
+
+    Se decodifica una vez y cada tamaño se reduce desde esa imagen, no desde otra
+    miniatura ya comprimida con pérdida.
+    """
+    img = _open_for(source, max(SIZES.values()))
+    return {size_name: _encode(img, max_side, QUALITY) for size_name, max_side in SIZES.items()}
+
+
+def derivatives_for_upload(local_path, destination):
+    """Miniaturas de un archivo del spool, en el formato que espera UploadQueue:
+    lista de (ruta_en_storage, bytes, content_type, campo_del_documento)."""
+    with open(local_path, 'rb') as f:
+        images = make_derivatives(f.read())
+    return [(derivative_path(destination, size_name), data, CONTENT_TYPE, DERIVATIVE_FIELDS[size_name])
+            for size_name, data in images.items()]
+
+
+def init_worker():
+    """Inicializador del pool de procesos: no compartir con el padre la sesión HTTP heredada."""
+    import threading
+    import report_images
+    report_images._session = None
+    report_images._session_lock = threading.Lock()
+
+
+def backfill_capture(capture_id, cloud_url):
+    """Para el pool de procesos del backfill: descarga la captura y genera sus miniaturas."""
+    import report_images
+    return capture_id, make_derivatives(report_images.fetch_image(cloud_url))
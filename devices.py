@@ -0,0 +1,314 @@
+# devices.py (Registro de dispositivos: latidos de las Pi e índice en memoria por equipo)
+#
+# Cada Pi envía un latido periódico a POST /devices/heartbeat con su IP, estado y
+# capacidades, autenticado con la clave del dispositivo (X-Device-Key). El servidor
+# guarda el latido en 'devices/<id>' y mantiene un índice en memoria por equipo,
+# alimentado por un listener de Firestore, para elegir dispositivo sin leer nada.
+# Lo que llega en el latido se valida antes de guardarlo: el relé se conecta a esa dirección.
+
+import hashlib
+import hmac
+import secrets
+import socket
+import threading
+import time
+
+import requests
+from google.cloud.firestore_v1 import SERVER_TIMESTAMP
+from google.cloud.firestore_v1.base_query import FieldFilter
+
+import metrics
+import stream_relay
+
+HEARTBEAT_INTERVAL = 30  # segundos entre latidos
+OFFLINE_AFTER = 3 * HEARTBEAT_INTERVAL  # sin latidos durante este tiempo, el dispositivo está desconectado
+STATUSES = ('idle', 'busy', 'offline')
+UNKNOWN_TTL = 300  # segundos durante los que un device_id inexistente no se vuelve a buscar en Firestore
+MAX_UNKNOWN = 10000  # entradas como máximo en la caché de device_id inexistentes
+MAX_DEVICE_ID = 128
+MAX_CAMERA_NAME = 32
+MAX_STREAM_URL = 256
+
+
+def hash_key(key):
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def new_device_key():
+    return secrets.token_urlsafe(32)
+
+
+def local_ip():
+    """IP de la interfaz con la que se sale a la red (sin enviar ningún paquete)."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.connect(('8.8.8.8', 80))
+        return sock.getsockname()[0]
+    except OSError:
+        return '127.0.0.1'
+    finally:
+        sock.close()
+
+
+def clean_local_ip(value):
+    """La IP del latido si es una dirección privada de la LAN; si no, None."""
+    return str(value) if isinstance(value, str) and stream_relay.is_lan_address(value) else None
+
+
+def clean_capabilities(capabilities):
+    """Solo las capacidades conocidas, con tipo y tamaño acotados.
+
+    stream_url se descarta si no es uno de los túneles configurados (LINFO_TUNNEL_HOSTS).
+    """
+    if not isinstance(capabilities, dict):
+        return {}
+    cleaned = {}
+    camera = capabilities.get('camera')
+    if isinstance(camera, str) and len(camera) <= MAX_CAMERA_NAME:
+        cleaned['camera'] = camera
+    if isinstance(capabilities.get('still_from_stream'), bool):
+        cleaned['still_from_stream'] = capabilities['still_from_stream']
+    stream_url = capabilities.get('stream_url')
+    if isinstance(stream_url, str) and len(stream_url) <= MAX_STREAM_URL and stream_relay.is_tunnel_url(stream_url):
+        cleaned['stream_url'] = stream_url
+    return cleaned
+
+
+def _epoch(value):
+    """last_seen llega como datetime desde Firestore y como número desde el propio latido."""
+    if value is None:
+        return 0.0
+    if hasattr(value, 'timestamp'):
+        return value.timestamp()
+    return float(value)
+
+
+class DeviceRegistry:
+    """Índice en memoria {team_id: {device_id: datos}} de los dispositivos.
+
+    watch_team() abre un listener por equipo (como LocalCache), así que lo que
+    escriba otro servidor o la consola de Firebase también llega al índice.
+    Los latidos actualizan el índice al momento y se escriben en Firestore.
+    Con firestore_client=None funciona solo en memoria (dispositivos simulados).
+    """
+
+    def __init__(self, firestore_client, offline_after=OFFLINE_AFTER, clock=time.time):
+        self.firestore_client = firestore_client
+        self.offline_after = offline_after
+        self.clock = clock
+        self._teams = {}
+        self._device_team = {}
+        self._watches = {}
+        self._unknown = {}  # {device_id: instante hasta el que no se vuelve a buscar}
+        self._lock = threading.Lock()
+        metrics.gauge('linfo_devices_online', 'Dispositivos con latido reciente, por equipo.', ('team',),
+                      callback=self._online_counts)
+
+    # --- Índice ---
+
+    def _put(self, device_id, data):
+        team_id = data.get('team_id')
+        if not team_id:
+            return
+        with self._lock:
+            old_team = self._device_team.get(device_id)
+            if old_team and old_team != team_id:
+                self._teams.get(old_team, {}).pop(device_id, None)
+            self._teams.setdefault(team_id, {})[device_id] = dict(data, device_id=device_id)
+            self._device_team[device_id] = team_id
+            self._unknown.pop(device_id, None)
+
+    def _remove(self, device_id):
+        with self._lock:
+            team_id = self._device_team.pop(device_id, None)
+            if team_id:
+                self._teams.get(team_id, {}).pop(device_id, None)
+
+    def get(self, device_id):
+        with self._lock:
+            team_id = self._device_team.get(device_id)
+            device = self._teams.get(team_id, {}).get(device_id) if team_id else None
+            return dict(device) if device else None
+
+    def watch_team(self, team_id):
+        """Empieza a seguir los dispositivos del equipo (idempotente)."""
+        if not self.firestore_client or not team_id:
+            return
+        with self._lock:
+            if team_id in self._watches:
+                return
+            self._watches[team_id] = None
+
+        def on_snapshot(docs, changes, read_time):
+            try:
+                for change in changes:
+                    if change.type.name == 'REMOVED':
+                        self._remove(change.document.id)
+                    else:
+                        self._put(change.document.id, change.document.to_dict())
+            except Exception as e:
+                print(f"Error al aplicar cambios de dispositivos del equipo {team_id}: {e}")
+
+        query = self.firestore_client.collection('devices').where(filter=FieldFilter('team_id', '==', team_id))
+        try:
+            self._watches[team_id] = query.on_snapshot(on_snapshot)
+        except Exception as e:
+            print(f"Error al seguir los dispositivos del equipo {team_id}: {e}")
+
+    # --- Consultas (sin red) ---
+
+    def is_online(self, device, now=None):
+        now = self.clock() if now is None else now
+        return device.get('status') != 'offline' and now - _epoch(device.get('last_seen')) <= self.offline_after
+
+    def online_devices(self, team_id):
+        """Dispositivos conectados del equipo: primero los libres, luego por latido más reciente."""
+        now = self.clock()
+        with self._lock:
+            devices = [dict(d) for d in self._teams.get(team_id, {}).values()]
+        online = [d for d in devices if self.is_online(d, now)]
+        online.sort(key=lambda d: (d.get('status') != 'idle', -_epoch(d.get('last_seen'))))
+        return online
+
+    def pick_device(self, team_id, preferred_id=None):
+        """Elige el dispositivo para un estudio, o None si no hay ninguno conectado."""
+        online = self.online_devices(team_id)
+        for device in online:
+            if device['device_id'] == preferred_id:
+                return device
+        return online[0] if online else None
+
+    def _online_counts(self):
+        with self._lock:
+            teams = list(self._teams)
+        return {(team_id,): len(self.online_devices(team_id)) for team_id in teams}
+
+    # --- Alta y latidos ---
+
+    def register(self, team_id, name, device_id=None):
+        """Da de alta un dispositivo. Retorna (device_id, clave); la clave solo se muestra una vez."""
+        key = new_device_key()
+        data = {'team_id': team_id, 'name': name, 'key_hash': hash_key(key), 'status': 'offline',
+                'local_ip': None, 'capabilities': {}, 'last_seen': None}
+        if self.firestore_client:
+            doc_ref = self.firestore_client.collection('devices').document(device_id) if device_id \
+                else self.firestore_client.collection('devices').document()
+            with metrics.span('firestore', 'set'):
+                doc_ref.set(data)
+            device_id = doc_ref.id
+        device_id = device_id or secrets.token_hex(10)
+        self._put(device_id, data)
+        self.watch_team(team_id)
+        return device_id, key
+
+    def _is_unknown(self, device_id, now):
+        with self._lock:
+            until = self._unknown.get(device_id)
+            if until is not None and until <= now:
+                del self._unknown[device_id]
+                until = None
+            return until is not None
+
+    def _mark_unknown(self, device_id, now):
+        with self._lock:
+            if len(self._unknown) >= MAX_UNKNOWN:
+                self._unknown = {d: until for d, until in self._unknown.items() if until > now}
+                if len(self._unknown) >= MAX_UNKNOWN:
+                    self._unknown.clear()
+            self._unknown[device_id] = now + UNKNOWN_TTL
+
+    def _lookup(self, device_id):
+        """Datos del dispositivo: del índice o, la primera vez, de Firestore.
+
+        Un device_id que no existe se recuerda durante UNKNOWN_TTL, así que repetir
+        latidos con ids inventados no genera una lectura de Firestore cada vez.
+        """
+        device = self.get(device_id)
+        if device is None and self.firestore_client:
+            now = self.clock()
+            if self._is_unknown(device_id, now):
+                return None
+            with metrics.span('firestore', 'get'):
+                doc = self.firestore_client.collection('devices').document(device_id).get()
+            if doc.exists:
+                device = doc.to_dict()
+                self._put(device_id, device)
+                self.watch_team(device.get('team_id'))
+            else:
+                self._mark_unknown(device_id, now)
+        return device
+
+    def heartbeat(self, device_id, key, local_ip=None, status='idle', capabilities=None):
+        """Registra un latido. Retorna los datos actualizados, o None si la clave no es válida.
+
+        local_ip y capabilities se validan (ver clean_local_ip y clean_capabilities).
+        """
+        if not key or not isinstance(key, str) or not isinstance(device_id, str) \
+                or not device_id or len(device_id) > MAX_DEVICE_ID:
+            return None
+        device = self._lookup(device_id)
+        if device is None or not hmac.compare_digest(device.get('key_hash', ''), hash_key(key)):
+            return None
+        if status not in STATUSES:
+            status = 'idle'
+        update = {'local_ip': clean_local_ip(local_ip), 'status': status, 'last_seen': self.clock()}
+        if capabilities is not None:
+            update['capabilities'] = clean_capabilities(capabilities)
+        device.update(update)
+        device.pop('device_id', None)
+        self._put(device_id, device)
+        if self.firestore_client:
+            with metrics.span('firestore', 'update'):
+                self.firestore_client.collection('devices').document(device_id).update(
+                    dict(update, last_seen=SERVER_TIMESTAMP))
+        return self.get(device_id)
+
+
+class HeartbeatClient:
+    """Hilo que envía los latidos de esta Pi al servidor.
+
+    'send' recibe (payload, headers) y retorna el código HTTP; por defecto hace
+    un POST a 'server_url', y se puede sustituir para simular dispositivos.
+    """
+
+    def __init__(self, server_url, device_id, key, capabilities=None, status_fn=None,
+                 interval=HEARTBEAT_INTERVAL, send=None, ip_fn=local_ip):
+        self.server_url = server_url.rstrip('/') if server_url else None
+        self.device_id = device_id
+        self.key = key
+        self.capabilities = capabilities or {}
+        self.status_fn = status_fn or (lambda: 'idle')
+        self.interval = interval
+        self.send = send or self._post
+        self.ip_fn = ip_fn
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _post(self, payload, headers):
+        response = requests.post(f"{self.server_url}/devices/heartbeat", json=payload, headers=headers,
+                                 timeout=(5, 10))
+        return response.status_code
+
+    def beat(self):
+        payload = {'device_id': self.device_id, 'local_ip': self.ip_fn(), 'status': self.status_fn(),
+                   'capabilities': self.capabilities}
+        return self.send(payload, {'X-Device-Key': self.key})
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='device-heartbeat', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                code = self.beat()
+                if code != 200:
+                    print(f"El servidor rechazó el latido del dispositivo {self.device_id} (HTTP {code}).")
+            except Exception as e:
+                print(f"Error al enviar el latido del dispositivo {self.device_id}: {e}")
+            self._stop.wait(self.interval)
@@ -0,0 +1,179 @@
+# fluorescence.py (Cuantificación de la fluorescencia de cada captura, vectorizada con NumPy)
+#
+# Sobre la intensidad (luminancia) de la captura se calcula:
+# - el histograma y sus percentiles;
+# - un umbral adaptativo (Otsu, con un mínimo para capturas sin señal) y el área que lo supera;
+# - las regiones de reflujo dérmico: zonas donde la fluorescencia es difusa (casi toda la
+#   celda supera el umbral), a diferencia de los canales linfáticos, que son líneas finas.
+# El resultado se guarda en el campo 'fluorescence' del documento de la captura.
+
+import base64
+import io
+import time
+
+import numpy as np
+from PIL import Image
+
+ANALYSIS_VERSION = 1  # Subirla hace que el backfill vuelva a procesar las capturas ya analizadas
+ANALYSIS_MAX_SIDE = 1024  # Las fracciones de área no cambian con la escala y el JPEG se decodifica a 1/4
+HISTOGRAM_BINS = 32
+MIN_THRESHOLD = 40  # Sin fluorescencia, Otsu separaría el ruido del sensor en dos clases
+GRID_COLS = 64  # Celdas de la rejilla en la que se buscan las regiones de reflujo
+BACKFLOW_COVERAGE = 0.6  # Fracción de la celda sobre el umbral para considerarla difusa
+MIN_REGION_CELLS = 4
+MAX_REGIONS = 10
+
+
+def decode_intensity(image_bytes, max_side=ANALYSIS_MAX_SIDE):
+    """Decodifica la captura como luminancia (uint8), reducida a 'max_side' como mucho.
+
+    Con draft() el decodificador JPEG solo reconstruye la luminancia y ya a escala
+    1/2, 1/4 u 1/8, que es lo que permite analizar una foto de 12 MP en la Pi.
+    """
+    img = Image.open(io.BytesIO(image_bytes))
+    scale = max_side / max(img.size)
+    if scale < 1:
+        # draft() elige la mayor reducción que no baje del tamaño pedido: pidiendo la
+        # mitad, el resultado queda entre max_side / 2 y max_side sin reescalar después.
+        img.draft('L', (int(img.width * scale / 2), int(img.height * scale / 2)))
+    img = img.convert('L')
+    if max(img.size) > max_side:
+        scale = max_side / max(img.size)
+        img = img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))), Image.BILINEAR)
+    return np.asarray(img)
+
+
+def otsu_threshold(histogram):
+    """Umbral de Otsu a partir del histograma de 256 niveles (sin recorrer píxeles)."""
+    levels = np.arange(histogram.size, dtype=np.float64)
+    weight_low = np.cumsum(histogram, dtype=np.float64)
+    weight_high = weight_low[-1] - weight_low
+    cumulative = np.cumsum(histogram * levels)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_low = cumulative / weight_low
+        mean_high = (cumulative[-1] - cumulative) / weight_high
+        between = weight_low * weight_high * (mean_low - mean_high) ** 2
+    return int(np.nanargmax(np.nan_to_num(between, nan=-1.0)))
+
+
+def label_grid(mask):
+    """Componentes conexas (vecindad 4) de una máscara pequeña. 0 es fondo.
+
+    Propaga la etiqueta mínima entre vecinos con operaciones sobre el array entero
+    hasta que no cambia nada; con una rejilla de 64 columnas son pocas iteraciones.
+    """
+    rows, cols = mask.shape
+    big = rows * cols + 1
+    labels = np.where(mask, np.arange(1, rows * cols + 1).reshape(rows, cols), big)
+    while True:
+        padded = np.pad(labels, 1, constant_values=big)
+        neighbours = np.minimum.reduce([padded[:-2, 1:-1], padded[2:, 1:-1], padded[1:-1, :-2],
+                                        padded[1:-1, 2:], labels])
+        updated = np.where(mask, neighbours, big)
+        if np.array_equal(updated, labels):
+            break
+        labels = updated
+    labels[~mask] = 0
+    return labels
+
+
+def _percentile(cumulative, total, fraction):
+    return int(np.searchsorted(cumulative, fraction * total))
+
+
+def _pack_mask(mask):
+    return {'rows': int(mask.shape[0]), 'cols': int(mask.shape[1]),
+            'bits': base64.b64encode(np.packbits(mask.ravel()).tobytes()).decode('ascii')}
+
+
+def unpack_mask(packed):
+    """Máscara de reflujo (rejilla de celdas) guardada en el documento -> array booleano."""
+    bits = np.frombuffer(base64.b64decode(packed['bits']), dtype=np.uint8)
+    count = packed['rows'] * packed['cols']
+    return np.unpackbits(bits)[:count].reshape(packed['rows'], packed['cols']).astype(bool)
+
+
+def analyze_array(gray):
+    """Métricas de fluorescencia de una imagen de intensidad uint8 (alto x ancho)."""
+    height, width = gray.shape
+    total = gray.size
+    histogram = np.bincount(gray.ravel(), minlength=256)
+    cumulative = np.cumsum(histogram)
+    threshold = max(otsu_threshold(histogram), MIN_THRESHOLD)
+    mask = gray > threshold
+    area = int(cumulative[-1] - cumulative[threshold])
+
+    # Centroide de todo lo fluorescente, con sumas por filas y columnas (sin índices por píxel).
+    centroid = None
+    if area:
+        cx = float(mask.sum(axis=0) @ np.arange(width)) / area / width
+        cy = float(mask.sum(axis=1) @ np.arange(height)) / area / height
+        centroid = [round(cx, 4), round(cy, 4)]
+
+    # Rejilla de celdas cuadradas; el borde que no llena una celda se descarta.
+    cell = max(1, width // GRID_COLS)
+    rows, cols = height // cell, width // cell
+    cropped_mask = mask[:rows * cell, :cols * cell].reshape(rows, cell, cols, cell)
+    coverage = cropped_mask.mean(axis=(1, 3))
+    cell_mean = gray[:rows * cell, :cols * cell].reshape(rows, cell, cols, cell).mean(axis=(1, 3))
+    backflow = coverage >= BACKFLOW_COVERAGE
+
+    labels = label_grid(backflow)
+    ids, sizes = np.unique(labels[labels > 0], return_counts=True)
+    keep = ids[sizes >= MIN_REGION_CELLS]
+    backflow = np.isin(labels, keep)
+    regions = []
+    if keep.size:
+        ys, xs = np.indices(labels.shape)
+        weights = cell_mean * coverage
+        for region_id in keep:
+            inside = labels == region_id
+            w = weights[inside]
+            region_x, region_y = xs[inside], ys[inside]
+            regions.append({
+                'area_fraction': round(float(inside.sum()) / (rows * cols), 5),
+                'cx': round(float((region_x + 0.5) @ w / w.sum()) / cols, 4),
+                'cy': round(float((region_y + 0.5) @ w / w.sum()) / rows, 4),
+                'bbox': [round(float(region_x.min()) / cols, 4), round(float(region_y.min()) / rows, 4),
+                         round(float(region_x.max() + 1) / cols, 4), round(float(region_y.max() + 1) / rows, 4)],
+                'mean_intensity': round(float(cell_mean[inside].mean()), 1),
+            })
+        regions.sort(key=lambda r: r['area_fraction'], reverse=True)
+
+    binned = histogram.reshape(HISTOGRAM_BINS, -1).sum(axis=1) / total
+    return {
+        'version': ANALYSIS_VERSION,
+        'width': int(width),
+        'height': int(height),
+        'threshold': int(threshold),
+        'area_fraction': round(area / total, 5),
+        'mean_intensity': round(float(histogram @ np.arange(256)) / total, 2),
+        'median_intensity': _percentile(cumulative, total, 0.5),
+        'p95_intensity': _percentile(cumulative, total, 0.95),
+        'max_intensity': int(np.flatnonzero(histogram)[-1]),
+        'centroid': centroid,
+        'histogram': [round(float(v), 5) for v in binned],
+        'backflow_fraction': round(float(backflow.sum()) / (rows * cols), 5),
+        'regions': regions[:MAX_REGIONS],
+        'backflow_mask': _pack_mask(backflow),
+    }
+
+
+def analyze(image_bytes):
+    """Analiza una captura JPEG completa. Retorna el diccionario de 'fluorescence'."""
+    start = time.perf_counter()
+    result = analyze_array(decode_intensity(image_bytes))
+    result['analysis_ms'] = round((time.perf_counter() - start) * 1000, 1)
+    return result
+
+
+def analysis_for_upload(local_path):
+    """Campos del documento para UploadQueue: se analiza el archivo del spool antes de subirlo."""
+    with open(local_path, 'rb') as f:
+        return {'fluorescence': analyze(f.read())}
+
+
+def analyze_capture(capture_id, cloud_url):
+    """Para el pool de procesos del backfill: descarga la captura y la analiza."""
+    import report_images
+    return capture_id, analyze(report_images.fetch_image(cloud_url))
@@ -0,0 +1,102 @@
+# jobs.py (Trabajos en segundo plano con seguimiento de progreso)
+
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Job:
+    """Estado de un trabajo: lo actualiza el propio trabajo y lo consulta /jobs/<id>."""
+
+    def __init__(self, kind, team_id):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.team_id = team_id
+        self.status = 'pendiente'
+        self.total = 0
+        self.done = 0
+        self.message = ''
+        self.error = None
+        self.result = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self._lock = threading.Lock()
+
+    def update(self, done=None, total=None, message=None, advance=0):
+        with self._lock:
+            if total is not None:
+                self.total = total
+            if done is not None:
+                self.done = done
+            self.done += advance
+            if message is not None:
+                self.message = message
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'id': self.id,
+                'kind': self.kind,
+                'status': self.status,
+                'total': self.total,
+                'done': self.done,
+                'progress': round(self.done / self.total, 3) if self.total else None,
+                'message': self.message,
+                'error': self.error,
+                'result': self.result,
+            }
+
+
+class JobRegistry:
+    """Ejecuta trabajos en un pool de hilos y guarda su estado un tiempo tras terminar.
+
+    'dedicated_workers' ({tipo: hilos}) da a esos tipos de trabajo un pool propio, para
+    que no esperen detrás de trabajos largos de otro tipo (p. ej. un borrado detrás de
+    una exportación).
+    """
+
+    def __init__(self, max_workers=2, keep_seconds=3600, dedicated_workers=None):
+        self.keep_seconds = keep_seconds
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self._dedicated = {kind: ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f'job-{kind}')
+                           for kind, workers in (dedicated_workers or {}).items()}
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, kind, team_id, func, *args, **kwargs):
+        """Lanza func(job, *args, **kwargs); lo que retorne queda en job.result."""
+        job = Job(kind, team_id)
+        with self._lock:
+            self._purge()
+            self._jobs[job.id] = job
+        executor = self._dedicated.get(kind, self._executor)
+        executor.submit(self._run, job, func, args, kwargs)
+        return job
+
+    def _run(self, job, func, args, kwargs):
+        job.status = 'en_curso'
+        try:
+            job.result = func(job, *args, **kwargs)
+            job.status = 'completado'
+        except Exception as e:
+            print(f"Error en el trabajo {job.kind} {job.id}: {e}")
+            job.error = str(e)
+            job.status = 'error'
+        finally:
+            job.finished_at = time.time()
+
+    def get(self, job_id, team_id=None):
+        """Retorna el trabajo, o None si no existe o pertenece a otro equipo."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None or (team_id is not None and job.team_id != team_id):
+            return None
+        return job
+
+    def _purge(self):
+        now = time.time()
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.finished_at and now - job.finished_at > self.keep_seconds]
+        for job_id in expired:
+            del self._jobs[job_id]
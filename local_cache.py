@@ -0,0 +1,378 @@
+# local_cache.py (Réplica local en SQLite de los pacientes y capturas de Firestore)
+
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from google.cloud.firestore_v1.base_query import FieldFilter
+from google.cloud.firestore_v1.transforms import DELETE_FIELD, SERVER_TIMESTAMP
+
+from upload_queue import encode_document, decode_document
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS patients (
+        firestore_id TEXT PRIMARY KEY, team_id TEXT NOT NULL, cedula TEXT,
+        nombre TEXT, apellido TEXT, edad INTEGER, telefono TEXT,
+        data TEXT NOT NULL, synced_at REAL
+    );
+    CREATE INDEX IF NOT EXISTS idx_patients_team_apellido ON patients (team_id, apellido, firestore_id);
+    CREATE TABLE IF NOT EXISTS captures (
+        firestore_id TEXT PRIMARY KEY, patient_firestore_id TEXT, team_id TEXT,
+        timestamp TEXT, storage_path TEXT, cloud_url TEXT, study_area TEXT,
+        data TEXT NOT NULL, synced_at REAL
+    );
+    CREATE INDEX IF NOT EXISTS idx_captures_patient_timestamp ON captures (patient_firestore_id, timestamp);
+    CREATE INDEX IF NOT EXISTS idx_captures_team ON captures (team_id);
+'''
+
+# Índice de búsqueda de pacientes. Es una tabla FTS5 sin contenido propio (content=''):
+# su rowid es el de 'patients' y la mantienen los triggers, así que cualquier
+# escritura en la réplica la actualiza. La cédula se indexa sin el prefijo V/E ni
+# separadores, para que "V-12.345.678", "12345678" o "12345" encuentren al mismo paciente.
+CEDULA_DIGITS_SQL = "replace(replace(replace(replace(replace(upper({0}), 'V', ''), 'E', ''), '-', ''), '.', ''), ' ', '')"
+
+SEARCH_SCHEMA = '''
+    CREATE VIRTUAL TABLE IF NOT EXISTS patients_fts USING fts5(
+        nombre, apellido, cedula, content='',
+        tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3 4'
+    );
+    CREATE TRIGGER IF NOT EXISTS patients_fts_insert AFTER INSERT ON patients BEGIN
+        INSERT INTO patients_fts (rowid, nombre, apellido, cedula)
+        VALUES (new.rowid, new.nombre, new.apellido, {new_cedula});
+    END;
+    CREATE TRIGGER IF NOT EXISTS patients_fts_delete AFTER DELETE ON patients BEGIN
+        INSERT INTO patients_fts (patients_fts, rowid, nombre, apellido, cedula)
+        VALUES ('delete', old.rowid, old.nombre, old.apellido, {old_cedula});
+    END;
+    CREATE TRIGGER IF NOT EXISTS patients_fts_update AFTER UPDATE ON patients BEGIN
+        INSERT INTO patients_fts (patients_fts, rowid, nombre, apellido, cedula)
+        VALUES ('delete', old.rowid, old.nombre, old.apellido, {old_cedula});
+        INSERT INTO patients_fts (rowid, nombre, apellido, cedula)
+        VALUES (new.rowid, new.nombre, new.apellido, {new_cedula});
+    END;
+'''.format(new_cedula=CEDULA_DIGITS_SQL.format('new.cedula'), old_cedula=CEDULA_DIGITS_SQL.format('old.cedula'))
+
+# Términos más cortos no se buscan: el índice de prefijos empieza en 2 caracteres y una
+# sola letra coincide con casi todo el equipo.
+MIN_SEARCH_PREFIX = 2
+
+
+def init_schema(conn):
+    """Crea las tablas de la réplica; migra las tablas antiguas, que nunca se llenaban."""
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(patients)")]
+    if columns and 'team_id' not in columns:
+        # El esquema anterior (con AUTOINCREMENT y FK) no se usaba: solo es una caché,
+        # así que se reconstruye y se vuelve a llenar desde Firestore.
+        conn.execute('DROP TABLE IF EXISTS captures')
+        conn.execute('DROP TABLE IF EXISTS patients')
+    conn.executescript(SCHEMA)
+    has_search_index = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'patients_fts'").fetchone()
+    conn.executescript(SEARCH_SCHEMA)
+    if not has_search_index:
+        # Índice nuevo sobre una réplica que ya tenía datos: se llena una sola vez.
+        conn.execute(f'''
+            INSERT INTO patients_fts (rowid, nombre, apellido, cedula)
+            SELECT rowid, nombre, apellido, {CEDULA_DIGITS_SQL.format('cedula')} FROM patients
+        ''')
+    conn.commit()
+
+
+def build_search_query(text):
+    """Convierte lo que escribe el usuario en una consulta MATCH de FTS5.
+
+    Las palabras buscan por prefijo en nombre y apellido (sin importar tildes ni
+    mayúsculas); los números buscan por prefijo en la cédula. Todos los términos
+    deben coincidir; los de menos de MIN_SEARCH_PREFIX caracteres se ignoran.
+    Retorna None si no queda nada que buscar.
+    """
+    compact = re.sub(r'[\s.\-]', '', text)
+    if re.fullmatch(r'[VvEe]?\d+', compact):
+        # Una cédula escrita con o sin prefijo y separadores.
+        digits = compact.lstrip('VvEe')
+        return f'cedula : "{digits}"*' if len(digits) >= MIN_SEARCH_PREFIX else None
+    terms = []
+    for token in re.findall(r'[^\W_]+', text):
+        if len(token) < MIN_SEARCH_PREFIX:
+            continue
+        if token.isdigit():
+            terms.append(f'cedula : "{token}"*')
+        else:
+            terms.append(f'{{nombre apellido}} : "{token}"*')
+    return ' AND '.join(terms) if terms else None
+
+
+def _stamp(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def _local_copy(data):
+    """Copia del documento apta para SQLite: los SERVER_TIMESTAMP pasan a la hora local
+    hasta que el listener traiga el valor real del servidor, y los DELETE_FIELD se quitan."""
+    result = {}
+    for key, value in data.items():
+        if value is DELETE_FIELD:
+            continue
+        if isinstance(value, dict):
+            result[key] = _local_copy(value)
+        elif value is SERVER_TIMESTAMP:
+            result[key] = datetime.now()
+        else:
+            result[key] = value
+    return result
+
+
+class LocalCache:
+    """Caché de lectura/escritura de 'patients' y 'captures' sobre SQLite.
+
+    Por cada equipo se abre un listener on_snapshot de Firestore que mantiene
+    las tablas al día. Mientras el primer snapshot de un equipo no haya llegado,
+    is_ready() es False y las rutas siguen leyendo de Firestore. Las escrituras
+    de la app se aplican también aquí (write-through) para que se vean al instante.
+    """
+
+    def __init__(self, db_path, firestore_client):
+        self.db_path = db_path
+        self.firestore_client = firestore_client
+        self._lock = threading.Lock()
+        self._watches = {}
+        self._ready = {}
+        conn = self._connect()
+        conn.execute('PRAGMA journal_mode=WAL')
+        init_schema(conn)
+        conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    # --- Listeners de Firestore ---
+
+    def watch_team(self, team_id):
+        """Empieza a replicar los pacientes y capturas del equipo (idempotente)."""
+        if not self.firestore_client or not team_id:
+            return
+        with self._lock:
+            if team_id in self._watches:
+                return
+            self._watches[team_id] = []
+            self._ready[team_id] = set()
+        for collection, upsert, delete in (('patients', self._upsert_patient, self._delete_patient),
+                                           ('captures', self._upsert_capture, self._delete_capture)):
+            query = self.firestore_client.collection(collection).where(filter=FieldFilter('team_id', '==', team_id))
+            callback = self._make_callback(team_id, collection, upsert, delete)
+            try:
+                self._watches[team_id].append(query.on_snapshot(callback))
+            except Exception as e:
+                print(f"Error al iniciar la réplica de {collection} para el equipo {team_id}: {e}")
+
+    def _make_callback(self, team_id, collection, upsert, delete):
+        """'upsert' y 'delete' reciben la conexión: todos los cambios de un snapshot
+        se aplican en una sola transacción."""
+        def on_snapshot(docs, changes, read_time):
+            try:
+                first = collection not in self._ready.get(team_id, set())
+                conn = self._connect()
+                try:
+                    if first:
+                        # El primer snapshot trae el conjunto completo: lo que no venga
+                        # se borró mientras la app estaba apagada o sin conexión.
+                        self._prune(conn, collection, team_id, {doc.id for doc in docs})
+                    for change in changes:
+                        if change.type.name == 'REMOVED':
+                            delete(conn, change.document.id)
+                        else:
+                            upsert(conn, change.document.id, change.document.to_dict())
+                    conn.commit()
+                finally:
+                    conn.close()
+                if first:
+                    with self._lock:
+                        self._ready[team_id].add(collection)
+                    print(f"Réplica local de {collection} lista para el equipo {team_id}.")
+            except Exception as e:
+                print(f"Error al aplicar cambios de {collection} en la réplica local: {e}")
+        return on_snapshot
+
+    def is_ready(self, team_id, collections=('patients', 'captures')):
+        with self._lock:
+            ready = self._ready.get(team_id, set())
+            return all(c in ready for c in collections)
+
+    def _prune(self, conn, collection, team_id, keep_ids):
+        rows = conn.execute(f'SELECT firestore_id FROM {collection} WHERE team_id = ?', (team_id,)).fetchall()
+        stale = [(row['firestore_id'],) for row in rows if row['firestore_id'] not in keep_ids]
+        conn.executemany(f'DELETE FROM {collection} WHERE firestore_id = ?', stale)
+
+    # --- Escrituras ---
+    # Los métodos con guion bajo escriben sobre una conexión abierta sin confirmar;
+    # los públicos abren la suya y confirman.
+
+    def _upsert_patient(self, conn, firestore_id, data):
+        data = _local_copy(data)
+        conn.execute('''
+            INSERT INTO patients
+                (firestore_id, team_id, cedula, nombre, apellido, edad, telefono, data, synced_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (firestore_id) DO UPDATE SET
+                team_id = excluded.team_id, cedula = excluded.cedula, nombre = excluded.nombre,
+                apellido = excluded.apellido, edad = excluded.edad, telefono = excluded.telefono,
+                data = excluded.data, synced_at = excluded.synced_at
+        ''', (firestore_id, data.get('team_id'), data.get('cedula'), data.get('nombre'), data.get('apellido'),
+              data.get('edad'), data.get('telefono'), encode_document(data), time.time()))
+
+    def upsert_patient(self, firestore_id, data):
+        conn = self._connect()
+        self._upsert_patient(conn, firestore_id, data)
+        conn.commit()
+        conn.close()
+
+    def update_patient(self, firestore_id, updates):
+        """Aplica una actualización parcial (como DocumentReference.update)."""
+        current = self.get_patient(firestore_id)
+        if current is None:
+            return
+        current.pop('firestore_id', None)
+        current.update(updates)
+        self.upsert_patient(firestore_id, current)
+
+    def _delete_patient(self, conn, firestore_id):
+        conn.execute('DELETE FROM patients WHERE firestore_id = ?', (firestore_id,))
+
+    def delete_patient(self, firestore_id):
+        conn = self._connect()
+        self._delete_patient(conn, firestore_id)
+        conn.commit()
+        conn.close()
+
+    def _upsert_capture(self, conn, firestore_id, data):
+        data = _local_copy(data)
+        conn.execute('''
+            INSERT INTO captures
+                (firestore_id, patient_firestore_id, team_id, timestamp, storage_path, cloud_url,
+                 study_area, data, synced_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (firestore_id) DO UPDATE SET
+                patient_firestore_id = excluded.patient_firestore_id, team_id = excluded.team_id,
+                timestamp = excluded.timestamp, storage_path = excluded.storage_path,
+                cloud_url = excluded.cloud_url, study_area = excluded.study_area,
+                data = excluded.data, synced_at = excluded.synced_at
+        ''', (firestore_id, data.get('patient_firestore_id'), data.get('team_id'), _stamp(data.get('timestamp')),
+              data.get('storage_path'), data.get('cloud_url'), data.get('study_area'),
+              encode_document(data), time.time()))
+
+    def upsert_capture(self, firestore_id, data):
+        conn = self._connect()
+        self._upsert_capture(conn, firestore_id, data)
+        conn.commit()
+        conn.close()
+
+    def update_capture(self, firestore_id, updates):
+        current = self.get_capture(firestore_id)
+        if current is None:
+            return
+        current.pop('firestore_id', None)
+        current.update(updates)
+        self.upsert_capture(firestore_id, current)
+
+    def _delete_capture(self, conn, firestore_id):
+        conn.execute('DELETE FROM captures WHERE firestore_id = ?', (firestore_id,))
+
+    def delete_capture(self, firestore_id):
+        conn = self._connect()
+        self._delete_capture(conn, firestore_id)
+        conn.commit()
+        conn.close()
+
+    def delete_patient_captures(self, patient_firestore_id):
+        conn = self._connect()
+        conn.execute('DELETE FROM captures WHERE patient_firestore_id = ?', (patient_firestore_id,))
+        conn.commit()
+        conn.close()
+
+    # --- Lecturas ---
+
+    @staticmethod
+    def _row_to_doc(row):
+        data = decode_document(row['data'])
+        data['firestore_id'] = row['firestore_id']
+        return data
+
+    def get_patient(self, firestore_id):
+        conn = self._connect()
+        row = conn.execute('SELECT firestore_id, data FROM patients WHERE firestore_id = ?', (firestore_id,)).fetchone()
+        conn.close()
+        return self._row_to_doc(row) if row else None
+
+    def get_capture(self, firestore_id):
+        conn = self._connect()
+        row = conn.execute('SELECT firestore_id, data FROM captures WHERE firestore_id = ?', (firestore_id,)).fetchone()
+        conn.close()
+        return self._row_to_doc(row) if row else None
+
+    def patient_page(self, team_id, after=None, page_size=50):
+        """Página de pacientes ordenada por (apellido, id), con el mismo cursor que Firestore.
+
+        Retorna (pacientes, hay_más); solo incluye las columnas de la lista.
+        """
+        params = [team_id]
+        where = 'team_id = ?'
+        if after:
+            apellido, doc_id = after
+            where += ' AND (apellido > ? OR (apellido = ? AND firestore_id > ?))'
+            params += [apellido, apellido, doc_id]
+        conn = self._connect()
+        rows = conn.execute(f'''
+            SELECT firestore_id, nombre, apellido, cedula FROM patients WHERE {where}
+            ORDER BY apellido, firestore_id LIMIT ?
+        ''', params + [page_size + 1]).fetchall()
+        conn.close()
+        patients = [dict(row) for row in rows[:page_size]]
+        return patients, len(rows) > page_size
+
+    def capture_page(self, patient_firestore_id, after=None, page_size=24):
+        """Página de capturas del paciente, de la más reciente a la más antigua.
+
+        'after' es (timestamp, id) de la última captura de la página anterior, igual que
+        el cursor de Firestore; las capturas sin timestamp van al final. Retorna (capturas, hay_más).
+        """
+        params = [patient_firestore_id]
+        where = 'patient_firestore_id = ?'
+        if after:
+            timestamp, doc_id = after
+            if timestamp is None:
+                where += ' AND timestamp IS NULL AND firestore_id < ?'
+                params += [doc_id]
+            else:
+                where += ' AND (timestamp < ? OR timestamp IS NULL OR (timestamp = ? AND firestore_id < ?))'
+                params += [timestamp, timestamp, doc_id]
+        conn = self._connect()
+        rows = conn.execute(f'''
+            SELECT firestore_id, data FROM captures WHERE {where}
+            ORDER BY timestamp IS NULL, timestamp DESC, firestore_id DESC LIMIT ?
+        ''', params + [page_size + 1]).fetchall()
+        conn.close()
+        captures = [self._row_to_doc(row) for row in rows[:page_size]]
+        return captures, len(rows) > page_size
+
+    def search_patients(self, team_id, text, limit=20):
+        """Busca pacientes del equipo por nombre, apellido o cédula (ver build_search_query)."""
+        match = build_search_query(text)
+        if not match:
+            return []
+        conn = self._connect()
+        # CROSS JOIN fija el orden: primero el índice FTS y luego la tabla por rowid.
+        # Se ordena antes del LIMIT para que los resultados sean los primeros por apellido
+        # de todas las coincidencias, no los que SQLite encuentre antes.
+        rows = conn.execute('''
+            SELECT p.firestore_id, p.nombre, p.apellido, p.cedula
+            FROM patients_fts f CROSS JOIN patients p ON p.rowid = f.rowid
+            WHERE patients_fts MATCH ? AND p.team_id = ?
+            ORDER BY p.apellido COLLATE NOCASE, p.nombre COLLATE NOCASE, p.firestore_id
+            LIMIT ?
+        ''', (match, team_id, limit)).fetchall()
+        conn.close()
+        return [dict(row) for row in rows]
@@ -0,0 +1,241 @@
+# metrics.py (Instrumentación: tiempos de peticiones y de llamadas externas en formato Prometheus)
+#
+# Sin dependencias: cada observación es una búsqueda en un diccionario bajo un lock,
+# así que puede quedarse activo siempre en la Raspberry Pi. Se expone en /metrics.
+
+import bisect
+import hmac
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+LOCAL_ADDRESSES = ('127.0.0.1', '::1')  # Sin token, /metrics solo responde a estas direcciones
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.label_names)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            lines.append(f'{self.name}{_format_labels(self.label_names, key)} {_format_number(value)}')
+        return lines
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """Valor instantáneo. Con 'callback' se calcula al exportar: retorna un número
+    o {tupla_de_etiquetas: número}."""
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labels=(), callback=None):
+        super().__init__(name, documentation, labels)
+        self.callback = callback
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def render(self):
+        if self.callback:
+            try:
+                value = self.callback()
+            except Exception as e:
+                print(f"Error al calcular la métrica {self.name}: {e}")
+                value = {}
+            with self._lock:
+                self._values = value if isinstance(value, dict) else {(): value}
+        return super().render()
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                # [cuentas por bucket (la última es +Inf), suma, total]
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            items = [(key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items()]
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.label_names, key, ('le', _format_number(bound)))
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.label_names, key)
+            lines.append(f'{self.name}_sum{labels} {_format_number(total)}')
+            lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            return metric
+
+    def counter(self, name, documentation, labels=()):
+        return self._get_or_create(Counter, name, documentation, labels)
+
+    def gauge(self, name, documentation, labels=(), callback=None):
+        return self._get_or_create(Gauge, name, documentation, labels, callback)
+
+    def histogram(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, documentation, labels, buckets)
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+
+HTTP_REQUEST_SECONDS = histogram('linfo_http_request_duration_seconds',
+                                 'Duración de las peticiones HTTP (hasta el primer byte en los streams).',
+                                 ('method', 'endpoint', 'status'))
+EXTERNAL_CALL_SECONDS = histogram('linfo_external_call_duration_seconds',
+                                  'Duración de las llamadas a Firestore, Storage, Auth y la cámara.',
+                                  ('service', 'operation'))
+EXTERNAL_CALL_ERRORS = counter('linfo_external_call_errors_total',
+                               'Llamadas externas que terminaron en excepción.', ('service', 'operation'))
+SLOW_REQUESTS = counter('linfo_http_slow_requests_total',
+                        'Peticiones que superaron LINFO_SLOW_REQUEST_MS.', ('endpoint',))
+
+
+@contextmanager
+def span(service, operation):
+    """Mide una llamada externa: with metrics.span('firestore', 'get'): ..."""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        EXTERNAL_CALL_ERRORS.inc(service=service, operation=operation)
+        raise
+    finally:
+        EXTERNAL_CALL_SECONDS.observe(time.perf_counter() - start, service=service, operation=operation)
+
+
+def init_app(app, slow_request_ms=None, token=None):
+    """Registra el middleware de tiempos y la ruta /metrics.
+
+    'slow_request_ms' (o LINFO_SLOW_REQUEST_MS) imprime las peticiones más lentas
+    que ese umbral. Si hay 'token' (o LINFO_METRICS_TOKEN), /metrics exige
+    'Authorization: Bearer <token>'; si no, solo responde a peticiones locales que
+    no vengan de un proxy (ngrok también conecta desde 127.0.0.1).
+    """
+    from flask import Response, g, request
+
+    if slow_request_ms is None and os.environ.get('LINFO_SLOW_REQUEST_MS'):
+        slow_request_ms = float(os.environ['LINFO_SLOW_REQUEST_MS'])
+    token = token or os.environ.get('LINFO_METRICS_TOKEN')
+
+    @app.before_request
+    def _start_timer():
+        g._metrics_start = time.perf_counter()
+
+    @app.after_request
+    def _record_request(response):
+        start = g.pop('_metrics_start', None)
+        if start is None:
+            return response
+        elapsed = time.perf_counter() - start
+        # La regla de la ruta (no la URL) mantiene acotado el número de series.
+        endpoint = request.url_rule.rule if request.url_rule else 'sin_ruta'
+        HTTP_REQUEST_SECONDS.observe(elapsed, method=request.method, endpoint=endpoint,
+                                     status=response.status_code)
+        if slow_request_ms is not None and elapsed * 1000 >= slow_request_ms:
+            SLOW_REQUESTS.inc(endpoint=endpoint)
+            print(f"Petición lenta: {request.method} {request.path} -> {response.status_code} "
+                  f"en {elapsed * 1000:.0f} ms")
+        return response
+
+    @app.route('/metrics')
+    def metrics_endpoint():
+        if token:
+            if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+                return "No autorizado.", 401
+        elif request.remote_addr not in LOCAL_ADDRESSES or request.headers.get('X-Forwarded-For') \
+                or request.headers.get('Forwarded'):
+            return "No autorizado.", 401
+        return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+    return app
@@ -0,0 +1,173 @@
+# report_cache.py (Caché en disco de los PDF ya generados, con expulsión LRU)
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+CACHE_DIR = 'report_cache'
+MAX_BYTES = 200 * 1024 * 1024
+
+# Cambiar este valor invalida todo lo cacheado cuando cambia el formato del informe.
+RENDER_VERSION = 1
+
+
+def _stamp(value):
+    """Representación estable de un valor de Firestore (las fechas, en ISO)."""
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return value
+
+
+def report_fingerprint(report_data, patient_data, captures_by_id, quality):
+    """Huella de todo lo que influye en el PDF: si no cambia, el PDF tampoco."""
+    selected = report_data.get('selected_captures', [])
+    payload = {
+        'version': RENDER_VERSION,
+        'quality': quality,
+        'report': {
+            'analysis_date': _stamp(report_data.get('analysis_date')),
+            'selected_captures': selected,
+            'extremidad': report_data.get('extremidad', []),
+            'hallazgos': report_data.get('hallazgos', []),
+            'conclusiones': report_data.get('conclusiones', ''),
+        },
+        'patient': {
+            'nombre': patient_data.get('nombre'),
+            'apellido': patient_data.get('apellido'),
+            'cedula': patient_data.get('cedula'),
+            'updated_at': _stamp(patient_data.get('updated_at')),
+        },
+        'captures': [
+            {
+                'id': capture_id,
+                'cloud_url': captures_by_id.get(capture_id, {}).get('cloud_url'),
+                'annotated_url': captures_by_id.get(capture_id, {}).get('annotated_url'),
+                'last_annotated_at': _stamp(captures_by_id.get(capture_id, {}).get('last_annotated_at')),
+                'annotation_hash': captures_by_id.get(capture_id, {}).get('annotation_hash'),
+                'timestamp': _stamp(captures_by_id.get(capture_id, {}).get('timestamp')),
+                'study_area': captures_by_id.get(capture_id, {}).get('study_area'),
+            }
+            for capture_id in selected
+        ],
+    }
+    encoded = json.dumps(payload, sort_keys=True, default=str).encode('utf-8')
+    return hashlib.sha256(encoded).hexdigest()
+
+
+class ReportCache:
+    """PDFs renderados, indexados por (informe, calidad) y validados por su huella.
+
+    El índice vive en la tabla 'report_cache' de SQLite junto con el paciente y
+    las capturas de cada informe, para poder invalidar entradas cuando se edita
+    un paciente o una captura. Si el total supera 'max_bytes' se expulsan las
+    entradas usadas hace más tiempo.
+    """
+
+    def __init__(self, db_path, cache_dir=CACHE_DIR, max_bytes=MAX_BYTES):
+        self.db_path = db_path
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        conn = self._connect()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS report_cache (
+                report_id TEXT NOT NULL, quality TEXT NOT NULL, fingerprint TEXT NOT NULL,
+                patient_id TEXT, capture_ids TEXT, path TEXT NOT NULL, size INTEGER NOT NULL,
+                last_access REAL NOT NULL, PRIMARY KEY (report_id, quality)
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_report_cache_patient ON report_cache (patient_id)')
+        conn.commit()
+        conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def get(self, report_id, quality, fingerprint):
+        """Devuelve los bytes del PDF si hay una versión con esa huella, o None."""
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute('SELECT * FROM report_cache WHERE report_id = ? AND quality = ?',
+                               (report_id, quality)).fetchone()
+            if not row or row['fingerprint'] != fingerprint:
+                conn.close()
+                return None
+            try:
+                with open(row['path'], 'rb') as f:
+                    data = f.read()
+            except FileNotFoundError:
+                conn.execute('DELETE FROM report_cache WHERE report_id = ? AND quality = ?', (report_id, quality))
+                conn.commit()
+                conn.close()
+                return None
+            conn.execute('UPDATE report_cache SET last_access = ? WHERE report_id = ? AND quality = ?',
+                         (time.time(), report_id, quality))
+            conn.commit()
+            conn.close()
+            return data
+
+    def put(self, report_id, quality, fingerprint, patient_id, capture_ids, pdf_bytes):
+        path = os.path.join(self.cache_dir, f"{report_id}_{quality}_{fingerprint[:16]}.pdf")
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(pdf_bytes)
+        os.replace(tmp_path, path)
+        with self._lock:
+            conn = self._connect()
+            old = conn.execute('SELECT path FROM report_cache WHERE report_id = ? AND quality = ?',
+                               (report_id, quality)).fetchone()
+            if old and old['path'] != path:
+                self._remove_file(old['path'])
+            conn.execute('''
+                INSERT OR REPLACE INTO report_cache
+                    (report_id, quality, fingerprint, patient_id, capture_ids, path, size, last_access)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (report_id, quality, fingerprint, patient_id, json.dumps(list(capture_ids)), path,
+                  len(pdf_bytes), time.time()))
+            conn.commit()
+            self._evict(conn)
+            conn.close()
+
+    def _evict(self, conn):
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM report_cache').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for row in conn.execute('SELECT report_id, quality, path, size FROM report_cache ORDER BY last_access').fetchall():
+            if total <= self.max_bytes:
+                break
+            self._remove_file(row['path'])
+            conn.execute('DELETE FROM report_cache WHERE report_id = ? AND quality = ?', (row['report_id'], row['quality']))
+            total -= row['size']
+        conn.commit()
+
+    def _delete_where(self, where, params):
+        with self._lock:
+            conn = self._connect()
+            rows = conn.execute(f'SELECT path FROM report_cache WHERE {where}', params).fetchall()
+            for row in rows:
+                self._remove_file(row['path'])
+            conn.execute(f'DELETE FROM report_cache WHERE {where}', params)
+            conn.commit()
+            conn.close()
+
+    def invalidate_report(self, report_id):
+        self._delete_where('report_id = ?', (report_id,))
+
+    def invalidate_patient(self, patient_id):
+        self._delete_where('patient_id = ?', (patient_id,))
+
+    def invalidate_capture(self, capture_id):
+        self._delete_where('EXISTS (SELECT 1 FROM json_each(capture_ids) WHERE value = ?)', (capture_id,))
+
+    @staticmethod
+    def _remove_file(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,346 @@
+# report_images.py (Descarga concurrente y caché local de las imágenes de los informes)
+
+import hashlib
+import io
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from urllib.parse import urlparse, unquote
+
+import requests
+from PIL import Image
+from requests.adapters import HTTPAdapter
+
+import annotation_render
+import derivatives
+import metrics
+
+CACHE_DIR = 'image_cache'
+MAX_BYTES = 1024 * 1024 * 1024
+MAX_AGE = 30 * 24 * 3600  # Entradas sin usar durante este tiempo se borran aunque haya sitio
+EVICT_INTERVAL = 300  # Segundos entre recorridos de la caché para expulsar entradas
+STALE_TEMP_AGE = 3600  # Temporales y .lock sin entrada más antiguos que esto son restos de un fallo
+MAX_WORKERS = 6
+TIMEOUT = (5, 30)  # (conexión, lectura) en segundos
+
+# Resolución y calidad JPEG de las imágenes incrustadas en el PDF, según ?quality=.
+# 'original' incrusta la imagen tal como está en Storage.
+QUALITY_PRESETS = {
+    'baja': {'dpi': 100, 'jpeg_quality': 60},
+    'media': {'dpi': 150, 'jpeg_quality': 75},
+    'alta': {'dpi': 300, 'jpeg_quality': 90},
+    'original': None,
+}
+DEFAULT_QUALITY = 'media'
+
+try:
+    import fcntl
+except ImportError:  # Windows: sin bloqueo entre procesos, cada uno genera su copia.
+    fcntl = None
+
+IMAGE_CACHE_LOOKUPS = metrics.counter('linfo_image_cache_lookups_total',
+                                      'Consultas a la caché local de imágenes.', ('result',))
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """Sesión HTTP compartida, con pool de conexiones reutilizables."""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=MAX_WORKERS, max_retries=2)
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+        return _session
+
+
+def storage_path_from_url(url):
+    """Extrae la ruta del blob de una URL pública de Storage (sin el bucket)."""
+    path = unquote(urlparse(url).path).lstrip('/')
+    return path.split('/', 1)[1] if '/' in path else path
+
+
+class ImageCache:
+    """Caché en disco de imágenes, agrupada por la ruta de la captura en Storage.
+
+    Cada ruta tiene su directorio, con el original y sus variantes ('variant':
+    reducciones para el PDF, anotaciones compuestas, miniaturas), así que purge()
+    borra todo lo de una captura. Cada lectura renueva la fecha de modificación
+    del archivo; si el total pasa de 'max_bytes' se borran las entradas usadas
+    hace más tiempo, y las que llevan 'max_age' sin usarse aunque haya sitio.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=MAX_BYTES, max_age=MAX_AGE, evict_interval=EVICT_INTERVAL):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.evict_interval = evict_interval
+        self._written = 0
+        self._last_evict = 0.0
+        self._evict_lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _dir(self, storage_path):
+        digest = hashlib.sha256(storage_path.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], digest[2:])
+
+    def _path(self, storage_path, variant=''):
+        name = hashlib.sha256(variant.encode('utf-8')).hexdigest()[:32] if variant else 'original'
+        return os.path.join(self._dir(storage_path), name)
+
+    def get(self, storage_path, variant=''):
+        path = self._path(storage_path, variant)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        try:
+            os.utime(path)  # Orden LRU de la expulsión
+        except OSError:
+            pass
+        return data
+
+    def put(self, storage_path, data, variant=''):
+        path = self._path(storage_path, variant)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Los procesos de los pools (miniaturas, exportación de informes) escriben en la
+        # misma caché: el nombre temporal lleva el proceso además del hilo.
+        tmp_path = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self._written += len(data)
+        self._maybe_evict()
+
+    def purge(self, storage_path):
+        """Borra la imagen de 'storage_path' y todas sus variantes (p. ej. al borrar la captura)."""
+        shutil.rmtree(self._dir(storage_path), ignore_errors=True)
+
+    @contextmanager
+    def lock(self, storage_path, variant=''):
+        """Bloqueo de una entrada entre hilos y procesos (flock), para que solo uno la genere."""
+        path = self._path(storage_path, variant)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        lock_file = open(f"{path}.lock", 'w')
+        try:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+        finally:
+            lock_file.close()  # Cerrar libera el flock
+
+    def get_or_create(self, storage_path, create, variant=''):
+        """Entrada de la caché; si falta, la genera create() una sola vez aunque la pidan
+        varios procesos a la vez (p. ej. dos informes con la misma captura en el pool)."""
+        data = self.get(storage_path, variant)
+        if data is not None:
+            return data
+        with self.lock(storage_path, variant):
+            # Otro proceso pudo generarla mientras esperábamos el lock.
+            data = self.get(storage_path, variant)
+            if data is None:
+                data = create()
+                self.put(storage_path, data, variant)
+        return data
+
+    # --- Expulsión ---
+
+    def _maybe_evict(self):
+        now = time.time()
+        if now - self._last_evict < self.evict_interval and self._written < self.max_bytes // 10:
+            return
+        if not self._evict_lock.acquire(blocking=False):
+            return
+        try:
+            self._last_evict, self._written = now, 0
+            with open(os.path.join(self.cache_dir, '.evict.lock'), 'w') as lock_file:
+                if fcntl:
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except OSError:
+                        return  # Otro proceso ya está recorriendo la caché
+                self.evict(now)
+        except OSError as e:
+            print(f"Error al limpiar la caché de imágenes: {e}")
+        finally:
+            self._evict_lock.release()
+
+    def evict(self, now=None):
+        """Borra las entradas caducadas y, si aún se pasa de 'max_bytes', las menos usadas.
+
+        Con cada entrada se va su .lock; los .lock y temporales sueltos de un fallo
+        también se borran. Retorna (entradas borradas, bytes que quedan).
+        """
+        now = time.time() if now is None else now
+        entries, removed = [], 0
+        for root, _dirs, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if root == self.cache_dir:
+                    continue  # .evict.lock
+                if name.endswith('.tmp'):
+                    if now - stat.st_mtime > STALE_TEMP_AGE:
+                        self._remove(path)
+                    continue
+                if name.endswith('.lock'):
+                    # El .lock de una entrada que existe se borra junto con ella.
+                    if now - stat.st_mtime > STALE_TEMP_AGE and not os.path.exists(path[:-len('.lock')]):
+                        self._remove(path)
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for mtime, size, path in entries:
+            if total <= self.max_bytes and now - mtime <= self.max_age:
+                continue
+            self._remove(path)
+            self._remove(f"{path}.lock")
+            total -= size
+            removed += 1
+        # Directorios de capturas que se quedaron vacíos.
+        for root, dirs, files in os.walk(self.cache_dir, topdown=False):
+            if root != self.cache_dir and not dirs and not files:
+                try:
+                    os.rmdir(root)
+                except OSError:
+                    pass
+        return removed, total
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+_cache = None
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        _cache = ImageCache()
+    return _cache
+
+
+def fetch_image(url):
+    """Devuelve los bytes de la imagen, desde la caché local o descargándola."""
+    cache = get_cache()
+    storage_path = storage_path_from_url(url)
+    data = cache.get(storage_path)
+    if data is not None:
+        IMAGE_CACHE_LOOKUPS.inc(result='hit')
+        return data
+    IMAGE_CACHE_LOOKUPS.inc(result='miss')
+
+    def download():
+        with metrics.span('storage', 'download'):
+            response = get_session().get(url, timeout=TIMEOUT)
+            response.raise_for_status()
+        return response.content
+    return cache.get_or_create(storage_path, download)
+
+
+def fetch_annotated_image(url, annotation_json, max_side=None):
+    """Captura original con la anotación vectorial compuesta encima.
+
+    Se cachea por ruta y huella de la anotación: editar la anotación cambia
+    la clave y la versión anterior simplemente deja de usarse. Con 'max_side'
+    retorna la miniatura de ese tamaño.
+    """
+    cache = get_cache()
+    storage_path = storage_path_from_url(url)
+    variant = f"annotation-{annotation_render.annotation_hash(annotation_json)}"
+    if max_side:
+        return cache.get_or_create(storage_path, lambda: derivatives.resize_image(
+            fetch_annotated_image(url, annotation_json), max_side), variant=f"{variant}@{max_side}px")
+    return cache.get_or_create(storage_path, lambda: annotation_render.composite(fetch_image(url), annotation_json),
+                               variant=variant)
+
+
+def fetch_source_image(url, annotation_json=None):
+    if annotation_json:
+        return fetch_annotated_image(url, annotation_json)
+    return fetch_image(url)
+
+
+def downscale_for_pdf(image_bytes, width_mm, dpi, jpeg_quality):
+    """Reduce la imagen a los píxeles que necesita 'width_mm' a 'dpi' y la pasa a JPEG."""
+    target_width = max(1, round(width_mm / 25.4 * dpi))
+    img = Image.open(io.BytesIO(image_bytes))
+    target_size = (target_width, max(1, round(img.height * target_width / img.width)))
+    if img.width > target_width:
+        # En JPEG, draft() decodifica ya reducido (escalado DCT), mucho más rápido.
+        img.draft('RGB', target_size)
+    # Se pasa a RGB antes de reducir: LANCZOS no se aplica a imágenes con paleta (P).
+    if img.mode in ('RGBA', 'LA', 'P'):
+        # Las anotaciones son PNG con transparencia: se aplanan sobre fondo blanco.
+        img = img.convert('RGBA')
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel('A'))
+        img = background
+    elif img.mode != 'RGB':
+        img = img.convert('RGB')
+    if img.width > target_width:
+        img = img.resize(target_size, Image.LANCZOS)
+    output = io.BytesIO()
+    img.save(output, format='JPEG', quality=jpeg_quality, optimize=True)
+    return output.getvalue()
+
+
+def fetch_report_image(url, width_mm, quality=DEFAULT_QUALITY, annotation_json=None):
+    """Imagen lista para incrustar en el PDF, reducida según el preset de calidad.
+
+    La versión reducida también se guarda en la caché, así que regenerar un
+    informe no vuelve a descargar ni a recomprimir nada.
+    """
+    preset = QUALITY_PRESETS.get(quality)
+    if preset is None:
+        return fetch_source_image(url, annotation_json)
+    cache = get_cache()
+    variant = f"{width_mm:.1f}mm-{preset['dpi']}dpi-q{preset['jpeg_quality']}"
+    if annotation_json:
+        variant += f"#annotation-{annotation_render.annotation_hash(annotation_json)}"
+    return cache.get_or_create(storage_path_from_url(url), lambda: downscale_for_pdf(
+        fetch_source_image(url, annotation_json), width_mm, preset['dpi'], preset['jpeg_quality']), variant=variant)
+
+
+def fetch_images(urls, width_mm=None, quality='original', annotations=None):
+    """Descarga varias imágenes en paralelo. Retorna {url: bytes}; omite las que fallan.
+
+    Con 'width_mm' las imágenes se reducen para el PDF según el preset 'quality'.
+    'annotations' ({url: JSON de Fabric}) indica qué imágenes llevan una anotación
+    vectorial que hay que componer encima.
+    Cada URL se procesa una sola vez, así que una imagen repetida produce
+    exactamente los mismos bytes y fpdf2 la incrusta una única vez.
+    """
+    unique_urls = list(dict.fromkeys(u for u in urls if u))
+    annotations = annotations or {}
+    results = {}
+
+    def fetch(url):
+        try:
+            if width_mm:
+                return url, fetch_report_image(url, width_mm, quality, annotations.get(url))
+            return url, fetch_source_image(url, annotations.get(url))
+        except Exception as e:
+            print(f"Error al descargar la imagen {url}: {e}")
+            return url, None
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        for url, data in executor.map(fetch, unique_urls):
+            if data is not None:
+                results[url] = data
+    return results
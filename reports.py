@@ -0,0 +1,189 @@
+# reports.py (Informes PDF: armado del documento y ZIP de la exportación masiva)
+#
+# build_report_pdf no depende de Flask ni de Firestore: recibe los documentos ya leídos,
+# así que lo ejecutan tanto /generate_report como los procesos del pool de la exportación
+# masiva. Las imágenes salen de la caché en disco de report_images, que comparten todos
+# los procesos: una captura que aparece en varios informes se descarga y se reduce una vez.
+
+import csv
+import io
+import os
+import zipfile
+
+from fpdf import FPDF
+from fpdf.enums import XPos, YPos
+
+import annotation_render
+import report_images
+
+
+class PDF(FPDF):
+    def header(self):
+        self.set_font('Helvetica', 'B', 16)
+        self.cell(0, 10, 'LINFOFLUOROSCOPIA', align='C', new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+        self.ln(5)
+
+    def footer(self):
+        self.set_y(-15)
+        self.set_font('Helvetica', 'I', 8)
+        self.cell(0, 10, f'Página {self.page_no()}', align='C')
+
+    def chapter_title(self, title):
+        self.set_font('Helvetica', 'B', 12)
+        self.cell(0, 10, title, new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+        self.ln(4)
+
+    def chapter_body(self, name, data):
+        y_before = self.get_y()
+        self.set_font('Helvetica', 'B', 11)
+        self.multi_cell(40, 10, name, border=1, new_x="RIGHT", new_y="TOP")
+        self.set_y(y_before)
+        self.set_x(self.l_margin + 40)
+        self.set_font('Helvetica', '', 11)
+        available_width = self.w - self.l_margin - self.r_margin - 40
+        self.multi_cell(available_width, 10, data, border=1, new_x="LMARGIN", new_y="NEXT")
+
+
+def capture_image_source(capture_data):
+    """(url, annotation_json) de la imagen a mostrar de una captura.
+
+    Una anotación raster tiene su propia URL; una vectorial se compone sobre la
+    original (annotation_json no es None).
+    """
+    if capture_data.get('annotated_url'):
+        return capture_data['annotated_url'], None
+    annotation_json = capture_data.get('annotation_data')
+    if capture_data.get('annotation_hash') and annotation_json and annotation_render.has_objects(annotation_json):
+        return capture_data.get('cloud_url'), annotation_json
+    return capture_data.get('cloud_url'), None
+
+
+def build_report_pdf(report_data, patient_data, captures_by_id, quality):
+    """Arma el PDF del informe con los datos ya leídos de Firestore."""
+    pdf = PDF()
+    pdf.add_page()
+
+    pdf.chapter_title('Datos del Paciente')
+    pdf.chapter_body('Nombre:', f"{patient_data.get('nombre', '')} {patient_data.get('apellido', '')}")
+    pdf.chapter_body('Cédula:', patient_data.get('cedula', 'N/A'))
+    fecha_informe = report_data.get('analysis_date')
+    if fecha_informe:
+        pdf.chapter_body('Fecha del Informe:', fecha_informe.strftime('%d-%m-%Y'))
+
+    pdf.ln(10)
+
+    extremidad_str = ', '.join(report_data.get('extremidad', []))
+    hallazgos_str = ', '.join(report_data.get('hallazgos', []))
+    observaciones_str = report_data.get('conclusiones', '')
+
+    pdf.chapter_title('Resultados del Estudio')
+    pdf.chapter_body('Extremidad:', extremidad_str if extremidad_str else ' ')
+    pdf.chapter_body('Hallazgos:', hallazgos_str if hallazgos_str else ' ')
+    pdf.chapter_body('Observaciones:', observaciones_str if observaciones_str else ' ')
+
+    selected_captures_ids = report_data.get('selected_captures', [])
+    if selected_captures_ids:
+        pdf.add_page()
+        pdf.chapter_title('Imágenes Anexas')
+
+        # Descargas en paralelo (con caché local) y ya reducidas para el PDF.
+        sources = [capture_image_source(c) for c in captures_by_id.values()]
+        image_urls = [url for url, _ in sources]
+        annotations = {url: annotation for url, annotation in sources if annotation}
+        image_width = pdf.w - 20
+        images = report_images.fetch_images(image_urls, width_mm=image_width, quality=quality, annotations=annotations)
+
+        for capture_id in selected_captures_ids:
+            capture_data = captures_by_id.get(capture_id)
+            if capture_data:
+                image_url_to_use, _ = capture_image_source(capture_data)
+                if image_url_to_use:
+                    image_bytes = images.get(image_url_to_use)
+                    if image_bytes:
+                        img_stream = io.BytesIO(image_bytes)
+                        pdf.image(img_stream, w=image_width)
+                        pdf.set_font('Helvetica', 'I', 9)
+                        timestamp = capture_data.get('timestamp')
+                        if timestamp:
+                            pdf.cell(0, 10, f"Captura de {capture_data.get('study_area', '')} - {timestamp.strftime('%d-%m-%Y %H:%M')}", align='C', new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+                        pdf.ln(5)
+
+    return pdf.output()
+
+
+def report_filename(report_id, patient_data):
+    """Nombre del PDF, el mismo que usa /generate_report para la descarga."""
+    apellido = (patient_data.get('apellido') or '').replace('/', '-').replace('\\', '-')
+    return f'informe_{apellido}_{report_id}.pdf'
+
+
+def render_report_file(report_id, report_data, patient_data, captures_by_id, quality, path):
+    """Para el pool de procesos de la exportación: arma el PDF y lo escribe en 'path'.
+
+    El PDF se escribe en disco desde el propio proceso, así que no vuelve al proceso
+    principal por el pipe del pool. Retorna (report_id, tamaño en bytes).
+    """
+    try:
+        pdf_bytes = build_report_pdf(report_data, patient_data, captures_by_id, quality)
+    except Exception as e:
+        # Algunas excepciones de fpdf2 (p. ej. un carácter que la fuente no tiene) no se
+        # pueden reconstruir en el proceso principal y dejarían el pool inservible.
+        raise RuntimeError(f"{type(e).__name__}: {e}") from None
+    with open(path, 'wb') as f:
+        f.write(pdf_bytes)
+    return report_id, len(pdf_bytes)
+
+
+class ExportArchive:
+    """ZIP de una exportación, escrito en disco a medida que llegan los PDF.
+
+    Se escribe en 'path'.tmp y se renombra al cerrarlo, así que nunca se sirve un ZIP
+    a medias. Los PDF ya van comprimidos y se guardan sin recomprimir. Al final se
+    añade indice.csv con una fila por informe, incluidos los que fallaron.
+    """
+
+    INDEX_NAME = 'indice.csv'
+    INDEX_HEADER = ['informe', 'paciente', 'cedula', 'fecha', 'archivo', 'estado']
+
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = f'{path}.tmp'
+        self._zip = zipfile.ZipFile(self.tmp_path, 'w', compression=zipfile.ZIP_STORED, allowZip64=True)
+        self._index = io.StringIO()
+        self._writer = csv.writer(self._index)
+        self._writer.writerow(self.INDEX_HEADER)
+
+    def add(self, report_id, report_data, patient_data, pdf_path=None, pdf_bytes=None, error=None):
+        """Añade el PDF de un informe (desde un archivo o desde memoria) y su fila del índice.
+
+        Sin PDF (p. ej. si falló), solo queda la fila con el error.
+        """
+        name = report_filename(report_id, patient_data)
+        if pdf_path is not None:
+            self._zip.write(pdf_path, name)
+        elif pdf_bytes is not None:
+            self._zip.writestr(name, pdf_bytes)
+        else:
+            name = ''
+        fecha = report_data.get('analysis_date')
+        self._writer.writerow([
+            report_id,
+            f"{patient_data.get('nombre', '')} {patient_data.get('apellido', '')}".strip(),
+            patient_data.get('cedula', ''),
+            fecha.strftime('%Y-%m-%d') if fecha else '',
+            name,
+            f'error: {error}' if error else 'ok',
+        ])
+
+    def close(self):
+        # Con BOM, para que Excel lo abra como UTF-8.
+        self._zip.writestr(self.INDEX_NAME, '\ufeff' + self._index.getvalue())
+        self._zip.close()
+        os.replace(self.tmp_path, self.path)
+
+    def discard(self):
+        self._zip.close()
+        try:
+            os.remove(self.tmp_path)
+        except OSError:
+            pass
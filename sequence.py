@@ -0,0 +1,441 @@
+# sequence.py (Secuencias de ICG: búfer circular de la vista previa y curvas tiempo-intensidad)
+#
+# Mientras alguien mira el stream se guarda la luminancia reducida de la vista previa en
+# un búfer circular preasignado (un único array uint8 de frames x alto x ancho, no una
+# lista de JPEG), así que el doctor puede guardar "los últimos N segundos" después de ver
+# pasar el bolo de ICG. También se puede grabar a intervalo fijo durante un estudio.
+# La secuencia guardada se vuelca a un .npy mapeado en memoria en el disco; las curvas
+# tiempo-intensidad de todas las regiones de interés salen de una multiplicación de
+# matrices por bloques de frames, y se sube un único .npz con las curvas, las proyecciones
+# y las características de cada curva en lugar de cientos de capturas sueltas.
+
+import io
+import math
+import os
+import threading
+import time
+import uuid
+
+import numpy as np
+from PIL import Image
+
+import fluorescence
+import metrics
+
+SAMPLE_FPS = 5  # Frames por segundo que se guardan (el bolo de ICG tarda segundos en llegar)
+BUFFER_SECONDS = int(os.environ.get('LINFO_SEQUENCE_SECONDS', '60'))
+FRAME_MAX_SIDE = 320  # 60 s a 5 fps de 320x240 son 23 MB
+MAX_RECORDING_FRAMES = 3600
+MIN_INTERVAL = 1.0 / SAMPLE_FPS
+SPOOL_DIR = 'sequence_spool'
+CURVE_CHUNK = 64  # Frames por bloque: acota la memoria al leer la secuencia del disco
+BASELINE_FRACTION = 0.05  # Los primeros frames, antes de que llegue el contraste, dan la línea base
+ARRIVAL_FRACTION = 0.1  # La llegada es el primer frame que supera el 10 % de la subida
+MIN_RISE = 2.0  # Subidas menores (en niveles de gris) son ruido: sin tiempo de llegada
+ARTIFACT_VERSION = 1
+
+SEQUENCE_FRAMES = metrics.counter('linfo_sequence_frames_total',
+                                  'Frames de la vista previa guardados en el búfer de secuencias.')
+SEQUENCE_BUILD_SECONDS = metrics.histogram('linfo_sequence_build_seconds',
+                                           'Cálculo de las curvas y el .npz de una secuencia.', (),
+                                           buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0))
+
+
+def decode_preview(jpeg, max_side=FRAME_MAX_SIDE):
+    """Luminancia (uint8) de un frame de la vista previa, reducida a 'max_side' como mucho.
+
+    A diferencia de fluorescence.decode_intensity se pide a draft() el tamaño final:
+    la vista previa de 640x480 queda en 320x240 ya en el decodificador.
+    """
+    img = Image.open(io.BytesIO(jpeg))
+    scale = max_side / max(img.size)
+    if scale < 1:
+        img.draft('L', (math.ceil(img.width * scale), math.ceil(img.height * scale)))
+    img = img.convert('L')
+    if max(img.size) > max_side:
+        scale = max_side / max(img.size)
+        img = img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))), Image.BILINEAR)
+    return np.asarray(img)
+
+
+def open_spill(spool_dir, count, shape):
+    """Crea un .npy mapeado en memoria para 'count' frames. Retorna (ruta, array)."""
+    os.makedirs(spool_dir, exist_ok=True)
+    path = os.path.join(spool_dir, f'{uuid.uuid4().hex}.npy')
+    return path, np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=(count,) + tuple(shape))
+
+
+class Sequence:
+    """Secuencia guardada: frames en un .npy del disco y la hora de cada uno."""
+
+    def __init__(self, path, frames, times, mode, interval):
+        self.path = path
+        self.frames = frames
+        self.times = times
+        self.mode = mode
+        self.interval = interval
+
+    @property
+    def count(self):
+        return len(self.times)
+
+    @property
+    def duration(self):
+        return float(self.times[-1] - self.times[0]) if self.count else 0.0
+
+    def discard(self):
+        """Suelta el mapeo y borra el archivo (cuando el .npz ya está en la cola de subidas)."""
+        self.frames = None  # El mapeo se libera con la última referencia; el archivo ya se puede borrar
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class FrameRing:
+    """Búfer circular de frames de luminancia en un array preasignado."""
+
+    def __init__(self, capacity, shape):
+        self.capacity = capacity
+        self.shape = tuple(shape)
+        self.frames = np.empty((capacity,) + self.shape, dtype=np.uint8)
+        self.times = np.zeros(capacity, dtype=np.float64)
+        self.count = 0
+        self.head = 0  # Posición del próximo frame
+        self.lock = threading.Lock()
+
+    def push(self, frame, timestamp):
+        with self.lock:
+            self.frames[self.head] = frame
+            self.times[self.head] = timestamp
+            self.head = (self.head + 1) % self.capacity
+            self.count = min(self.count + 1, self.capacity)
+
+    def clear(self):
+        with self.lock:
+            self.count = 0
+            self.head = 0
+
+    def seconds(self):
+        with self.lock:
+            if self.count < 2:
+                return 0.0
+            return float(self.times[(self.head - 1) % self.capacity] - self.times[(self.head - self.count) % self.capacity])
+
+    def spill(self, since, spool_dir):
+        """Copia al disco, en orden, los frames con hora >= 'since'. Retorna (ruta, frames, horas)."""
+        with self.lock:
+            start = (self.head - self.count) % self.capacity
+            order = (start + np.arange(self.count)) % self.capacity
+            count = self.count - int(np.searchsorted(self.times[order], since))
+            if count <= 0:
+                return None, None, None
+            first = (self.head - count) % self.capacity
+            path, stack = open_spill(spool_dir, count, self.shape)
+            # Los frames ocupan como mucho dos tramos contiguos del anillo.
+            tail = min(count, self.capacity - first)
+            stack[:tail] = self.frames[first:first + tail]
+            stack[tail:] = self.frames[:count - tail]
+            times = np.concatenate([self.times[first:first + tail], self.times[:count - tail]])
+        stack.flush()
+        return path, stack, times
+
+
+class Recording:
+    """Grabación a intervalo fijo: escribe cada frame directamente en el .npy del disco."""
+
+    def __init__(self, spool_dir, shape, interval, duration, on_complete):
+        self.interval = interval
+        self.duration = duration
+        self.on_complete = on_complete
+        self.capacity = min(MAX_RECORDING_FRAMES, int(duration / interval) + 1)
+        self.shape = tuple(shape)
+        self.path, self.stack = open_spill(spool_dir, self.capacity, shape)
+        self.times = np.zeros(self.capacity, dtype=np.float64)
+        self.count = 0
+        self.next_due = 0.0  # El primer frame que llegue se guarda
+        self.started = time.time()
+        self.finished = threading.Event()
+        self.lock = threading.Lock()
+        self.result = None
+        self.error = None
+        self.thread = None
+
+    def add(self, frame, timestamp):
+        with self.lock:
+            # Medio periodo de muestreo de margen: el búfer toma frames cada ~1/SAMPLE_FPS s con cierta holgura.
+            if self.stack is None or timestamp < self.next_due - MIN_INTERVAL / 2 or frame.shape != self.shape:
+                return
+            # Llena: el hilo de la grabación aún no la ha cerrado y no hay sitio en el memmap.
+            if self.count >= self.capacity:
+                return
+            self.stack[self.count] = frame
+            self.times[self.count] = timestamp
+            self.count += 1
+            # Rejilla fija desde el primer frame; tras un hueco se vuelve a anclar sin recuperar los perdidos.
+            self.next_due += self.interval
+            if self.next_due < timestamp:
+                self.next_due = timestamp + self.interval
+            if self.count >= self.capacity:
+                self.finished.set()
+
+    def to_sequence(self):
+        with self.lock:
+            stack, self.stack = self.stack, None
+        stack.flush()
+        return Sequence(self.path, stack[:self.count], self.times[:self.count].copy(), 'interval', self.interval)
+
+    def status(self):
+        return {'frames': self.count, 'capacity': self.capacity, 'interval': self.interval,
+                'duration': self.duration, 'elapsed': round(time.time() - self.started, 1),
+                'finished': self.finished.is_set(), 'result': self.result, 'error': self.error}
+
+
+class SequenceRecorder:
+    """Búfer de los últimos segundos de un FrameBroadcaster y grabaciones a intervalo fijo.
+
+    El búfer solo se llena mientras el stream tiene clientes (no mantiene la cámara
+    activa por sí mismo); una grabación sí cuenta como cliente mientras dura.
+    """
+
+    def __init__(self, source, seconds=BUFFER_SECONDS, sample_fps=SAMPLE_FPS, max_side=FRAME_MAX_SIDE,
+                 spool_dir=SPOOL_DIR):
+        self.source = source
+        self.seconds = seconds
+        self.sample_fps = sample_fps
+        self.max_side = max_side
+        self.spool_dir = spool_dir
+        self.ring = None  # Se crea con el primer frame: su tamaño depende del stream
+        self.recording = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='sequence-buffer', daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self):
+        interval = 1.0 / self.sample_fps
+        sequence = 0
+        while True:
+            if not self.source.wait_for_clients(5.0):
+                # Sin nadie mirando, lo que hay en el búfer ya no es de este estudio.
+                if self.ring is not None:
+                    self.ring.clear()
+                continue
+            start = time.monotonic()
+            sequence, frame, timestamp = self.source.wait_for_new_frame(sequence, timeout=1.0)
+            if frame is None:
+                continue
+            try:
+                self._store(decode_preview(frame, self.max_side), timestamp)
+            except Exception as e:
+                print(f"Error al guardar un frame de la secuencia: {e}")
+            time.sleep(max(0.0, interval - (time.monotonic() - start)))
+
+    def _store(self, gray, timestamp):
+        ring = self.ring
+        if ring is None or ring.shape != gray.shape:
+            ring = self.ring = FrameRing(max(2, int(self.seconds * self.sample_fps)), gray.shape)
+        ring.push(gray, timestamp)
+        SEQUENCE_FRAMES.inc()
+        recording = self.recording
+        if recording is not None:
+            recording.add(gray, timestamp)
+
+    def save_last(self, seconds):
+        """Vuelca al disco los últimos 'seconds' del búfer. Retorna una Sequence o None si está vacío."""
+        if self.ring is None:
+            return None
+        path, frames, times = self.ring.spill(time.time() - seconds, self.spool_dir)
+        if path is None:
+            return None
+        return Sequence(path, frames, times, 'buffer', 1.0 / self.sample_fps)
+
+    def start_recording(self, interval, duration, on_complete):
+        """Graba un frame cada 'interval' segundos durante 'duration'.
+
+        Al terminar (por tiempo, por llenarse o con stop_recording) se llama a
+        on_complete(sequence) en el hilo de la grabación; lo que retorne queda en
+        'result'. Retorna el estado, o None si ya hay una grabación en curso.
+        """
+        interval = max(MIN_INTERVAL, float(interval))
+        shape = self.ring.shape if self.ring is not None else self._probe_shape()
+        with self._lock:
+            if self.recording is not None and not self.recording.finished.is_set():
+                return None
+            recording = self.recording = Recording(self.spool_dir, shape, interval, float(duration), on_complete)
+        recording.thread = threading.Thread(target=self._record, args=(recording,), name='sequence-recording',
+                                            daemon=True)
+        recording.thread.start()
+        return recording.status()
+
+    def _probe_shape(self):
+        """Tamaño de los frames reducidos cuando el búfer aún no tiene ninguno."""
+        with self.source.as_client():
+            frame = self.source.wait_for_frame(timeout=5)
+        if frame is None:
+            raise RuntimeError("La cámara no está enviando frames.")
+        return decode_preview(frame, self.max_side).shape
+
+    def _record(self, recording):
+        with self.source.as_client():
+            recording.finished.wait(recording.duration)
+        recording.finished.set()
+        sequence = recording.to_sequence()
+        try:
+            with SEQUENCE_BUILD_SECONDS.time():
+                recording.result = recording.on_complete(sequence)
+        except Exception as e:
+            recording.error = str(e)
+            print(f"Error al procesar la grabación de la secuencia: {e}")
+            sequence.discard()
+
+    def stop_recording(self, timeout=60):
+        """Termina la grabación en curso y espera a que se procese. Retorna su estado o None."""
+        recording = self.recording
+        if recording is None or recording.thread is None:
+            return None
+        recording.finished.set()
+        recording.thread.join(timeout)
+        return recording.status()
+
+    def status(self):
+        ring = self.ring
+        return {'buffered_seconds': round(ring.seconds(), 1) if ring else 0.0,
+                'buffered_frames': ring.count if ring else 0,
+                'buffer_capacity': ring.capacity if ring else int(self.seconds * self.sample_fps),
+                'frame_size': list(ring.shape[::-1]) if ring else None,
+                'recording': self.recording.status() if self.recording else None}
+
+
+# --- Curvas tiempo-intensidad ---
+
+def projections(frames, chunk=CURVE_CHUNK):
+    """Máximo y media de cada píxel a lo largo de la secuencia, por bloques de frames."""
+    peak = np.zeros(frames.shape[1:], dtype=np.uint8)
+    total = np.zeros(frames.shape[1:], dtype=np.float64)
+    for start in range(0, len(frames), chunk):
+        block = np.asarray(frames[start:start + chunk])
+        np.maximum(peak, block.max(axis=0), out=peak)
+        total += block.sum(axis=0, dtype=np.float64)
+    mean = np.rint(total / max(1, len(frames))).astype(np.uint8)
+    return peak, mean
+
+
+def _rect_mask(shape, rect):
+    height, width = shape
+    x0, y0, x1, y1 = (min(1.0, max(0.0, float(v))) for v in rect)
+    mask = np.zeros(shape, dtype=bool)
+    mask[int(y0 * height):math.ceil(y1 * height), int(x0 * width):math.ceil(x1 * width)] = True
+    return mask
+
+
+def regions_of_interest(peak, rois=None):
+    """Máscaras de las regiones de interés: el frame completo, las del doctor (rectángulos
+    normalizados [x0, y0, x1, y1]) y las automáticas a partir de la proyección máxima:
+    todo lo fluorescente y cada región de reflujo. Retorna (nombres, tipos, rects, máscaras, umbral)."""
+    shape = peak.shape
+    names, kinds, rects, masks = ['completa'], ['frame'], [[0.0, 0.0, 1.0, 1.0]], [np.ones(shape, dtype=bool)]
+    for index, roi in enumerate(rois or []):
+        rect = roi.get('rect') if isinstance(roi, dict) else roi
+        if not rect or len(rect) != 4:
+            continue
+        mask = _rect_mask(shape, rect)
+        if mask.any():
+            names.append(str(roi.get('name') if isinstance(roi, dict) and roi.get('name') else f'roi_{index + 1}'))
+            kinds.append('user')
+            rects.append([float(v) for v in rect])
+            masks.append(mask)
+
+    analysis = fluorescence.analyze_array(peak)
+    fluorescent = peak > analysis['threshold']
+    if fluorescent.any():
+        ys, xs = np.nonzero(fluorescent)
+        names.append('fluorescente')
+        kinds.append('fluorescent')
+        rects.append([float(xs.min()) / shape[1], float(ys.min()) / shape[0],
+                      float(xs.max() + 1) / shape[1], float(ys.max() + 1) / shape[0]])
+        masks.append(fluorescent)
+    for index, region in enumerate(analysis['regions']):
+        names.append(f'reflujo_{index + 1}')
+        kinds.append('backflow')
+        rects.append(region['bbox'])
+        masks.append(_rect_mask(shape, region['bbox']))
+    return names, kinds, np.array(rects, dtype=np.float32), np.stack(masks), analysis['threshold']
+
+
+def time_intensity_curves(frames, masks, chunk=CURVE_CHUNK):
+    """Intensidad media de cada región en cada frame: (frames x píxeles) @ (píxeles x regiones).
+
+    Las máscaras se normalizan por su área, así que una sola multiplicación de matrices
+    por bloque de frames da todas las medias a la vez.
+    """
+    weights = masks.reshape(len(masks), -1).T.astype(np.float32)
+    weights /= weights.sum(axis=0)
+    curves = np.empty((len(frames), len(masks)), dtype=np.float32)
+    for start in range(0, len(frames), chunk):
+        block = np.asarray(frames[start:start + chunk])
+        curves[start:start + len(block)] = block.reshape(len(block), -1).astype(np.float32) @ weights
+    return curves
+
+
+def curve_features(curves, times):
+    """Línea base, pico, tiempo al pico, tiempo de llegada y pendiente máxima de cada curva."""
+    count = len(times)
+    baseline = curves[:max(1, int(count * BASELINE_FRACTION))].mean(axis=0)
+    peak_index = curves.argmax(axis=0)
+    peak = curves.max(axis=0)
+    rise = peak - baseline
+    arrival_index = (curves >= baseline + ARRIVAL_FRACTION * rise).argmax(axis=0)
+    if count > 1:
+        slopes = np.diff(curves, axis=0) / np.maximum(np.diff(times), 1e-3)[:, None]
+        max_slope = slopes.max(axis=0)
+    else:
+        max_slope = np.zeros(curves.shape[1], dtype=np.float32)
+    return {'baseline': baseline, 'peak': peak, 'rise': rise, 'time_to_peak': times[peak_index],
+            'arrival': np.where(rise >= MIN_RISE, times[arrival_index], np.nan), 'max_slope': max_slope}
+
+
+def _rounded(value, digits=2):
+    value = float(value)
+    return None if math.isnan(value) else round(value, digits)
+
+
+def build_artifact(sequence, rois=None):
+    """Calcula las curvas de la secuencia. Retorna (bytes del .npz, campos del documento)."""
+    times = np.asarray(sequence.times, dtype=np.float64)
+    relative = (times - times[0]).astype(np.float32)
+    peak, mean = projections(sequence.frames)
+    names, kinds, rects, masks, threshold = regions_of_interest(peak, rois)
+    curves = time_intensity_curves(sequence.frames, masks)
+    features = curve_features(curves, relative)
+
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, version=np.int32(ARTIFACT_VERSION), start_time=np.float64(times[0]),
+                        times=relative, curves=curves, roi_names=np.array(names), roi_kinds=np.array(kinds),
+                        roi_rects=rects, threshold=np.int32(threshold), peak_projection=peak,
+                        mean_projection=mean, **{key: np.asarray(value, dtype=np.float32)
+                                                 for key, value in features.items()})
+    summary = {
+        'artifact_version': ARTIFACT_VERSION,
+        'mode': sequence.mode,
+        'interval': round(sequence.interval, 3),
+        'frame_count': sequence.count,
+        'duration': round(sequence.duration, 2),
+        'frame_size': [int(peak.shape[1]), int(peak.shape[0])],
+        'rois': [{'name': names[i], 'kind': kinds[i], 'rect': [round(float(v), 4) for v in rects[i]],
+                  'baseline': _rounded(features['baseline'][i], 1), 'peak': _rounded(features['peak'][i], 1),
+                  'time_to_peak': _rounded(features['time_to_peak'][i]),
+                  'arrival': _rounded(features['arrival'][i]),
+                  'max_slope': _rounded(features['max_slope'][i])} for i in range(len(names))],
+    }
+    return buffer.getvalue(), summary
+
+
+def load_artifact(data):
+    """Lee un .npz de secuencia. Retorna un diccionario de arrays."""
+    with np.load(io.BytesIO(data)) as archive:
+        return {key: archive[key] for key in archive.files}
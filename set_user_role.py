@@ -9,8 +9,11 @@ def set_role(email, role):
     """Asigna un rol a un usuario de Firebase por su email."""
     try:
         user = auth.get_user_by_email(email)
-        # El segundo argumento de set_custom_user_claims es un diccionario
-        auth.set_custom_user_claims(user.uid, {'role': role})
+        # set_custom_user_claims reemplaza todos los claims: se conserva 'team_id',
+        # que la app usa junto con 'role' para abrir la sesión sin leer Firestore.
+        claims = dict(user.custom_claims or {})
+        claims['role'] = role
+        auth.set_custom_user_claims(user.uid, claims)
         print(f"Éxito: El rol '{role}' fue asignado a {email}.")
     except Exception as e:
         print(f"Error: {e}")
@@ -0,0 +1,350 @@
+# stream_relay.py (Relé del stream de las Pi: una conexión por dispositivo, muchos navegadores)
+#
+# En el VPS no hay cámara: /stream/video_feed abre una sola conexión MJPEG con la Pi
+# elegida y reparte cada frame a todos los navegadores con un FrameBroadcaster (mismo
+# objeto de bytes para todos; un cliente lento se salta frames sin frenar a los demás).
+# /stream/capture se reenvía a la Pi por un pool de conexiones HTTP persistentes.
+#
+# La Pi no comparte la sesión del navegador: el relé le pasa el usuario en X-Relay-User,
+# firmado con HMAC usando el hash de la clave del dispositivo (lo conocen los dos lados).
+#
+# La dirección de la Pi llega en su latido, así que no se confía en ella: solo se conecta
+# a IP privadas de la LAN en el puerto fijo o a los túneles configurados, sin seguir
+# redirecciones, y de /stream/capture y /stream/sequence solo se devuelve un objeto JSON.
+
+import hashlib
+import hmac
+import http.cookiejar
+import ipaddress
+import json
+import os
+import re
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlsplit
+
+import metrics
+from streaming import AdaptiveStream, FrameBroadcaster
+
+DEVICE_PORT = 5000
+CONNECT_TIMEOUT = 3
+READ_TIMEOUT = 10  # Sin frames de la Pi durante este tiempo, se reconecta
+CAPTURE_TIMEOUT = (CONNECT_TIMEOUT, 30)  # La captura en alta resolución tarda más que un frame
+LINGER_SECONDS = 10  # Mantiene la conexión con la Pi un rato tras irse el último navegador
+RECONNECT_DELAY = 1.0
+MAX_RECONNECT_DELAY = 15.0
+SIGNATURE_MAX_AGE = 60
+CHUNK_SIZE = 64 * 1024
+MAX_PART_BYTES = 8 * 1024 * 1024  # Si no aparece el separador en este tamaño, el stream está corrupto
+MAX_REPLY_BYTES = 256 * 1024  # Las respuestas de /capture y /sequence/* de la Pi son JSON pequeños
+# Redes en las que puede estar una Pi (sin loopback ni link-local, donde están los metadatos de la nube).
+LAN_NETWORKS = [ipaddress.ip_network(net) for net in ('10.0.0.0/8', '172.16.0.0/12', '192.168.0.0/16', 'fc00::/7')]
+# Hosts de túnel (LINFO_TUNNEL_HOSTS, separados por comas) aceptados como stream_url;
+# ".dominio" acepta cualquier subdominio.
+TUNNEL_HOSTS = [host.strip().lower() for host in os.environ.get('LINFO_TUNNEL_HOSTS', '').split(',') if host.strip()]
+
+RELAY_CONNECTIONS = metrics.counter('linfo_relay_upstream_connections_total',
+                                    'Conexiones abiertas con el stream de una Pi.', ('device', 'result'))
+RELAY_FRAMES = metrics.counter('linfo_relay_upstream_frames_total',
+                               'Frames recibidos de la Pi.', ('device',))
+RELAY_LATENCY_SECONDS = metrics.histogram('linfo_relay_upstream_latency_seconds',
+                                          'Desde que la Pi publica un frame hasta que llega al relé '
+                                          '(depende de que los relojes estén sincronizados).', ('device',),
+                                          buckets=(0.01, 0.025, 0.05, 0.1, 0.2, 0.35, 0.5, 1.0, 2.0, 5.0))
+RELAY_ERRORS = metrics.counter('linfo_relay_errors_total',
+                               'Errores del relé (conexión perdida, stream corrupto).', ('device', 'kind'))
+
+_BOUNDARY_RE = re.compile(r'boundary="?([^";]+)"?')
+
+
+# --- Firma del usuario reenviado ---
+
+def _signature(secret, timestamp, user_json):
+    return hmac.new(secret.encode('utf-8'), f'{timestamp}.{user_json}'.encode('utf-8'), hashlib.sha256).hexdigest()
+
+
+def sign_user(user, secret, now=None):
+    """Cabeceras que identifican al usuario ante la Pi."""
+    timestamp = str(int(time.time() if now is None else now))
+    user_json = json.dumps(user, sort_keys=True, separators=(',', ':'))
+    return {'X-Relay-User': user_json, 'X-Relay-Time': timestamp,
+            'X-Relay-Signature': _signature(secret, timestamp, user_json)}
+
+
+def verify_user(headers, secret, now=None, max_age=SIGNATURE_MAX_AGE):
+    """Retorna el usuario de las cabeceras firmadas por el relé, o None si no son válidas."""
+    user_json = headers.get('X-Relay-User')
+    timestamp = headers.get('X-Relay-Time', '')
+    signature = headers.get('X-Relay-Signature', '')
+    if not secret or not user_json or not timestamp.isdigit():
+        return None
+    now = time.time() if now is None else now
+    if abs(now - int(timestamp)) > max_age:
+        return None
+    if not hmac.compare_digest(_signature(secret, timestamp, user_json), signature):
+        return None
+    try:
+        user = json.loads(user_json)
+    except ValueError:
+        return None
+    return user if isinstance(user, dict) and user.get('uid') else None
+
+
+# --- Dirección de la Pi ---
+
+def is_lan_address(value):
+    """True si 'value' es una IP privada de la LAN (no loopback, link-local ni pública)."""
+    try:
+        address = ipaddress.ip_address(str(value))
+    except ValueError:
+        return False
+    return any(address in network for network in LAN_NETWORKS)
+
+
+def is_tunnel_url(url, tunnel_hosts=None):
+    """True si 'url' es la raíz de un host de túnel configurado, sin credenciales ni puerto."""
+    tunnel_hosts = TUNNEL_HOSTS if tunnel_hosts is None else tunnel_hosts
+    try:
+        parts = urlsplit(str(url))
+        port = parts.port
+    except ValueError:
+        return False
+    host = (parts.hostname or '').lower()
+    if parts.scheme not in ('http', 'https') or parts.username or parts.password or port is not None \
+            or parts.path not in ('', '/') or parts.query or parts.fragment or not host:
+        return False
+    return any(host == allowed or (allowed.startswith('.') and host.endswith(allowed)) for allowed in tunnel_hosts)
+
+
+def device_base_url(local_ip, stream_url=None, tunnel_hosts=None):
+    """URL base con la que el relé alcanza la Pi, o None si su dirección no es aceptable."""
+    if stream_url:
+        return str(stream_url).rstrip('/') if is_tunnel_url(stream_url, tunnel_hosts) else None
+    if local_ip and is_lan_address(local_ip):
+        address = ipaddress.ip_address(str(local_ip))
+        host = f'[{address}]' if address.version == 6 else str(address)
+        return f'http://{host}:{DEVICE_PORT}'
+    return None
+
+
+def read_json_reply(response, max_bytes=MAX_REPLY_BYTES):
+    """Objeto JSON de la respuesta de la Pi, o None si no lo es o supera 'max_bytes'."""
+    if response.headers.get('Content-Type', '').split(';')[0].strip() != 'application/json':
+        return None
+    body = response.raw.read(max_bytes + 1, decode_content=True)
+    if len(body) > max_bytes:
+        return None
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+# --- Lectura del multipart MJPEG ---
+
+def boundary_from_content_type(content_type, default='frame'):
+    match = _BOUNDARY_RE.search(content_type or '')
+    boundary = match.group(1) if match else default
+    return boundary[2:] if boundary.startswith('--') else boundary
+
+
+def iter_mjpeg_parts(chunks, boundary='frame'):
+    """Separa un stream multipart/x-mixed-replace en (jpeg, cabeceras).
+
+    Usa Content-Length si la parte lo trae (las Pi lo envían); si no, busca
+    el siguiente separador.
+    """
+    delimiter = b'--' + boundary.encode('ascii')
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        while True:
+            start = buffer.find(delimiter)
+            if start < 0:
+                break
+            headers_end = buffer.find(b'\r\n\r\n', start)
+            if headers_end < 0:
+                break
+            headers = {}
+            for line in bytes(buffer[start + len(delimiter):headers_end]).decode('latin-1').split('\r\n'):
+                name, sep, value = line.partition(':')
+                if sep:
+                    headers[name.strip().lower()] = value.strip()
+            body_start = headers_end + 4
+            length = headers.get('content-length', '')
+            if length.isdigit():
+                body_end = body_start + int(length)
+                if len(buffer) < body_end:
+                    break
+            else:
+                body_end = buffer.find(b'\r\n' + delimiter, body_start)
+                if body_end < 0:
+                    break
+            frame = bytes(buffer[body_start:body_end])
+            del buffer[:body_end]
+            yield frame, headers
+        if len(buffer) > MAX_PART_BYTES:
+            raise ValueError("El stream MJPEG no tiene separadores válidos.")
+
+
+def read_available(response, chunk_size=CHUNK_SIZE):
+    """Trozos del cuerpo según van llegando.
+
+    iter_content(n) espera a juntar n bytes, lo que retrasaría cada frame hasta
+    que llegara parte del siguiente; read1 devuelve lo que ya está en el socket.
+    """
+    read1 = getattr(response.raw, 'read1', None)
+    if read1 is None:  # urllib3 < 2
+        yield from response.iter_content(4096)
+        return
+    while True:
+        chunk = read1(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def pooled_session(pool_size=16):
+    """Sesión HTTP con conexiones persistentes hacia las Pi, sin guardar cookies:
+    cada petición reenviada lleva solo la identidad firmada de su usuario."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+    return session
+
+
+# --- Relé por dispositivo ---
+
+class DeviceRelay:
+    """Mantiene una conexión MJPEG con una Pi mientras haya navegadores mirando.
+
+    'resolve' retorna (url_base, secreto) del dispositivo, o (None, None) si
+    está desconectado; se consulta en cada reconexión porque la IP puede cambiar.
+    """
+
+    def __init__(self, device_id, resolve, session, linger=LINGER_SECONDS, reconnect_delay=RECONNECT_DELAY):
+        self.device_id = device_id
+        self.resolve = resolve
+        self.session = session
+        self.linger = linger
+        self.reconnect_delay = reconnect_delay
+        self.broadcaster = FrameBroadcaster(name=f'relay:{device_id}')
+        # Cada navegador recibe el nivel de calidad que admite su conexión; todos
+        # comparten la misma conexión con la Pi.
+        self.levels = AdaptiveStream(self.broadcaster, on_connect=self._ensure_thread, linger=linger)
+        self.connected = False
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def stream(self, **hints):
+        """Generador MJPEG para un navegador; arranca la conexión con la Pi si hace falta.
+
+        'hints' son los de AdaptiveStream.stream (width, fps, quality, adaptive).
+        """
+        return self.levels.stream(**hints)
+
+    def _ensure_thread(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=f'relay-{self.device_id}', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        delay = self.reconnect_delay
+        while True:
+            if not self.broadcaster.wait_for_clients(self.linger):
+                with self._lock:
+                    # Un navegador pudo conectarse justo ahora; si no, el hilo termina.
+                    if not self.broadcaster.clients:
+                        self._thread = None
+                        return
+                continue
+            try:
+                if self._pump():
+                    delay = self.reconnect_delay
+                    continue
+            except Exception as e:
+                RELAY_ERRORS.inc(device=self.device_id, kind=type(e).__name__)
+                print(f"Error en el relé del dispositivo {self.device_id}: {e}")
+            finally:
+                self.connected = False
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+    def _pump(self):
+        """Lee frames de la Pi y los publica. Retorna True si se cerró por falta de clientes."""
+        base_url, secret = self.resolve(self.device_id)
+        if not base_url:
+            RELAY_CONNECTIONS.inc(device=self.device_id, result='sin_ip')
+            return False
+        headers = sign_user({'uid': 'relay', 'role': 'relay'}, secret) if secret else {}
+        with self.session.get(f'{base_url}/video_feed', headers=headers, stream=True, allow_redirects=False,
+                              timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)) as response:
+            if response.status_code != 200:
+                RELAY_CONNECTIONS.inc(device=self.device_id, result=str(response.status_code))
+                return False
+            RELAY_CONNECTIONS.inc(device=self.device_id, result='ok')
+            self.connected = True
+            boundary = boundary_from_content_type(response.headers.get('Content-Type'))
+            idle_since = None
+            for frame, part_headers in iter_mjpeg_parts(read_available(response), boundary):
+                received = time.time()
+                RELAY_FRAMES.inc(device=self.device_id)
+                timestamp = part_headers.get('x-timestamp')
+                try:
+                    sent = float(timestamp) if timestamp else None
+                except ValueError:
+                    sent = None
+                if sent is not None:
+                    RELAY_LATENCY_SECONDS.observe(max(0.0, received - sent), device=self.device_id)
+                self.broadcaster.publish(frame, sent)
+                if self.broadcaster.clients:
+                    idle_since = None
+                elif idle_since is None:
+                    idle_since = received
+                elif received - idle_since > self.linger:
+                    return True
+        RELAY_ERRORS.inc(device=self.device_id, kind='stream_cerrado')
+        return False
+
+
+class StreamRelay:
+    """Relés de todos los dispositivos y reenvío de capturas a la Pi."""
+
+    def __init__(self, resolve, session=None, linger=LINGER_SECONDS):
+        self.resolve = resolve
+        self.session = session or pooled_session()
+        self.linger = linger
+        self._relays = {}
+        self._lock = threading.Lock()
+
+    def relay_for(self, device_id):
+        with self._lock:
+            relay = self._relays.get(device_id)
+            if relay is None:
+                relay = self._relays[device_id] = DeviceRelay(device_id, self.resolve, self.session, self.linger)
+            return relay
+
+    def stream(self, device_id, **hints):
+        return self.relay_for(device_id).stream(**hints)
+
+    def forward(self, device_id, path, user, params=None, method='GET'):
+        """Reenvía una petición a la Pi en nombre de 'user'.
+
+        Retorna (código HTTP, objeto JSON o None si la Pi no respondió un JSON válido),
+        o None si el dispositivo no tiene una dirección aceptable.
+        """
+        base_url, secret = self.resolve(device_id)
+        if not base_url:
+            return None
+        headers = sign_user(user, secret) if secret else {}
+        with metrics.span('device', path.strip('/') or 'root'):
+            with self.session.request(method, f'{base_url}{path}', params=params, headers=headers, stream=True,
+                                      allow_redirects=False, timeout=CAPTURE_TIMEOUT) as response:
+                return response.status_code, read_json_reply(response)
@@ -0,0 +1,462 @@
+# streaming.py (Difusión del stream MJPEG: un solo productor, muchos clientes)
+
+import io
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+
+from PIL import Image
+
+import metrics
+
+MJPEG_MIMETYPE = 'multipart/x-mixed-replace; boundary=frame'
+
+
+FRAMES_PUBLISHED = metrics.counter('linfo_stream_frames_published_total',
+                                   'Frames publicados en el stream.', ('stream',))
+FRAMES_SENT = metrics.counter('linfo_stream_frames_sent_total',
+                              'Frames enviados a los clientes (suma de todos).', ('stream',))
+FRAMES_REPEATED = metrics.counter('linfo_stream_frames_repeated_total',
+                                  'Reenvíos del último frame por cámara parada.', ('stream',))
+FRAMES_DROPPED = metrics.counter('linfo_stream_frames_dropped_total',
+                                 'Frames que un cliente lento se saltó (suma de todos).', ('stream',))
+FRAME_DELIVERY_SECONDS = metrics.histogram('linfo_stream_frame_delivery_seconds',
+                                           'Desde que se publica un frame hasta que el cliente lo termina de recibir.',
+                                           ('stream',),
+                                           buckets=(0.005, 0.01, 0.02, 0.033, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5))
+FRAME_ENCODE_SECONDS = metrics.histogram('linfo_stream_frame_encode_seconds',
+                                         'Tiempo de obtener y codificar un frame (hilo productor).', ('stream',),
+                                         buckets=(0.002, 0.005, 0.01, 0.02, 0.033, 0.05, 0.1, 0.25, 0.5))
+_broadcasters = weakref.WeakSet()  # Los niveles retirados desaparecen de /metrics al liberarse
+
+
+def _stream_gauge(attribute):
+    def collect():
+        return {(b.name,): getattr(b, attribute) for b in list(_broadcasters)}
+    return collect
+
+
+metrics.gauge('linfo_stream_clients', 'Clientes conectados al stream.', ('stream',), callback=_stream_gauge('clients'))
+metrics.gauge('linfo_stream_fps', 'Frames por segundo publicados (media móvil).', ('stream',),
+              callback=_stream_gauge('fps'))
+
+
+def mjpeg_part(frame, timestamp=None):
+    """Envuelve un JPEG como una parte del multipart MJPEG.
+
+    Content-Length y X-Timestamp (hora de publicación) permiten que el relé
+    separe los frames sin buscar en el JPEG y mida la latencia desde la Pi.
+    """
+    timestamp = time.time() if timestamp is None else timestamp
+    headers = (f'--frame\r\nContent-Type: image/jpeg\r\nContent-Length: {len(frame)}\r\n'
+               f'X-Timestamp: {timestamp:.6f}\r\n\r\n')
+    return headers.encode('ascii') + frame + b'\r\n'
+
+
+class FrameBroadcaster:
+    """Guarda el último frame codificado y lo reparte a todos los clientes.
+
+    Cada frame se codifica una sola vez (por el hilo productor o por quien
+    llame a publish) y todos los clientes reciben el mismo objeto de bytes.
+    Cada cliente recuerda el último número de secuencia que envió; si es lento,
+    simplemente se salta los frames intermedios y no frena a los demás.
+    """
+
+    def __init__(self, source=None, idle_timeout=2.0, name='camera', on_demand=None):
+        # 'source' es una función que devuelve un JPEG (p. ej. camera.get_frame).
+        # Si es None, los frames llegan desde fuera mediante publish().
+        # 'name' identifica al stream en /metrics.
+        # 'on_demand(activo)' se llama, fuera del lock, al llegar el primer cliente (True)
+        # y al irse el último (False); p. ej. para encender y apagar el encoder de la Pi.
+        self.source = source
+        self.on_demand = on_demand
+        self.name = name
+        self.idle_timeout = idle_timeout
+        self.condition = threading.Condition()
+        self.frame = None
+        self.part = None
+        self.sequence = 0
+        self.clients = 0
+        self._has_clients = threading.Event()
+        self._thread = None
+        self.fps = 0.0
+        self._last_publish = None
+        self._published_at = None
+        self.timestamp = None
+        _broadcasters.add(self)
+
+    def start(self):
+        """Arranca el hilo productor (solo si hay una fuente que consultar)."""
+        if self.source and self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='frame-broadcaster', daemon=True)
+            self._thread.start()
+        return self
+
+    def _run(self):
+        while True:
+            # Sin clientes no tiene sentido ocupar la CPU de la Pi codificando.
+            self._has_clients.wait()
+            start = time.perf_counter()
+            try:
+                frame = self.source()
+                FRAME_ENCODE_SECONDS.observe(time.perf_counter() - start, stream=self.name)
+            except Exception as e:
+                print(f"Error al obtener frame de la cámara: {e}")
+                time.sleep(0.5)
+                continue
+            if frame:
+                self.publish(frame)
+
+    def publish(self, frame, timestamp=None):
+        """Publica un frame nuevo y despierta a todos los clientes en espera.
+
+        'timestamp' conserva la hora original del frame cuando llega de otro servidor.
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        part = mjpeg_part(frame, timestamp)
+        now = time.perf_counter()
+        if self._last_publish is not None and now > self._last_publish:
+            # Media móvil exponencial del intervalo entre frames.
+            self.fps = 0.9 * self.fps + 0.1 * (1.0 / (now - self._last_publish))
+        self._last_publish = now
+        FRAMES_PUBLISHED.inc(stream=self.name)
+        with self.condition:
+            self.frame = frame
+            self.part = part
+            self.sequence += 1
+            self.timestamp = timestamp
+            self._published_at = now
+            self.condition.notify_all()
+
+    def latest(self):
+        """Devuelve (secuencia, frame) del último frame publicado."""
+        with self.condition:
+            return self.sequence, self.frame
+
+    def wait_for_frame(self, timeout=None):
+        """Devuelve el último frame, esperando solo si todavía no hay ninguno."""
+        with self.condition:
+            self.condition.wait_for(lambda: self.frame is not None, timeout)
+            return self.frame
+
+    def wait_for_part(self, last_sequence, timeout=None):
+        """Espera a un frame más nuevo que 'last_sequence'.
+
+        Devuelve (secuencia, parte_mjpeg); la parte es None si se agotó el tiempo.
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.sequence != last_sequence, timeout):
+                return last_sequence, None
+            return self.sequence, self.part
+
+    def wait_for_new_frame(self, last_sequence, timeout=None):
+        """Como wait_for_part, pero devuelve (secuencia, frame, hora_de_publicación)."""
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.sequence != last_sequence and self.frame is not None,
+                                           timeout):
+                return last_sequence, None, None
+            return self.sequence, self.frame, self.timestamp
+
+    def reset(self):
+        """Olvida el último frame, para no mostrar uno antiguo cuando vuelva a haber clientes."""
+        with self.condition:
+            self.frame = None
+            self.part = None
+
+    def wait_for_clients(self, timeout=None):
+        """Espera a que haya al menos un cliente. Retorna False si se agotó el tiempo."""
+        return self._has_clients.wait(timeout)
+
+    @contextmanager
+    def as_client(self):
+        """Cuenta como un cliente más mientras dura el bloque (mantiene viva la fuente)."""
+        self._add_client()
+        try:
+            yield
+        finally:
+            self._remove_client()
+
+    def _add_client(self):
+        with self.condition:
+            self.clients += 1
+            first = self.clients == 1
+            self._has_clients.set()
+        if first and self.on_demand:
+            self.on_demand(True)
+
+    def _remove_client(self):
+        with self.condition:
+            self.clients -= 1
+            last = self.clients <= 0
+            if last:
+                self.clients = 0
+                self._has_clients.clear()
+        if last and self.on_demand:
+            self.on_demand(False)
+
+    def stream(self, on_connect=None):
+        """Generador MJPEG para un cliente de /video_feed.
+
+        'on_connect' se llama cuando el cliente ya cuenta como conectado (p. ej. para
+        que el relé abra la conexión con la Pi).
+        """
+        self._add_client()
+        if on_connect:
+            on_connect()
+        try:
+            sequence = 0
+            while True:
+                with self.condition:
+                    fresh = self.condition.wait_for(lambda: self.sequence != sequence, self.idle_timeout)
+                    skipped = self.sequence - sequence - 1 if fresh and sequence else 0
+                    sequence, part, published_at = self.sequence, self.part, self._published_at
+                if skipped > 0:
+                    # El cliente no llegó a tiempo: se salta los intermedios en vez de acumularlos.
+                    FRAMES_DROPPED.inc(skipped, stream=self.name)
+                if not fresh:
+                    # La cámara está parada (p. ej. cambiando de modo para una captura):
+                    # se reenvía el último frame bueno para que la conexión siga viva.
+                    if part is None:
+                        continue
+                    FRAMES_REPEATED.inc(stream=self.name)
+                    published_at = None
+                if part is not None:
+                    FRAMES_SENT.inc(stream=self.name)
+                    yield part
+                    # El servidor pide el siguiente frame cuando terminó de escribir este.
+                    if published_at is not None:
+                        FRAME_DELIVERY_SECONDS.observe(time.perf_counter() - published_at, stream=self.name)
+        finally:
+            # Se ejecuta también cuando el navegador cierra la conexión.
+            self._remove_client()
+
+
+class LatestFrameOutput(io.BufferedIOBase):
+    """Destino para el encoder de picamera2 que solo conserva el JPEG más reciente.
+
+    Cada write() del encoder es un frame completo; en lugar de acumularlo se
+    publica directamente en el FrameBroadcaster, reemplazando al anterior.
+    """
+
+    def __init__(self, broadcaster):
+        self.broadcaster = broadcaster
+
+    def writable(self):
+        return True
+
+    def write(self, buf):
+        self.broadcaster.publish(buf)
+        return len(buf)
+
+
+# --- Calidad adaptativa ---
+#
+# Cada cliente de /video_feed puede pedir ancho, fps y calidad JPEG (?w=&fps=&q=) y,
+# además, el servidor baja o sube de nivel según lo que tarda en enviarle cada frame.
+# Los valores se redondean a unos pocos escalones, así que cada combinación distinta
+# se codifica una sola vez y la comparten todos los clientes que estén en ella.
+
+WIDTH_STEPS = (240, 320, 480, 640, 800, 1024, 1280, 1920)
+FPS_STEPS = (2, 5, 10, 15, 20, 25, 30)
+QUALITY_STEPS = (30, 40, 50, 60, 70, 80, 90)
+DEFAULT_QUALITY = 75
+
+# Escalera por la que baja un cliente lento, de mejor a peor: (ancho, fps, calidad).
+# None significa "lo que da la fuente" (el nivel original no se recodifica).
+QUALITY_LADDER = (
+    (None, None, None),
+    (640, 20, 70),
+    (480, 15, 60),
+    (320, 10, 50),
+    (240, 5, 40),
+)
+ADAPT_WINDOW = 2.0  # Segundos de envío que se miden antes de decidir
+DOWNGRADE_BUSY = 0.75  # Fracción del tiempo escribiendo a partir de la cual se baja de nivel
+UPGRADE_BUSY = 0.25  # ...y por debajo de la cual se intenta subir
+UPGRADE_WINDOWS = 3  # Ventanas holgadas seguidas antes de subir (evita oscilar)
+LEVEL_LINGER = 10  # Segundos que un nivel sin clientes espera antes de retirarse
+
+LEVEL_SWITCHES = metrics.counter('linfo_stream_level_switches_total',
+                                 'Cambios de nivel de calidad de los clientes.', ('stream', 'direction'))
+
+
+def _snap_down(value, steps):
+    """El mayor escalón que no supera 'value' (o el menor si todos lo superan)."""
+    if value is None:
+        return None
+    candidates = [step for step in steps if step <= value]
+    return candidates[-1] if candidates else steps[0]
+
+
+def level_key(width=None, fps=None, quality=None):
+    return (_snap_down(width, WIDTH_STEPS), _snap_down(fps, FPS_STEPS), _snap_down(quality, QUALITY_STEPS))
+
+
+def _not_above(key, ceiling):
+    """True si el nivel 'key' no supera a 'ceiling' en ninguna dimensión (None = sin límite)."""
+    return all(limit is None or (value is not None and value <= limit) for value, limit in zip(key, ceiling))
+
+
+def transcode(jpeg, width=None, quality=None):
+    """Reduce un JPEG a 'width' píxeles de ancho (nunca lo amplía) y lo recodifica."""
+    img = Image.open(io.BytesIO(jpeg))
+    if width and width < img.width:
+        size = (width, max(1, round(img.height * width / img.width)))
+        img.draft('RGB', size)  # El decodificador ya reduce por 1/2, 1/4 u 1/8 (escalado DCT)
+        if img.size != size:
+            img = img.convert('RGB').resize(size, Image.BILINEAR)
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    output = io.BytesIO()
+    img.save(output, format='JPEG', quality=quality or DEFAULT_QUALITY)
+    return output.getvalue()
+
+
+class QualityLevel:
+    """Un nivel derivado de la fuente: toma su último frame, lo reduce y lo publica.
+
+    Solo trabaja mientras tiene clientes, y mientras tanto cuenta como un cliente
+    más de la fuente (para que el relé o la cámara sigan produciendo). Tras 'linger'
+    segundos sin clientes su hilo termina y se llama a 'on_idle(nivel)'; el siguiente
+    cliente lo vuelve a arrancar.
+    """
+
+    def __init__(self, source, key, on_connect=None, on_idle=None, linger=LEVEL_LINGER):
+        self.source = source
+        self.key = key
+        self.width, self.fps, self.quality = key
+        self.on_connect = on_connect
+        self.on_idle = on_idle
+        self.linger = linger
+        self.name = '/'.join(f'{value}{unit}' for value, unit in zip(key, ('w', 'fps', 'q')) if value is not None)
+        self.broadcaster = FrameBroadcaster(name=f'{source.name}@{self.name}')
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def stream(self):
+        return self.broadcaster.stream(on_connect=self._ensure_thread)
+
+    def _ensure_thread(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=f'quality-{self.name}', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        recode = self.width is not None or self.quality is not None
+        while True:
+            if not self.broadcaster.wait_for_clients(self.linger):
+                with self._lock:
+                    # Un cliente pudo conectarse justo ahora; si no, el hilo termina.
+                    if not self.broadcaster.clients:
+                        self._thread = None
+                        break
+                continue
+            self.source._add_client()
+            if self.on_connect:
+                self.on_connect()
+            try:
+                sequence, next_time = 0, 0.0
+                while self.broadcaster.clients:
+                    if self.fps:
+                        delay = next_time - time.perf_counter()
+                        if delay > 0:
+                            time.sleep(delay)
+                        next_time = max(next_time + 1.0 / self.fps, time.perf_counter())
+                    sequence, frame, timestamp = self.source.wait_for_new_frame(sequence, timeout=1.0)
+                    if frame is None:
+                        continue
+                    if recode:
+                        start = time.perf_counter()
+                        try:
+                            frame = transcode(frame, self.width, self.quality)
+                        except Exception as e:
+                            print(f"Error al recodificar el frame para {self.broadcaster.name}: {e}")
+                            continue
+                        FRAME_ENCODE_SECONDS.observe(time.perf_counter() - start, stream=self.broadcaster.name)
+                    self.broadcaster.publish(frame, timestamp)
+            finally:
+                self.source._remove_client()
+                self.broadcaster.reset()
+        if self.on_idle:
+            self.on_idle(self)
+
+
+class AdaptiveStream:
+    """Reparte una fuente (FrameBroadcaster) en niveles de calidad bajo demanda.
+
+    Cada cliente mide cuánto tarda en escribirse cada frame: si pasa la mayor
+    parte del tiempo escribiendo, la red no da abasto y baja un escalón; si le
+    sobra tiempo durante varias ventanas, sube, sin pasar de lo que pidió.
+    'on_connect' se llama cuando un cliente empieza a consumir de la fuente.
+    Los niveles se crean con el primer cliente que los pide y se retiran tras
+    'linger' segundos sin clientes, así que pedir muchas combinaciones distintas
+    no deja hilos ni broadcasters vivos.
+    """
+
+    def __init__(self, source, on_connect=None, linger=LEVEL_LINGER):
+        self.source = source
+        self.on_connect = on_connect
+        self.linger = linger
+        self._levels = {}
+        self._lock = threading.Lock()
+
+    def _level(self, key):
+        with self._lock:
+            level = self._levels.get(key)
+            if level is None:
+                level = self._levels[key] = QualityLevel(self.source, key, self.on_connect,
+                                                         on_idle=self._retire, linger=self.linger)
+            return level
+
+    def _retire(self, level):
+        with self._lock:
+            # Un cliente que ya tenía el nivel pudo volver a arrancarlo: entonces se queda.
+            if self._levels.get(level.key) is level and not level.broadcaster.clients:
+                del self._levels[level.key]
+
+    def _open(self, key):
+        if key == (None, None, None):
+            return self.source.stream(on_connect=self.on_connect)
+        return self._level(key).stream()
+
+    def steps(self, width=None, fps=None, quality=None):
+        """Niveles posibles para un cliente, de mejor a peor; el primero es lo que pidió."""
+        ceiling = level_key(width, fps, quality)
+        return [ceiling] + [key for key in QUALITY_LADDER if key != ceiling and _not_above(key, ceiling)]
+
+    def stream(self, width=None, fps=None, quality=None, adaptive=True):
+        """Generador MJPEG para un cliente."""
+        steps = self.steps(width, fps, quality)
+        index = 0
+        while True:
+            parts = self._open(steps[index])
+            new_index = index
+            try:
+                window_start, busy, calm = time.perf_counter(), 0.0, 0
+                for part in parts:
+                    start = time.perf_counter()
+                    yield part
+                    now = time.perf_counter()
+                    busy += now - start
+                    if not adaptive or now - window_start < ADAPT_WINDOW:
+                        continue
+                    ratio = busy / (now - window_start)
+                    window_start, busy = now, 0.0
+                    if ratio > DOWNGRADE_BUSY and index + 1 < len(steps):
+                        new_index = index + 1
+                    elif ratio < UPGRADE_BUSY and index > 0:
+                        calm += 1
+                        if calm >= UPGRADE_WINDOWS:
+                            new_index = index - 1
+                    else:
+                        calm = 0
+                    if new_index != index:
+                        break
+            finally:
+                parts.close()
+            if new_index == index:
+                return  # La fuente terminó
+            LEVEL_SWITCHES.inc(stream=self.source.name, direction='baja' if new_index > index else 'sube')
+            index = new_index
@@ -0,0 +1,22 @@
+# conftest.py (Las pruebas importan los módulos de la raíz del repositorio y los dobles de bench.py)
+
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def wait_for():
+    """wait_for(condition, timeout): espera a que condition() sea verdadera; False si se agota el tiempo."""
+    def wait(condition, timeout=10.0):
+        deadline = time.time() + timeout
+        while not condition():
+            if time.time() > deadline:
+                return False
+            time.sleep(0.02)
+        return True
+    return wait
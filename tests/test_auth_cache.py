@@ -0,0 +1,87 @@
+# test_auth_cache.py (Verificación local de ID tokens con un emisor falso)
+
+import base64
+import json
+import time
+
+import pytest
+
+import auth_cache
+from bench import make_fake_issuer
+
+PROJECT_ID = 'linfo-test'
+
+
+@pytest.fixture(scope='module')
+def issuer():
+    return make_fake_issuer(PROJECT_ID)
+
+
+@pytest.fixture
+def fetches():
+    return []
+
+
+@pytest.fixture
+def make_verifier(tmp_path, issuer, fetches):
+    certs, _ = issuer
+
+    def fetcher():
+        fetches.append(time.time())
+        return certs, 3600
+
+    def make():
+        return auth_cache.TokenVerifier(PROJECT_ID, auth_cache.CertCache(str(tmp_path / 'certs.json'), fetcher))
+    return make
+
+
+def with_kid(token, kid):
+    header = base64.urlsafe_b64encode(json.dumps({'alg': 'RS256', 'kid': kid}).encode()).rstrip(b'=').decode()
+    return header + token[token.index('.'):]
+
+
+def test_valid_token_is_accepted_and_certs_are_shared(issuer, make_verifier, fetches):
+    _, sign = issuer
+    token = sign({'sub': 'uid1', 'role': 'doctor'})
+    verifiers = [make_verifier() for _ in range(3)]
+
+    for verifier in verifiers:
+        claims = verifier.verify(token)
+        assert claims['uid'] == 'uid1'
+        assert claims['role'] == 'doctor'
+    assert len(fetches) == 1
+
+
+@pytest.mark.parametrize('claims', [
+    {'iat': int(time.time()) - 7200, 'exp': int(time.time()) - 3600, 'auth_time': int(time.time()) - 7200},
+    {'aud': 'otro-proyecto'},
+    {'iss': 'https://securetoken.google.com/otro-proyecto'},
+    {'sub': ''},
+], ids=['caducado', 'audiencia', 'emisor', 'sin-usuario'])
+def test_invalid_claims_are_rejected(issuer, make_verifier, claims):
+    _, sign = issuer
+    token = sign(dict({'sub': 'uid1'}, **claims))
+    with pytest.raises(auth_cache.AuthError):
+        make_verifier().verify(token)
+
+
+def test_tampered_signature_is_rejected(issuer, make_verifier):
+    _, sign = issuer
+    token = sign({'sub': 'uid1'})
+    with pytest.raises(auth_cache.AuthError):
+        make_verifier().verify(token[:-4] + ('AAAA' if not token.endswith('AAAA') else 'BBBB'))
+
+
+def test_unknown_kid_forces_a_single_cert_fetch(issuer, make_verifier, fetches):
+    _, sign = issuer
+    verifier = make_verifier()
+    token = sign({'sub': 'uid1'})
+    verifier.verify(token)
+    assert len(fetches) == 1
+
+    forged = with_kid(token, 'kid-inventado')
+    for _ in range(20):
+        with pytest.raises(auth_cache.AuthError):
+            verifier.verify(forged)
+    assert len(fetches) == 2
+    assert verifier.verify(token)['uid'] == 'uid1'
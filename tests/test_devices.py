@@ -0,0 +1,98 @@
+# test_devices.py (Registro de dispositivos: latidos, expiración y elección por equipo)
+
+from types import SimpleNamespace
+
+import pytest
+
+import devices
+from devices import DeviceRegistry
+
+
+@pytest.fixture
+def clock():
+    return [1_000_000.0]
+
+
+@pytest.fixture
+def registry(clock):
+    return DeviceRegistry(None, offline_after=90, clock=lambda: clock[0])
+
+
+def register_online(registry, team_id, name, ip, status='idle'):
+    device_id, key = registry.register(team_id, name)
+    assert registry.heartbeat(device_id, key, ip, status, {'camera': 'synthetic'})
+    return device_id, key
+
+
+def test_pick_device_never_crosses_teams(registry):
+    ours, _ = register_online(registry, 't1', 'Pi 1', '192.168.1.10')
+    theirs, _ = register_online(registry, 't2', 'Pi 2', '192.168.1.11')
+
+    assert registry.pick_device('t1')['device_id'] == ours
+    assert registry.pick_device('t1', preferred_id=theirs)['device_id'] == ours
+    assert [d['device_id'] for d in registry.online_devices('t2')] == [theirs]
+    assert registry.pick_device('t3') is None
+
+
+def test_pick_device_prefers_requested_then_idle(registry, clock):
+    busy, _ = register_online(registry, 't1', 'Ocupada', '192.168.1.10', status='busy')
+    clock[0] += 1
+    idle, _ = register_online(registry, 't1', 'Libre', '192.168.1.11')
+
+    assert registry.pick_device('t1')['device_id'] == idle
+    assert registry.pick_device('t1', preferred_id=busy)['device_id'] == busy
+
+
+def test_devices_without_heartbeats_go_offline(registry, clock):
+    device_id, key = register_online(registry, 't1', 'Pi 1', '192.168.1.10')
+    assert registry.pick_device('t1')['device_id'] == device_id
+
+    clock[0] += 91
+    assert registry.pick_device('t1') is None
+    assert registry.online_devices('t1') == []
+
+    registry.heartbeat(device_id, key, '192.168.1.10', 'idle')
+    assert registry.pick_device('t1')['device_id'] == device_id
+
+    registry.heartbeat(device_id, key, '192.168.1.10', 'offline')
+    assert registry.pick_device('t1') is None
+
+
+def test_heartbeat_requires_the_device_key(registry):
+    device_id, key = registry.register('t1', 'Pi 1')
+    assert registry.heartbeat(device_id, 'clave-incorrecta', '192.168.1.10') is None
+    assert registry.heartbeat(device_id, '', '192.168.1.10') is None
+    assert registry.heartbeat('x' * 200, key, '192.168.1.10') is None
+    assert registry.pick_device('t1') is None
+
+
+def test_heartbeat_drops_addresses_the_relay_must_not_reach(registry):
+    device_id, key = registry.register('t1', 'Pi 1')
+    device = registry.heartbeat(device_id, key, '169.254.169.254', 'idle',
+                                {'camera': 'synthetic', 'stream_url': 'http://169.254.169.254/', 'extra': 'x' * 4096})
+    assert device['local_ip'] is None
+    assert device['capabilities'] == {'camera': 'synthetic'}
+
+
+def test_unknown_device_ids_are_looked_up_once(clock):
+    gets = []
+
+    class Firestore:
+        def collection(self, name):
+            class Document:
+                def __init__(self, document_id):
+                    self.document_id = document_id
+
+                def get(self):
+                    gets.append(self.document_id)
+                    return SimpleNamespace(exists=False)
+            return SimpleNamespace(document=Document)
+
+    registry = DeviceRegistry(Firestore(), clock=lambda: clock[0])
+    for _ in range(10):
+        assert registry.heartbeat('inventado', 'clave') is None
+    assert gets == ['inventado']
+
+    clock[0] += devices.UNKNOWN_TTL + 1
+    assert registry.heartbeat('inventado', 'clave') is None
+    assert gets == ['inventado', 'inventado']
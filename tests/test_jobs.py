@@ -0,0 +1,26 @@
+# test_jobs.py (Trabajos en segundo plano)
+
+import threading
+
+from jobs import JobRegistry
+
+
+def test_dedicated_kind_does_not_wait_for_long_jobs(wait_for):
+    registry = JobRegistry(max_workers=2, dedicated_workers={'delete_patient': 1})
+    release = threading.Event()
+    try:
+        long_jobs = [registry.submit('export_reports', 't1', lambda job: release.wait()) for _ in range(3)]
+        delete = registry.submit('delete_patient', 't1', lambda job, patient_id: patient_id, 'p1')
+
+        assert wait_for(lambda: delete.status == 'completado', timeout=2)
+        assert delete.result == 'p1'
+        assert [job.status for job in long_jobs].count('pendiente') == 1
+    finally:
+        release.set()
+
+
+def test_jobs_are_scoped_to_their_team():
+    registry = JobRegistry()
+    job = registry.submit('gc_annotations', 't1', lambda job: None)
+    assert registry.get(job.id, 't1') is job
+    assert registry.get(job.id, 't2') is None
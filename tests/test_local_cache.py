@@ -0,0 +1,105 @@
+# test_local_cache.py (Réplica local de Firestore alimentada por snapshots)
+
+import datetime
+
+import pytest
+from google.cloud.firestore_v1.transforms import DELETE_FIELD, SERVER_TIMESTAMP
+
+from bench import FakeFirestore
+from local_cache import LocalCache
+
+
+@pytest.fixture
+def replica(tmp_path):
+    firestore_client = FakeFirestore()
+    cache = LocalCache(str(tmp_path / 'cache.db'), firestore_client)
+    return cache, firestore_client
+
+
+def patient(apellido, **extra):
+    return dict({'team_id': 't1', 'nombre': 'Ana', 'apellido': apellido, 'cedula': 'V-1'}, **extra)
+
+
+def test_first_snapshot_prunes_documents_deleted_while_offline(replica):
+    cache, firestore_client = replica
+    cache.upsert_patient('borrado', patient('Borrado'))
+    cache.upsert_patient('otro-equipo', dict(patient('Ajeno'), team_id='t2'))
+    cache.watch_team('t1')
+    assert not cache.is_ready('t1')
+
+    patients = {'p1': patient('Pérez'), 'p2': patient('Gómez')}
+    firestore_client.snapshot('patients', patients, [('ADDED', 'p1'), ('ADDED', 'p2')])
+    assert not cache.is_ready('t1')
+    firestore_client.snapshot('captures', {}, [])
+
+    assert cache.is_ready('t1')
+    assert cache.get_patient('borrado') is None
+    assert cache.get_patient('otro-equipo') is not None
+    assert cache.get_patient('p1')['apellido'] == 'Pérez'
+
+
+def test_modified_and_removed_changes(replica):
+    cache, firestore_client = replica
+    cache.watch_team('t1')
+    taken = datetime.datetime(2026, 9, 1, tzinfo=datetime.timezone.utc)
+    patients = {'p1': patient('Pérez'), 'p2': patient('Gómez')}
+    captures = {'c1': {'team_id': 't1', 'patient_firestore_id': 'p1', 'timestamp': taken, 'study_area': 'Brazo'}}
+    firestore_client.snapshot('patients', patients, [('ADDED', 'p1'), ('ADDED', 'p2')])
+    firestore_client.snapshot('captures', captures, [('ADDED', 'c1')])
+
+    patients['p1'] = patient('Pérez', telefono='0414')
+    firestore_client.snapshot('patients', patients, [('MODIFIED', 'p1'), ('REMOVED', 'p2')])
+    firestore_client.snapshot('captures', captures, [('REMOVED', 'c1')])
+
+    assert cache.get_patient('p1')['telefono'] == '0414'
+    assert cache.get_patient('p2') is None
+    assert cache.get_capture('c1') is None
+
+
+def test_write_through_resolves_sentinels(replica):
+    cache, firestore_client = replica
+    cache.upsert_patient('p1', patient('Pérez', telefono='0414', consent={'firmado': True}))
+
+    cache.update_patient('p1', {'telefono': DELETE_FIELD, 'updated_at': SERVER_TIMESTAMP,
+                                'consent': {'firmado': True, 'fecha': SERVER_TIMESTAMP, 'testigo': DELETE_FIELD}})
+    local = cache.get_patient('p1')
+    assert 'telefono' not in local
+    assert isinstance(local['updated_at'], datetime.datetime)
+    assert isinstance(local['consent']['fecha'], datetime.datetime)
+    assert 'testigo' not in local['consent']
+
+    # El listener trae después el valor real del servidor.
+    cache.watch_team('t1')
+    server_time = datetime.datetime(2026, 9, 2, 12, 0, tzinfo=datetime.timezone.utc)
+    firestore_client.snapshot('patients', {'p1': patient('Pérez', updated_at=server_time)}, [('MODIFIED', 'p1')])
+    assert cache.get_patient('p1')['updated_at'] == server_time
+
+
+def test_snapshot_is_applied_atomically(replica):
+    cache, firestore_client = replica
+    cache.watch_team('t1')
+    patients = {'p1': patient('Pérez'), 'p2': patient('Gómez', foto=object())}  # 'foto' no se puede serializar
+    firestore_client.snapshot('patients', patients, [('ADDED', 'p1'), ('ADDED', 'p2')])
+
+    assert cache.get_patient('p1') is None
+    assert not cache.is_ready('t1', ('patients',))
+
+
+def test_search_orders_all_matches_before_the_limit(replica):
+    cache, _ = replica
+    # Se insertan en orden inverso: el índice FTS los devuelve del último al primero alfabético.
+    for i in reversed(range(30)):
+        cache.upsert_patient(f'p{i}', patient(f'Pérez{i:02d}', cedula=f'V-{12345000 + i}'))
+    cache.upsert_patient('otro', dict(patient('Pérez'), team_id='t2'))
+
+    results = cache.search_patients('t1', 'perez', limit=5)
+    assert [p['apellido'] for p in results] == [f'Pérez{i:02d}' for i in range(5)]
+    assert [p['firestore_id'] for p in cache.search_patients('t1', 'V-12.345.01', limit=3)] == ['p10', 'p11', 'p12']
+
+
+def test_search_ignores_too_short_terms(replica):
+    cache, _ = replica
+    cache.upsert_patient('p1', patient('Pérez'))
+    assert cache.search_patients('t1', 'p') == []
+    assert cache.search_patients('t1', '1') == []
+    assert [p['firestore_id'] for p in cache.search_patients('t1', 'a pe')] == ['p1']
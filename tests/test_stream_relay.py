@@ -0,0 +1,89 @@
+# test_stream_relay.py (Cabeceras firmadas del relé, direcciones de las Pi y lectura del multipart MJPEG)
+
+import json
+
+import pytest
+
+import stream_relay
+from streaming import mjpeg_part
+
+SECRET = 'secreto-de-prueba'
+USER = {'uid': 'u1', 'role': 'doctor', 'team_id': 't1'}
+
+
+def test_signed_user_roundtrip():
+    headers = stream_relay.sign_user(USER, SECRET, now=1000)
+    assert stream_relay.verify_user(headers, SECRET, now=1030) == USER
+
+
+def test_tampered_headers_are_rejected():
+    headers = stream_relay.sign_user(USER, SECRET, now=1000)
+    forged_user = dict(headers, **{'X-Relay-User': json.dumps(dict(USER, role='admin'))})
+    forged_time = dict(headers, **{'X-Relay-Time': '1001'})
+    forged_signature = dict(headers, **{'X-Relay-Signature': '0' * 64})
+
+    for forged in (forged_user, forged_time, forged_signature):
+        assert stream_relay.verify_user(forged, SECRET, now=1000) is None
+    assert stream_relay.verify_user(headers, 'otro-secreto', now=1000) is None
+    assert stream_relay.verify_user(headers, '', now=1000) is None
+    assert stream_relay.verify_user({}, SECRET, now=1000) is None
+
+
+def test_expired_headers_are_rejected():
+    headers = stream_relay.sign_user(USER, SECRET, now=1000)
+    assert stream_relay.verify_user(headers, SECRET, now=1000 + stream_relay.SIGNATURE_MAX_AGE + 1) is None
+    assert stream_relay.verify_user(headers, SECRET, now=1000 - stream_relay.SIGNATURE_MAX_AGE - 1) is None
+
+
+@pytest.mark.parametrize('local_ip, stream_url, expected', [
+    ('192.168.1.10', None, 'http://192.168.1.10:5000'),
+    ('fd00::1', None, 'http://[fd00::1]:5000'),
+    ('169.254.169.254', None, None),
+    ('127.0.0.1', None, None),
+    ('8.8.8.8', None, None),
+    (None, 'https://pi1.tunel.example/', 'https://pi1.tunel.example'),
+    (None, 'https://tunel.example.evil.com/', None),
+    (None, 'https://pi1.tunel.example:8443/', None),
+    (None, 'https://user@pi1.tunel.example/', None),
+    ('192.168.1.10', 'http://169.254.169.254/', None),
+])
+def test_device_base_url(local_ip, stream_url, expected):
+    assert stream_relay.device_base_url(local_ip, stream_url, tunnel_hosts=['.tunel.example']) == expected
+
+
+def split(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def test_parts_split_across_chunks():
+    # El segundo JPEG contiene el separador: con Content-Length no se corta ahí.
+    frames = [b'\xff\xd8primero\xff\xd9', b'\xff\xd8--frame\r\ncon separador\xff\xd9', b'\xff\xd8tercero\xff\xd9']
+    stream = b''.join(mjpeg_part(frame, timestamp=1.5) for frame in frames)
+
+    for size in (1, 7, len(stream)):
+        parts = list(stream_relay.iter_mjpeg_parts(split(stream, size)))
+        assert [frame for frame, _ in parts] == frames
+        assert parts[0][1]['content-type'] == 'image/jpeg'
+        assert parts[0][1]['x-timestamp'] == '1.500000'
+
+
+def test_parts_without_content_length():
+    frames = [b'\xff\xd8uno\xff\xd9', b'\xff\xd8dos\xff\xd9']
+    stream = b''.join(b'--pi\r\nContent-Type: image/jpeg\r\n\r\n' + frame + b'\r\n' for frame in frames)
+    stream += b'--pi\r\n'
+
+    parts = list(stream_relay.iter_mjpeg_parts(split(stream, 5), boundary='pi'))
+    assert [frame for frame, _ in parts] == frames
+    assert 'content-length' not in parts[0][1]
+
+
+def test_stream_without_separators_is_rejected(monkeypatch):
+    monkeypatch.setattr(stream_relay, 'MAX_PART_BYTES', 1024)
+    with pytest.raises(ValueError):
+        list(stream_relay.iter_mjpeg_parts([b'x' * 512] * 4))
+
+
+def test_boundary_from_content_type():
+    assert stream_relay.boundary_from_content_type('multipart/x-mixed-replace; boundary=frame') == 'frame'
+    assert stream_relay.boundary_from_content_type('multipart/x-mixed-replace; boundary="--pi"') == 'pi'
+    assert stream_relay.boundary_from_content_type('') == 'frame'
@@ -0,0 +1,70 @@
+# test_streaming.py (Niveles de calidad derivados de una fuente MJPEG)
+
+import io
+import threading
+
+from PIL import Image
+
+import streaming
+
+
+def jpeg(width=640, height=480):
+    output = io.BytesIO()
+    Image.new('RGB', (width, height), 'green').save(output, format='JPEG')
+    return output.getvalue()
+
+
+def level_threads():
+    return [t for t in threading.enumerate() if t.name.startswith('quality-')]
+
+
+def start_publisher(source):
+    stop = threading.Event()
+    frame = jpeg()
+
+    def run():
+        while not stop.wait(0.01):
+            source.publish(frame)
+    threading.Thread(target=run, daemon=True).start()
+    return stop
+
+
+def test_idle_levels_stop_and_are_removed(wait_for):
+    source = streaming.FrameBroadcaster(name='prueba')
+    levels = streaming.AdaptiveStream(source, linger=0.2)
+    stop = start_publisher(source)
+    try:
+        for width in (240, 320, 480):  # Cada ancho es un nivel distinto
+            parts = levels.stream(width=width, adaptive=False)
+            part = next(parts)
+            assert Image.open(io.BytesIO(part.split(b'\r\n\r\n', 1)[1])).width <= width
+            parts.close()
+        assert wait_for(lambda: not levels._levels and not level_threads(), timeout=5)
+        assert source.clients == 0
+
+        # Un cliente nuevo vuelve a crear el nivel.
+        parts = levels.stream(width=320, adaptive=False)
+        next(parts)
+        assert list(levels._levels) == [streaming.level_key(320)]
+        parts.close()
+    finally:
+        stop.set()
+
+
+def test_level_kept_while_a_client_watches(wait_for):
+    source = streaming.FrameBroadcaster(name='prueba-activo')
+    levels = streaming.AdaptiveStream(source, linger=0.1)
+    stop = start_publisher(source)
+    try:
+        watching = levels.stream(width=320, adaptive=False)
+        next(watching)
+        leaving = levels.stream(width=320, adaptive=False)
+        next(leaving)
+        leaving.close()
+        for _ in range(20):
+            next(watching)
+        assert list(levels._levels) == [streaming.level_key(320)]
+        watching.close()
+        assert wait_for(lambda: not levels._levels, timeout=5)
+    finally:
+        stop.set()
@@ -0,0 +1,79 @@
+# test_upload_queue.py (Cola de subidas: varias colas sobre la misma base de datos y trabajos huérfanos)
+
+import os
+import sqlite3
+import time
+
+import upload_queue
+from bench import FakeBucket, FakeFirestore
+
+
+def make_queue(tmp_path, bucket, firestore_client, **kwargs):
+    return upload_queue.UploadQueue(str(tmp_path / 'spool.db'), str(tmp_path / 'spool'), bucket, firestore_client,
+                                    base_delay=0.05, max_delay=0.2, **kwargs)
+
+
+def insert_claimed(tmp_path, destination, claimed_at):
+    """Fila 'uploading' como la dejaría otro proceso (vivo o caído)."""
+    path = tmp_path / 'spool' / destination
+    path.write_bytes(b'x')
+    conn = sqlite3.connect(tmp_path / 'spool.db')
+    conn.execute('''
+        INSERT INTO upload_spool (local_path, destination, collection, document_id, document_data,
+                                  url_field, status, claimed_at)
+        VALUES (?, ?, 'captures', ?, '{}', 'cloud_url', 'uploading', ?)
+    ''', (str(path), destination, destination.split('.')[0], claimed_at))
+    conn.commit()
+    conn.close()
+
+
+def statuses(tmp_path):
+    conn = sqlite3.connect(tmp_path / 'spool.db')
+    rows = dict(conn.execute('SELECT destination, status FROM upload_spool').fetchall())
+    conn.close()
+    return rows
+
+
+def test_concurrent_queues_upload_each_file_once(tmp_path, wait_for):
+    bucket, firestore_client = FakeBucket(0.002, failures=5), FakeFirestore()
+    queues = [make_queue(tmp_path, bucket, firestore_client, workers=4) for _ in range(2)]
+    ids = [queues[i % 2].enqueue(b'jpeg', f'pacientes/P/Brazo/{i}.jpg', 'captures', {'study_area': 'Brazo'})
+           for i in range(60)]
+    for queue in queues:
+        queue.start()
+
+    assert wait_for(lambda: queues[0].pending_count() == 0)
+    assert bucket.uploads == {f'pacientes/P/Brazo/{i}.jpg': 1 for i in range(60)}
+    assert set(firestore_client.writes) == {('captures', document_id) for document_id in ids}
+    assert all(len(writes) == 1 for writes in firestore_client.writes.values())
+    assert statuses(tmp_path) == {}
+    assert os.listdir(tmp_path / 'spool') == []
+
+
+def test_stale_claims_are_recovered_and_recent_ones_left_alone(tmp_path, wait_for):
+    bucket, firestore_client = FakeBucket(0), FakeFirestore()
+    make_queue(tmp_path, bucket, firestore_client)
+    insert_claimed(tmp_path, 'huerfana.jpg', time.time() - 2 * upload_queue.STALE_UPLOAD_AFTER)
+    insert_claimed(tmp_path, 'en-curso.jpg', time.time())
+
+    queue = make_queue(tmp_path, bucket, firestore_client)
+    assert statuses(tmp_path) == {'huerfana.jpg': 'pending', 'en-curso.jpg': 'uploading'}
+
+    queue.start()
+    assert wait_for(lambda: 'huerfana.jpg' in bucket.uploads)
+    assert wait_for(lambda: statuses(tmp_path) == {'en-curso.jpg': 'uploading'})
+    assert 'en-curso.jpg' not in bucket.uploads
+    assert queue.pending_count() == 1
+
+
+def test_missing_spool_file_fails_without_retrying(tmp_path, wait_for):
+    bucket, firestore_client = FakeBucket(0), FakeFirestore()
+    queue = make_queue(tmp_path, bucket, firestore_client)
+    document_id = queue.enqueue(b'jpeg', 'pacientes/P/Brazo/perdida.jpg', 'captures', {})
+    os.remove(tmp_path / 'spool' / f'{document_id}_perdida.jpg')
+    queue.start()
+
+    assert wait_for(lambda: statuses(tmp_path) == {'pacientes/P/Brazo/perdida.jpg': 'failed'})
+    assert queue.pending_count() == 0
+    assert bucket.uploads == {}
+    assert firestore_client.writes == {}
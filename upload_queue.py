@@ -0,0 +1,287 @@
+# upload_queue.py (Cola de subidas en segundo plano con spool local en disco)
+
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import metrics
+
+# Un trabajo 'uploading' sin terminar tras este tiempo quedó huérfano (proceso caído):
+# vuelve a la cola. Es mayor que cualquier subida normal, así que no se duplican.
+STALE_UPLOAD_AFTER = 15 * 60
+
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return {'__datetime__': value.isoformat()}
+    raise TypeError(f"Tipo no serializable: {type(value)}")
+
+
+def _decode_value(obj):
+    if '__datetime__' in obj:
+        return datetime.fromisoformat(obj['__datetime__'])
+    return obj
+
+
+def encode_document(data):
+    """Serializa un documento de Firestore (con fechas) para guardarlo en SQLite."""
+    return json.dumps(data, default=_encode_value)
+
+
+def decode_document(text):
+    return json.loads(text, object_hook=_decode_value) if text else {}
+
+
+class UploadQueue:
+    """Sube archivos a Storage en segundo plano sin perderlos si falla la red.
+
+    Cada archivo se escribe primero en 'spool_dir' (con fsync) y se anota en la
+    tabla 'upload_spool' de SQLite, que hace de diario: si la app se reinicia,
+    las subidas pendientes se retoman. Un hilo despachador reparte los trabajos
+    a un pool de hilos; los fallos se reintentan con backoff exponencial y,
+    al terminar, se guarda el documento en Firestore con la URL pública.
+
+    'derivatives', si se indica, recibe (ruta_local, destino) de cada imagen y
+    retorna archivos derivados [(destino, bytes, content_type, campo)] que se
+    suben con ella; la URL de cada uno se guarda en 'campo' del documento. Si no
+    se pueden generar, la imagen se sube igual, sin esos campos.
+    'analyze', si se indica, recibe la ruta local de cada imagen y retorna campos
+    extra del documento (p. ej. las métricas de fluorescencia); si falla, la
+    imagen se sube igual, sin esos campos.
+
+    'bucket' y 'firestore_client' solo necesitan la parte de la API de
+    firebase_admin que se usa aquí, así que se pueden sustituir por dobles locales.
+
+    Varios procesos pueden compartir la misma base de datos: cada trabajo se reclama
+    con un UPDATE condicional, así que solo lo sube uno. Los trabajos terminados se
+    borran de la tabla; si el archivo del spool desapareció, el trabajo queda 'failed'.
+    """
+
+    def __init__(self, db_path, spool_dir, bucket, firestore_client, workers=3,
+                 base_delay=2.0, max_delay=300.0, derivatives=None, analyze=None):
+        self.db_path = db_path
+        self.spool_dir = spool_dir
+        self.bucket = bucket
+        self.firestore_client = firestore_client
+        self.workers = workers
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.derivatives = derivatives
+        self.analyze = analyze
+        self._wakeup = threading.Event()
+        self._executor = None
+        self._thread = None
+        self._in_flight = set()
+        self._in_flight_lock = threading.Lock()
+        os.makedirs(spool_dir, exist_ok=True)
+        self._init_db()
+        metrics.gauge('linfo_upload_queue_pending', 'Subidas pendientes en el spool.', callback=self.pending_count)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _init_db(self):
+        conn = self._connect()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS upload_spool (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, local_path TEXT NOT NULL,
+                destination TEXT NOT NULL, content_type TEXT, collection TEXT NOT NULL,
+                document_id TEXT NOT NULL, document_data TEXT, url_field TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL DEFAULT 0, last_error TEXT, created_at TEXT,
+                claimed_at REAL
+            )
+        ''')
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(upload_spool)")]
+        if 'claimed_at' not in columns:
+            conn.execute('ALTER TABLE upload_spool ADD COLUMN claimed_at REAL')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_upload_spool_status ON upload_spool (status, next_attempt_at)')
+        # Las versiones anteriores dejaban las filas terminadas en la tabla.
+        conn.execute("DELETE FROM upload_spool WHERE status = 'done'")
+        self._recover_stale(conn)
+        conn.commit()
+        conn.close()
+
+    def _recover_stale(self, conn):
+        """Devuelve a la cola lo que lleva subiéndose más de STALE_UPLOAD_AFTER.
+
+        Con varios procesos, un 'uploading' reciente puede ser de otro que sigue vivo,
+        así que solo se recuperan los antiguos.
+        """
+        conn.execute('''
+            UPDATE upload_spool SET status = 'pending', claimed_at = NULL
+            WHERE status = 'uploading' AND (claimed_at IS NULL OR claimed_at < ?)
+        ''', (time.time() - STALE_UPLOAD_AFTER,))
+
+    def start(self):
+        if self._thread is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='upload')
+            self._thread = threading.Thread(target=self._dispatch_loop, name='upload-dispatcher', daemon=True)
+            self._thread.start()
+        return self
+
+    def new_document_id(self, collection):
+        """ID para el documento de Firestore, generado localmente (sin red)."""
+        if self.firestore_client:
+            return self.firestore_client.collection(collection).document().id
+        return uuid.uuid4().hex[:20]
+
+    def enqueue(self, data, destination, collection, document_data, document_id=None,
+                content_type='image/jpeg', url_field='cloud_url'):
+        """Guarda 'data' en el spool y lo anota para subirlo.
+
+        Retorna el ID del documento de Firestore que se creará al terminar la subida.
+        Cuando esta función retorna, el archivo ya está a salvo en el disco local.
+        """
+        document_id = document_id or self.new_document_id(collection)
+        local_path = os.path.join(self.spool_dir, f"{document_id}_{os.path.basename(destination)}")
+        tmp_path = local_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, local_path)
+
+        conn = self._connect()
+        conn.execute('''
+            INSERT INTO upload_spool (local_path, destination, content_type, collection,
+                                      document_id, document_data, url_field, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (local_path, destination, content_type, collection, document_id,
+              encode_document(document_data), url_field, datetime.now().isoformat()))
+        conn.commit()
+        conn.close()
+        self._wakeup.set()
+        return document_id
+
+    def pending_count(self):
+        conn = self._connect()
+        count = conn.execute("SELECT COUNT(*) FROM upload_spool WHERE status IN ('pending', 'uploading')").fetchone()[0]
+        conn.close()
+        return count
+
+    def _dispatch_loop(self):
+        while True:
+            try:
+                next_due = self._dispatch_due()
+            except Exception as e:
+                # Un error puntual (p. ej. la base de datos bloqueada) no debe parar las subidas.
+                print(f"Error en el despachador de subidas: {e}")
+                next_due = time.time() + self.base_delay
+            # Dormir hasta el próximo reintento o hasta que llegue un trabajo nuevo.
+            timeout = None if next_due is None else max(0.0, next_due - time.time())
+            self._wakeup.wait(timeout=timeout if timeout is not None else 60)
+            self._wakeup.clear()
+
+    def _dispatch_due(self):
+        """Envía al pool los trabajos vencidos; retorna cuándo vence el siguiente."""
+        now = time.time()
+        conn = self._connect()
+        self._recover_stale(conn)
+        conn.commit()
+        rows = conn.execute('''
+            SELECT * FROM upload_spool WHERE status = 'pending' AND next_attempt_at <= ?
+            ORDER BY id
+        ''', (now,)).fetchall()
+        for row in rows:
+            with self._in_flight_lock:
+                if row['id'] in self._in_flight:
+                    continue
+                self._in_flight.add(row['id'])
+            # Otro proceso pudo reclamarlo entre el SELECT y aquí.
+            claimed = conn.execute('''
+                UPDATE upload_spool SET status = 'uploading', claimed_at = ? WHERE id = ? AND status = 'pending'
+            ''', (now, row['id'])).rowcount
+            conn.commit()
+            if not claimed:
+                with self._in_flight_lock:
+                    self._in_flight.discard(row['id'])
+                continue
+            self._executor.submit(self._process, dict(row))
+        next_row = conn.execute('''
+            SELECT MIN(next_attempt_at) FROM upload_spool WHERE status = 'pending' AND next_attempt_at > ?
+        ''', (now,)).fetchone()
+        conn.close()
+        return next_row[0]
+
+    def _process(self, job):
+        if not os.path.exists(job['local_path']):
+            # Sin el archivo no hay nada que reintentar.
+            print(f"Falta el archivo del spool {job['local_path']}: la subida a {job['destination']} queda fallida.")
+            conn = self._connect()
+            conn.execute('''
+                UPDATE upload_spool SET status = 'failed', claimed_at = NULL, last_error = ? WHERE id = ?
+            ''', ('Falta el archivo del spool', job['id']))
+            conn.commit()
+            conn.close()
+            with self._in_flight_lock:
+                self._in_flight.discard(job['id'])
+            return
+        try:
+            self._upload(job)
+        except Exception as e:
+            attempts = job['attempts'] + 1
+            delay = min(self.max_delay, self.base_delay * (2 ** (attempts - 1)))
+            delay *= random.uniform(0.8, 1.2)
+            print(f"Error al subir {job['destination']} (intento {attempts}): {e}. Reintento en {delay:.0f} s.")
+            conn = self._connect()
+            conn.execute('''
+                UPDATE upload_spool SET status = 'pending', claimed_at = NULL, attempts = ?, next_attempt_at = ?,
+                                        last_error = ?
+                WHERE id = ?
+            ''', (attempts, time.time() + delay, str(e), job['id']))
+            conn.commit()
+            conn.close()
+        else:
+            conn = self._connect()
+            conn.execute("DELETE FROM upload_spool WHERE id = ?", (job['id'],))
+            conn.commit()
+            conn.close()
+            try:
+                os.remove(job['local_path'])
+            except OSError:
+                pass
+        finally:
+            with self._in_flight_lock:
+                self._in_flight.discard(job['id'])
+            self._wakeup.set()
+
+    def _upload(self, job):
+        if not self.bucket or not self.firestore_client:
+            raise RuntimeError("Firebase no está disponible")
+        blob = self.bucket.blob(job['destination'])
+        with metrics.span('storage', 'upload'):
+            blob.upload_from_filename(job['local_path'], content_type=job['content_type'])
+            blob.make_public()
+        document_data = decode_document(job['document_data'])
+        document_data[job['url_field']] = blob.public_url
+        if self.derivatives and (job['content_type'] or '').startswith('image/'):
+            try:
+                derived = self.derivatives(job['local_path'], job['destination'])
+            except Exception as e:
+                # Una imagen que no se puede reducir (p. ej. un JPEG truncado) se guarda sin
+                # miniaturas; la galería usa entonces la imagen original.
+                print(f"Error al generar las miniaturas de {job['local_path']}: {e}")
+                derived = []
+            for destination, data, content_type, field in derived:
+                derived_blob = self.bucket.blob(destination)
+                with metrics.span('storage', 'upload'):
+                    derived_blob.upload_from_string(data, content_type=content_type)
+                    derived_blob.make_public()
+                document_data[field] = derived_blob.public_url
+        if self.analyze and (job['content_type'] or '').startswith('image/'):
+            try:
+                document_data.update(self.analyze(job['local_path']))
+            except Exception as e:
+                print(f"Error al analizar {job['local_path']}: {e}")
+        with metrics.span('firestore', 'set'):
+            self.firestore_client.collection(job['collection']).document(job['document_id']).set(document_data, merge=True)
+        print(f"Archivo {job['local_path']} subido a Storage como {job['destination']}.")